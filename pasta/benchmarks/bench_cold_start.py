@@ -0,0 +1,178 @@
+# bench_cold_start.py
+"""
+Cold start medido em processos novos (cada repetição é um python do zero):
+tempo do import do fisconforme e latência da primeira requisição, contra o
+stand-in sefin_fake:
+
+    python benchmarks/bench_cold_start.py                        # grava benchmarks/resultados/cold_<data>.json
+    python benchmarks/bench_cold_start.py -n 10 --saida cold.json
+
+Cenários:
+    import                  import fisconforme (e quais libs pesadas vieram junto)
+    import_eager            idem, importando antes bs4/lxml/pypdf/playwright/anticaptcha/uvicorn
+                            (como era com os imports no topo do módulo)
+    health                  import + primeira GET /health
+    fisconforme             primeira e segunda GET /fisconforme (refresh=1)
+    fisconforme_prewarm     GET /prewarm?aguardar=60 e depois a primeira /fisconforme
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+DIR_PASTA = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIR_PASTA)
+
+REPETICOES = 5
+DIR_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resultados")
+LIBS_PESADAS = ("bs4", "lxml", "pypdf", "playwright", "anticaptchaofficial", "uvicorn")
+
+
+# =========================================================
+# FILHO (um processo por repetição)
+# =========================================================
+def _ms(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000, 3)
+
+
+def _importar() -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    import fisconforme  # noqa: F401
+    return {"import_ms": _ms(t0), "libs_no_import": [m for m in LIBS_PESADAS if m in sys.modules]}
+
+
+def _cliente():
+    import fisconforme
+    from fastapi.testclient import TestClient
+    return fisconforme, TestClient(fisconforme.app)
+
+
+def filho_import() -> Dict[str, Any]:
+    return _importar()
+
+
+def filho_import_eager() -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    import bs4, lxml.html, pypdf, playwright.sync_api, anticaptchaofficial.imagecaptcha, uvicorn  # noqa: E401,F401
+    libs_ms = _ms(t0)
+    out = _importar()
+    out["libs_ms"] = libs_ms
+    out["import_ms"] = round(out["import_ms"] + libs_ms, 3)
+    return out
+
+
+def filho_health() -> Dict[str, Any]:
+    out = _importar()
+    _, c = _cliente()
+    t0 = time.perf_counter()
+    c.get("/health").raise_for_status()
+    out["primeira_ms"] = _ms(t0)
+    return out
+
+
+def _fisconforme(prewarm: bool) -> Dict[str, Any]:
+    out = _importar()
+    fisconforme, c = _cliente()
+    from benchmarks.sefin_fake import StandInSefin
+
+    with StandInSefin(empresas=2) as sefin:
+        sefin.apontar(fisconforme)
+        if prewarm:
+            t0 = time.perf_counter()
+            c.get("/prewarm", params={"aguardar": 60}).raise_for_status()
+            out["prewarm_ms"] = _ms(t0)
+        for chave in ("primeira_ms", "segunda_ms"):
+            t0 = time.perf_counter()
+            c.get("/fisconforme", params={"user": sefin.user, "refresh": 1}).raise_for_status()
+            out[chave] = _ms(t0)
+    return out
+
+
+CENARIOS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    "import": filho_import,
+    "import_eager": filho_import_eager,
+    "health": filho_health,
+    "fisconforme": lambda: _fisconforme(False),
+    "fisconforme_prewarm": lambda: _fisconforme(True),
+}
+
+
+# =========================================================
+# PAI
+# =========================================================
+def _rodar_filho(cenario: str) -> Dict[str, Any]:
+    r = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--filho", cenario],
+        capture_output=True, text=True, timeout=300, cwd=DIR_PASTA,
+    )
+    if r.returncode != 0:
+        erro = (r.stderr or r.stdout).strip()
+        raise RuntimeError(erro.splitlines()[-1] if erro else f"código {r.returncode}")
+    # a última linha é o JSON; o resto são os prints do fisconforme
+    return json.loads(r.stdout.strip().splitlines()[-1])
+
+
+def rodar(nomes: List[str], n: int) -> Dict[str, Any]:
+    resultado: Dict[str, Any] = {
+        "meta": {
+            "quando": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "repeticoes": n,
+        },
+        "cenarios": {},
+    }
+    for nome in nomes:
+        try:
+            rodadas = [_rodar_filho(nome) for _ in range(n)]
+        except Exception as e:
+            resultado["cenarios"][nome] = {"status": "erro", "motivo": str(e)}
+            print(f"{nome:22} erro    {str(e)[:80]}")
+            continue
+        est: Dict[str, Any] = {"status": "ok", "libs_no_import": rodadas[-1].get("libs_no_import", [])}
+        for chave in rodadas[0]:
+            if chave.endswith("_ms"):
+                est[f"{chave[:-3]}_mediana_ms"] = round(statistics.median(r[chave] for r in rodadas), 3)
+        resultado["cenarios"][nome] = est
+        print(f"{nome:22} " + "  ".join(f"{k} {v:9.1f}" for k, v in est.items() if k.endswith("_ms"))
+              + (f"  libs: {','.join(est['libs_no_import'])}" if est["libs_no_import"] else ""))
+    return resultado
+
+
+def main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(description="Cold start: import e primeira requisição (offline)")
+    ap.add_argument("--cenarios", default=",".join(CENARIOS), help="lista separada por vírgula")
+    ap.add_argument("-n", type=int, default=REPETICOES, help="processos por cenário")
+    ap.add_argument("--saida", help="arquivo JSON (padrão: benchmarks/resultados/cold_<data>.json)")
+    ap.add_argument("--filho", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+
+    if args.filho:
+        print(json.dumps(CENARIOS[args.filho]()))
+        return 0
+
+    nomes = [c.strip() for c in args.cenarios.split(",") if c.strip()]
+    desconhecidos = [c for c in nomes if c not in CENARIOS]
+    if desconhecidos:
+        ap.error(f"cenários desconhecidos: {', '.join(desconhecidos)}")
+
+    resultado = rodar(nomes, max(1, args.n))
+
+    saida = args.saida
+    if not saida:
+        os.makedirs(DIR_RESULTADOS, exist_ok=True)
+        saida = os.path.join(DIR_RESULTADOS, "cold_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    with open(saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nresultado: {saida}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
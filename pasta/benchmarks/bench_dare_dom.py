@@ -0,0 +1,75 @@
+# bench_dare_dom.py
+"""
+Benchmark do preparar_dare_duas_vias: transformador de uma passada x versão
+multipasso antiga (tests/dare_multipasso_referencia.py; a equivalência do
+<body> é checada em tests/test_dare_dom.py).
+
+    python benchmarks/bench_dare_dom.py                    # página DARE de paginas_sefin
+    python benchmarks/bench_dare_dom.py guia1.html guia2.html
+    python benchmarks/bench_dare_dom.py pasta_com_htmls/
+
+Use páginas DARE finais salvas (as que têm "copy-cb").
+"""
+import os
+import sys
+import time
+import statistics
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fisconforme  # noqa: E402
+from benchmarks.paginas_sefin import dare_final  # noqa: E402
+from tests import dare_multipasso_referencia as multipasso  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+REPETICOES = 20
+
+
+def carregar_paginas(args: List[str]) -> List[Tuple[str, str]]:
+    paginas = []
+    for a in args:
+        if os.path.isdir(a):
+            for nome in sorted(os.listdir(a)):
+                if nome.lower().endswith((".html", ".htm")):
+                    with open(os.path.join(a, nome), encoding="utf-8", errors="replace") as f:
+                        paginas.append((nome, f.read()))
+        else:
+            with open(a, encoding="utf-8", errors="replace") as f:
+                paginas.append((os.path.basename(a), f.read()))
+    if not paginas:
+        paginas.append(("sintetica.html", dare_final()))
+    return paginas
+
+
+def _normalizar(html: str) -> str:
+    soup = BeautifulSoup(html, "lxml")
+    corpo = soup.body or soup
+    return " ".join(corpo.get_text(" ", strip=True).split())
+
+
+def medir(func, html: str, n: int = REPETICOES) -> List[float]:
+    tempos = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        func(html)
+        tempos.append(time.perf_counter() - t0)
+    return tempos
+
+
+def main(argv: List[str]) -> int:
+    paginas = carregar_paginas(argv)
+    print(f"{'página':30} {'KB':>7} {'multipasso ms':>14} {'1 passada ms':>13} {'speed-up':>9}  texto igual")
+    for nome, html in paginas:
+        antigo = medir(multipasso.preparar_dare_duas_vias, html)
+        novo = medir(fisconforme.preparar_dare_duas_vias, html)
+        ma, mn = statistics.median(antigo) * 1000, statistics.median(novo) * 1000
+        igual = _normalizar(multipasso.preparar_dare_duas_vias(html)) == _normalizar(
+            fisconforme.preparar_dare_duas_vias(html)
+        )
+        print(f"{nome[:30]:30} {len(html) / 1024:7.1f} {ma:14.2f} {mn:13.2f} {ma / mn:8.2f}x  {igual}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,291 @@
+# bench_etapas.py
+"""
+Benchmark por etapa do pipeline, offline (stand-in sefin_fake + páginas de
+paginas_sefin), com saída JSON para comparar commits:
+
+    python benchmarks/bench_etapas.py                           # grava benchmarks/resultados/<data>.json
+    python benchmarks/bench_etapas.py --saida atual.json --comparar anterior.json
+    python benchmarks/bench_etapas.py --etapas parse_debitos,dare_dom -n 50
+
+Etapas que dependem do Chromium (render_pdf, zip_dares) são marcadas como
+"pulada" quando o Playwright não consegue abrir o navegador.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fisconforme  # noqa: E402
+from benchmarks import paginas_sefin as pg  # noqa: E402
+from benchmarks.sefin_fake import StandInSefin  # noqa: E402
+from pypdf import PdfWriter  # noqa: E402
+
+REPETICOES = 20
+DIR_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resultados")
+LIMIAR_REGRESSAO = 1.15   # mediana 15% maior que a anterior = regressão
+
+
+class EtapaPulada(Exception):
+    pass
+
+
+def _estatisticas(tempos: List[float]) -> Dict[str, Any]:
+    ord_ = sorted(tempos)
+    p95 = ord_[min(len(ord_) - 1, int(0.95 * len(ord_)))]
+    return {
+        "n": len(tempos),
+        "min_ms": round(ord_[0] * 1000, 3),
+        "mediana_ms": round(statistics.median(ord_) * 1000, 3),
+        "media_ms": round(statistics.fmean(ord_) * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "max_ms": round(ord_[-1] * 1000, 3),
+    }
+
+
+def medir(func: Callable[[], Any], n: int, preparar: Optional[Callable[[], Any]] = None) -> Dict[str, Any]:
+    func()  # aquecimento (imports, caches de regex, conexões)
+    tempos = []
+    for _ in range(n):
+        if preparar:
+            preparar()
+        t0 = time.perf_counter()
+        func()
+        tempos.append(time.perf_counter() - t0)
+    return _estatisticas(tempos)
+
+
+def _pdf_exemplo(paginas: int) -> bytes:
+    w = PdfWriter()
+    for _ in range(paginas):
+        w.add_blank_page(width=595, height=842)
+    buf = io.BytesIO()
+    w.write(buf)
+    return buf.getvalue()
+
+
+def _html_dare_completo() -> str:
+    body = fisconforme.preparar_dare_duas_vias(pg.dare_final())
+    return fisconforme.montar_html_dare_e_extrato(body, fisconforme._body_extrato(pg.extrato("1")))
+
+
+def _chromium_disponivel() -> Optional[str]:
+    try:
+        fisconforme.pool_chromium.renderizar_pdf("<p>ok</p>")
+        return None
+    except Exception as e:
+        return str(e).strip().splitlines()[0]
+
+
+# =========================================================
+# ETAPAS
+# =========================================================
+def etapa_parse_pendencias(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    html = pg.fisconforme_pendencias(200)
+    return medir(lambda: fisconforme.obter_pendencias_fisconforme(html), n)
+
+
+def etapa_parse_debitos(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    html = pg.debitos_lista("http://x", qtd=300, junk_kb=256)
+    return medir(lambda: fisconforme.obter_debitos_inscricao_estadual(html), n)
+
+
+def etapa_dare_dom(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    html = pg.dare_final()
+    return medir(lambda: fisconforme.preparar_dare_duas_vias(html), n)
+
+
+def etapa_montar_html(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    return medir(_html_dare_completo, n)
+
+
+def etapa_render_pdf(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    if ctx["chromium_erro"]:
+        raise EtapaPulada(ctx["chromium_erro"])
+    html = _html_dare_completo()
+    return medir(lambda: fisconforme.pool_chromium.renderizar_pdf(html), max(3, n // 4))
+
+
+def etapa_merge_pdfs(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Fallback 2 renders + merge: em memória, como no fluxo."""
+    entradas = [_pdf_exemplo(paginas) for paginas in (1, 3)]
+    return medir(lambda: fisconforme.merge_pdfs_bytes(entradas), n)
+
+
+def etapa_zip_escrita(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """40 PDFs em memória -> ZIP com writestr (sem arquivo intermediário)."""
+    pdf = _pdf_exemplo(2)
+    zip_path = os.path.join(ctx["tmpdir"], "bench.zip")
+
+    def escrever():
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for i in range(40):
+                zf.writestr(f"EMPRESA_{i % 5}/DARE_{i}.pdf", pdf)
+
+    return medir(escrever, n)
+
+
+def etapa_fluxo_fisconforme(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Login + FisConforme + débitos contra o stand-in; sessão fria a cada rodada."""
+    sefin: StandInSefin = ctx["sefin"]
+    cert = fisconforme.carregar_certificados_validos(sefin.user)[0]
+    r = fisconforme.fluxo_fisconforme(cert)
+    if r["situacao_geral"] == "erro":
+        raise RuntimeError(r["erro"] or r["erro_debitos"] or r["erro_fisconforme"])
+    return medir(lambda: fisconforme.fluxo_fisconforme(cert), n, preparar=fisconforme.cache_sessoes.limpar)
+
+
+def etapa_fluxo_fisconforme_sessao_quente(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    sefin: StandInSefin = ctx["sefin"]
+    cert = fisconforme.carregar_certificados_validos(sefin.user)[0]
+    return medir(lambda: fisconforme.fluxo_fisconforme(cert), n)
+
+
+def etapa_dare_captcha(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """GET do DARE + captcha (solver local) + POST, sem render."""
+    sefin: StandInSefin = ctx["sefin"]
+    cert = fisconforme.carregar_certificados_validos(sefin.user)[0]
+    with fisconforme.cache_sessoes.sessao(cert) as (sess, _):
+        debs, _erros = fisconforme.consultar_debitos_anos(sess, [datetime.now().year])
+        url = debs[0]["url_dare"]
+        return medir(lambda: fisconforme.carregar_html_dare_final(sess, url), n)
+
+
+def etapa_zip_dares(n: int, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """gerar_zip_dares de ponta a ponta (todas as empresas do stand-in)."""
+    if ctx["chromium_erro"]:
+        raise EtapaPulada(ctx["chromium_erro"])
+    sefin: StandInSefin = ctx["sefin"]
+    destino = os.path.join(ctx["tmpdir"], "zips")
+    os.makedirs(destino, exist_ok=True)
+    ativo = fisconforme.cache_pdf_dare.ativo
+    fisconforme.cache_pdf_dare.ativo = False   # mede captcha + render, não o cache
+    try:
+        return medir(lambda: fisconforme.gerar_zip_dares(sefin.user, destino_dir=destino), max(1, n // 10))
+    finally:
+        fisconforme.cache_pdf_dare.ativo = ativo
+
+
+ETAPAS: Dict[str, Callable[[int, Dict[str, Any]], Dict[str, Any]]] = {
+    "parse_pendencias": etapa_parse_pendencias,
+    "parse_debitos": etapa_parse_debitos,
+    "dare_dom": etapa_dare_dom,
+    "montar_html": etapa_montar_html,
+    "render_pdf": etapa_render_pdf,
+    "merge_pdfs": etapa_merge_pdfs,
+    "zip_escrita": etapa_zip_escrita,
+    "fluxo_fisconforme": etapa_fluxo_fisconforme,
+    "fluxo_fisconforme_sessao_quente": etapa_fluxo_fisconforme_sessao_quente,
+    "dare_captcha": etapa_dare_captcha,
+    "zip_dares": etapa_zip_dares,
+}
+
+
+# =========================================================
+# EXECUÇÃO / COMPARAÇÃO
+# =========================================================
+def _commit_atual() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def rodar(nomes: List[str], n: int) -> Dict[str, Any]:
+    resultado: Dict[str, Any] = {
+        "meta": {
+            "quando": datetime.now().isoformat(timespec="seconds"),
+            "commit": _commit_atual(),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "repeticoes": n,
+        },
+        "etapas": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_etapas_") as tmpdir, StandInSefin(empresas=3) as sefin:
+        sefin.apontar(fisconforme)
+        ctx = {"tmpdir": tmpdir, "sefin": sefin, "chromium_erro": None}
+        if {"render_pdf", "zip_dares"} & set(nomes):
+            ctx["chromium_erro"] = _chromium_disponivel()
+        try:
+            for nome in nomes:
+                try:
+                    est = ETAPAS[nome](n, ctx)
+                    est["status"] = "ok"
+                except EtapaPulada as e:
+                    est = {"status": "pulada", "motivo": str(e)}
+                except Exception as e:
+                    est = {"status": "erro", "motivo": f"{type(e).__name__}: {e}"}
+                resultado["etapas"][nome] = est
+                print(f"{nome:34} {est['status']:7} " + (
+                    f"mediana {est['mediana_ms']:9.2f} ms  p95 {est['p95_ms']:9.2f} ms"
+                    if est["status"] == "ok" else est.get("motivo", "")[:80]
+                ))
+        finally:
+            fisconforme.pool_chromium.encerrar()
+        resultado["meta"]["requisicoes_stand_in"] = dict(sefin.requisicoes)
+    return resultado
+
+
+def comparar(atual: Dict[str, Any], anterior: Dict[str, Any]) -> List[str]:
+    """Imprime a variação da mediana por etapa; devolve as etapas que regrediram."""
+    regressoes = []
+    print(f"\n{'etapa':34} {'antes ms':>10} {'agora ms':>10} {'razão':>7}")
+    for nome, est in atual["etapas"].items():
+        ant = anterior.get("etapas", {}).get(nome)
+        if est.get("status") != "ok" or not ant or ant.get("status") != "ok":
+            continue
+        razao = est["mediana_ms"] / ant["mediana_ms"] if ant["mediana_ms"] else float("inf")
+        marca = "  << regressão" if razao > LIMIAR_REGRESSAO else ""
+        if marca:
+            regressoes.append(nome)
+        print(f"{nome:34} {ant['mediana_ms']:10.2f} {est['mediana_ms']:10.2f} {razao:6.2f}x{marca}")
+    return regressoes
+
+
+def main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark por etapa (offline)")
+    ap.add_argument("--etapas", default=",".join(ETAPAS), help="lista separada por vírgula")
+    ap.add_argument("-n", type=int, default=REPETICOES, help="repetições por etapa")
+    ap.add_argument("--saida", help="arquivo JSON (padrão: benchmarks/resultados/<data>.json)")
+    ap.add_argument("--comparar", help="JSON de uma rodada anterior")
+    args = ap.parse_args(argv)
+
+    nomes = [e.strip() for e in args.etapas.split(",") if e.strip()]
+    desconhecidas = [e for e in nomes if e not in ETAPAS]
+    if desconhecidas:
+        ap.error(f"etapas desconhecidas: {', '.join(desconhecidas)}")
+
+    resultado = rodar(nomes, max(1, args.n))
+
+    saida = args.saida
+    if not saida:
+        os.makedirs(DIR_RESULTADOS, exist_ok=True)
+        saida = os.path.join(DIR_RESULTADOS, datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    with open(saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nresultado: {saida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            anterior = json.load(f)
+        if comparar(resultado, anterior):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,177 @@
+# paginas_sefin.py
+"""
+Páginas SEFIN "gravadas" para o stand-in offline e para os benchmarks.
+
+Cada página tem um gerador sintético com a mesma estrutura que os parsers do
+fisconforme.py procuram. Para usar páginas reais salvas do portal, coloque o
+HTML em PAGINAS_DIR (ou na variável de ambiente SEFIN_PAGINAS_DIR) com o
+nome da função (ex.: debitos_lista.html, dare_final.html); o arquivo
+substitui o gerador.
+"""
+import base64
+import os
+from datetime import date, timedelta
+from typing import Optional
+
+PAGINAS_DIR = os.getenv("SEFIN_PAGINAS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gravadas"))
+
+CAPTCHA_PREFIXO = b"CAPTCHA:"
+
+
+def _gravada(nome: str) -> Optional[str]:
+    path = os.path.join(PAGINAS_DIR, f"{nome}.html")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return f.read()
+    return None
+
+
+def det_certificados(base: str) -> str:
+    return _gravada("det_certificados") or f"""<!doctype html><html><body>
+<h1>Acesso Digital</h1>
+<form action="{base}/detsec.sefin.ro.gov.br/entrar" method="get"><button>Entrar com certificado</button></form>
+</body></html>"""
+
+
+def det_acessos() -> str:
+    return _gravada("det_acessos") or "<html><body><h2>Acessos do certificado</h2></body></html>"
+
+
+def redirect_portal(base: str) -> str:
+    return _gravada("redirect_portal") or f"""<!doctype html><html><body onload="document.forms[0].submit()">
+<form action="{base}/portalcontribuinte.sefin.ro.gov.br/LoginToken" method="post">
+  <input type="hidden" name="token" value="tok-123">
+  <input type="hidden" name="origem" value="det">
+</form></body></html>"""
+
+
+def portal_home(base: str) -> str:
+    menu = "".join(f"<li><a href='/app/servico{i}'>Serviço {i}</a></li>" for i in range(60))
+    return _gravada("portal_home") or f"""<!doctype html><html><body>
+<ul class="menu">{menu}</ul>
+<form action="/portalcontribuinte.sefin.ro.gov.br/fisconforme/acesso" method="post">
+  <input type="hidden" name="token" value="fis-456">
+</form>
+<form action="/app/busca"><input name="q"></form>
+</body></html>"""
+
+
+def fisconforme_pendencias(qtd: int = 8) -> str:
+    linhas = "".join(
+        f"<tr><td>{1000 + i}</td><td>00000000{i}</td><td>EMPRESA TESTE</td><td>0{1 + i % 9}/2025</td>"
+        f"<td>Omissão de EFD ICMS/IPI do período <b>{i}</b></td></tr>"
+        for i in range(qtd)
+    )
+    return _gravada("fisconforme_pendencias") or f"""<!doctype html><html><body>
+<table><thead><tr><th>Aviso</th></tr></thead><tbody><tr><td>Sem avisos</td></tr></tbody></table>
+<table class="pendencias">
+<thead><tr><th>Código</th><th>IE</th><th>Nome</th><th>Período</th><th>Descrição da Pendência</th></tr></thead>
+<tbody>{linhas}</tbody></table>
+</body></html>"""
+
+
+def debitos_form(ies=("000000001", "000000002")) -> str:
+    opts = "".join(f"<option value='{ie}'>{ie}</option>" for ie in ies)
+    return _gravada("debitos_form") or f"""<!doctype html><html><body>
+<form action="lista.jsp" method="post">
+  <input type="hidden" name="tipoDevedor" value="1">
+  <select name="inscricaoEstadual"><option value="">Selecione</option>{opts}</select>
+  <input name="ano"><input type="submit" name="Submit" value="Consultar Débitos">
+</form></body></html>"""
+
+
+def debitos_lista(base: str, ie: str = "000000001", ano: str = "2026", qtd: int = 6, junk_kb: int = 0) -> str:
+    gravada = _gravada("debitos_lista")
+    if gravada:
+        return gravada
+    linhas = []
+    hoje = date.today()
+    for i in range(qtd):
+        venc = (hoje + timedelta(days=i % 20)).strftime("%d/%m/%Y")  # dentro de DIAS_MAX_FUTURO_DARE
+        lanc = f"{ie[-3:]}{ano}{i:05d}"
+        linhas.append(
+            "<tr>"
+            f"<td><a href='{base}/dare.sefin.ro.gov.br/adm/emitir?lanc={lanc}'>DARE</a></td>"
+            f"<td><a href='extrato.jsp?lanc={lanc}'>Extrato</a></td>"
+            f"<td>{lanc}</td><td>{i % 3}</td><td>{(i % 12) + 1:02d}/{ano}</td><td></td>"
+            f"<td>1{i % 4}01</td><td>EM ABERTO</td><td>{venc}</td>"
+            f"<td>{100 + i},00</td><td>{110 + i},57</td>"
+            "</tr>"
+        )
+    junk = "<p>" + ("texto de rodapé " * (junk_kb * 64)) + "</p>" if junk_kb else ""
+    return f"""<!doctype html><html><body>
+<table><tr><th>Contribuinte</th></tr><tr><td>EMPRESA TESTE</td></tr></table>
+<table>
+<tr><th colspan="11">Débitos na Inscrição Estadual {ie}</th></tr>
+<tr><th>DARE</th><th>Extrato</th><th>Nº Lançamento</th><th>Parcela</th><th>Referência</th><th>Compl.</th>
+<th>Receita</th><th>Situação</th><th>Vencimento</th><th>Valor</th><th>Valor Atualizado</th></tr>
+{''.join(linhas)}
+</table>{junk}
+</body></html>"""
+
+
+def imagem_captcha(resposta: str) -> bytes:
+    """"Imagem" do captcha fake: o solver local lê a resposta dos próprios bytes."""
+    return CAPTCHA_PREFIXO + resposta.encode()
+
+
+def resposta_do_captcha(img_bytes: bytes) -> Optional[str]:
+    if img_bytes.startswith(CAPTCHA_PREFIXO):
+        return img_bytes[len(CAPTCHA_PREFIXO):].decode()
+    return None
+
+
+def dare_captcha(lanc: str, resposta: str) -> str:
+    b64 = base64.b64encode(imagem_captcha(resposta)).decode()
+    return _gravada("dare_captcha") or f"""<!doctype html><html><body>
+<form id="adm_processar_form" action="/dare.sefin.ro.gov.br/adm/processar" method="post">
+  <input type="hidden" name="lanc" value="{lanc}">
+  <img id="captcha-imagem" src="data:image/png;base64,{b64}">
+  <input name="captcha[resposta]">
+  <select name="formato"><option value="pdf" selected>PDF</option><option value="html">HTML</option></select>
+</form></body></html>"""
+
+
+def dare_final(linhas_extra: int = 40) -> str:
+    gravada = _gravada("dare_final")
+    if gravada:
+        return gravada
+
+    def via(rotulo: str) -> str:
+        itens = "".join(
+            f"<tr><td class='lbl'>Campo {i}</td><td style='page-break-inside:avoid'>Valor do campo {i} da guia</td></tr>"
+            for i in range(linhas_extra)
+        )
+        return f"""
+<table class="dare" width="100%">
+  <tr><td><img src="/img/logo_sefin.png"></td><td><b>GOVERNO DO ESTADO DE RONDÔNIA</b><br>SECRETARIA DE FINANÇAS</td></tr>
+  <tr><td colspan="2">DOCUMENTO DE ARRECADAÇÃO DE RECEITAS ESTADUAIS - DARE</td></tr>
+  {itens}
+  <tr><td colspan="2"><span>85800000001 234567890123 456789012345 678901234567</span></td></tr>
+  <tr><td colspan="2"><img src="/adm/codigo_barras.php?c=858000"></td></tr>
+  <tr><td colspan="2"><div class="copy-cb"><a href="#" class="btn">COPIAR CÓDIGO DE BARRAS</a></div></td></tr>
+  <tr><td colspan="2"><small>{rotulo}</small></td></tr>
+</table>"""
+
+    return f"""<!doctype html><html><head><meta charset="utf-8"><title>DARE</title>
+<link rel="stylesheet" href="/css/dare.css"></head>
+<body>
+<div class="menu"><a href="/adm/voltar">Voltar</a> <button onclick="print()">Imprimir</button></div>
+<div class="guia">
+  <div class="bloco">{via("Autenticação mecânica / Via banco")}</div>
+  <div class="pagebreak" style="page-break-after:always;"></div>
+  <div class="bloco">{via("Autenticação mecânica / Via Usuário")}</div>
+  <div><a href="#">COPIAR QR CODE PIX</a></div>
+</div>
+<script src="/js/dare.js"></script>
+</body></html>"""
+
+
+def extrato(lanc: str, linhas: int = 30) -> str:
+    corpo = "".join(
+        f"<tr><td>{i + 1:02d}/01/2026</td><td>Movimento {i}</td><td>{10 + i},00</td></tr>" for i in range(linhas)
+    )
+    return _gravada("extrato") or f"""<!doctype html><html><head><link rel="stylesheet" href="css/extrato.css"></head>
+<body><h3>Extrato do lançamento {lanc}</h3>
+<table><tr><th>Data</th><th>Histórico</th><th>Valor</th></tr>{corpo}</table>
+<img src="img/brasao.png"></body></html>"""
@@ -1,26 +1,48 @@
 # fisconforme.py
 import os
 import re
+import json
+import uuid
 import base64
+import queue
+import shutil
 import tempfile
+import threading
+import copy
+import hashlib
+import io
+import random
+import sqlite3
+import ssl
 import time
+import asyncio
+import weakref
 import zipfile
-from datetime import date, timedelta
-from typing import Dict, Any, Optional, List, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturoTimeout
+import multiprocessing
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Dict, Any, Optional, List, Tuple, Callable
 
 import requests
-from bs4 import BeautifulSoup
+import httpx
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
-import uvicorn
-
-from playwright.sync_api import sync_playwright
-from anticaptchaofficial.imagecaptcha import imagecaptcha
-from pypdf import PdfReader, PdfWriter
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 from pydantic import BaseModel, Field
 
+# bs4/lxml, pypdf, playwright, anticaptcha e uvicorn são importados no
+# primeiro uso (cold start do /health e /fisconforme sem render); /prewarm
+# adianta a carga
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, SoupStrainer, Tag
+    from pypdf import PdfWriter
+
 # =========================================================
 # 🔐 CONFIG FIXA
 # =========================================================
@@ -34,6 +56,9 @@ SUPABASE_KEY = (
 TABELA_CERTS = "certifica_dfe"
 
 ANTICAPTCHA_KEY = "60ce5191cf427863d4f3c79ee20e4afe"
+CAPTCHA_BACKEND = os.getenv("CAPTCHA_BACKEND", "anticaptcha")   # "anticaptcha" | "local"
+CAPTCHA_POLL_INTERVALO = 2.0            # s entre rodadas de getTaskResult (todas as tasks juntas)
+CAPTCHA_TIMEOUT = 90                    # s por captcha
 
 # =========================================================
 # URLs DET / PORTAL
@@ -51,6 +76,96 @@ BASE_PORTAL = "https://portalcontribuinte.sefin.ro.gov.br/"
 
 DIAS_MAX_FUTURO_DARE = 30
 
+# consulta de débitos: ano atual + N anteriores, todas as IEs. A lista.jsp
+# guarda IE/ano na sessão do portal (um cookie jar por empresa): POSTs
+# simultâneos na mesma sessão podem devolver a lista de outra IE/ano, então
+# o padrão é um por vez. O paralelismo fica entre empresas.
+DEBITOS_ANOS_ATRAS = int(os.getenv("DEBITOS_ANOS_ATRAS", "1"))
+DEBITOS_MAX_PARALELO = int(os.getenv("DEBITOS_MAX_PARALELO", "1"))   # POSTs simultâneos na mesma sessão
+
+# =========================================================
+# /dares: execução por empresa
+# =========================================================
+DARES_MODOS_EXECUCAO = ("pipeline", "thread", "process", "serial")
+DARES_MODO_EXECUCAO = os.getenv("DARES_MODO_EXECUCAO", "thread")   # um de DARES_MODOS_EXECUCAO
+DARES_MAX_WORKERS = int(os.getenv("DARES_MAX_WORKERS", "4"))
+DARES_MAX_WORKERS_LIMITE = 16
+ZIP_STREAM_BLOCO = 256 * 1024           # bytes por chunk enviado ao cliente
+ZIP_STREAM_MAX_BLOCOS = 32              # chunks em memória antes de travar o writer
+
+# modo "pipeline": estágios com filas limitadas entre eles (workers = empresas no estágio http)
+PIPELINE_WORKERS_CAPTCHA = int(os.getenv("PIPELINE_WORKERS_CAPTCHA", "16"))   # empresas com captcha em andamento (1 por sessão)
+PIPELINE_WORKERS_DOM = int(os.getenv("PIPELINE_WORKERS_DOM", "2"))
+PIPELINE_WORKERS_RENDER = int(os.getenv("PIPELINE_WORKERS_RENDER", "0"))       # 0 = POOL_CHROMIUM_TAMANHO
+PIPELINE_FILA_MAX = 32                  # itens por fila entre estágios (backpressure)
+
+# como os PDFs entram no ZIP (/dares?arquivo=&otimizar=)
+DARES_ARQUIVO_MODO = os.getenv("DARES_ARQUIVO_MODO", "deflate")   # "deflate" | "store" | "zip_por_empresa" | "pdf_por_empresa"
+DARES_PDF_OTIMIZAR = os.getenv("DARES_PDF_OTIMIZAR", "0") == "1"  # dedup de imagens/fontes idênticas (pypdf)
+
+# PDFs prontos esperando o writer do ZIP: em memória até o teto, depois no scratch da execução
+PDF_MEMORIA_MAX_MB = int(os.getenv("PDF_MEMORIA_MAX_MB", "128"))
+
+# =========================================================
+# JOBS /dares (submit / status / download)
+# =========================================================
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(tempfile.gettempdir(), "fisconforme_jobs"))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "1"))     # jobs rodando ao mesmo tempo
+JOBS_RETENCAO_S = 24 * 3600                             # ZIP/estado de job finalizado
+JOBS_INTERVALO_LIMPEZA_S = 10 * 60
+
+# =========================================================
+# CACHE DE SESSÃO AUTENTICADA (DET/Portal)
+# =========================================================
+SESSAO_CACHE_ATIVO = os.getenv("SESSAO_CACHE_ATIVO", "1") == "1"
+SESSAO_CACHE_TTL = 30 * 60              # s desde o login
+SESSAO_CACHE_REVALIDAR_APOS = 60        # s ocioso antes de conferir o portal de novo
+SESSAO_CACHE_MAX_ENTRADAS = 300
+SESSAO_CACHE_MAX_MB = 64
+
+# =========================================================
+# LIMITE POR HOST SEFIN + RETRY + CIRCUIT BREAKER
+# =========================================================
+LIMITE_HOST_ATIVO = os.getenv("LIMITE_HOST_ATIVO", "1") == "1"
+LIMITE_HOST_TAXA_INICIAL = float(os.getenv("LIMITE_HOST_TAXA_INICIAL", "10"))   # req/s por host
+LIMITE_HOST_TAXA_MIN = 0.5
+LIMITE_HOST_TAXA_MAX = float(os.getenv("LIMITE_HOST_TAXA_MAX", "50"))
+LIMITE_HOST_RAJADA = 10                 # tokens acumuláveis (rajada)
+LIMITE_HOST_AUMENTO = 2.0               # aumento aditivo: ~+2 req/s a cada segundo saudável
+LIMITE_HOST_FATOR_QUEDA = 0.5           # corte multiplicativo em erro / lentidão
+LIMITE_HOST_INTERVALO_CORTE = 2.0       # s entre cortes (respostas da mesma rajada contam 1x)
+LIMITE_HOST_LATENCIA_ALVO = 5.0         # s; acima disso é sinal de sobrecarga
+RETRY_GET_TENTATIVAS = 3                # retries extras (só GET/HEAD)
+RETRY_GET_BASE = 0.5                    # s; espera = U(0, base * 2^n)
+RETRY_GET_MAX = 8.0
+CIRCUITO_FALHAS = 8                     # falhas seguidas para abrir
+CIRCUITO_ABERTO_S = 30                  # s falhando rápido antes da sonda
+
+# =========================================================
+# /fisconforme: fan-out por empresa
+# =========================================================
+FISCONFORME_MAX_WORKERS = int(os.getenv("FISCONFORME_MAX_WORKERS", "8"))          # por request
+FISCONFORME_MAX_GLOBAL = int(os.getenv("FISCONFORME_MAX_GLOBAL", "24"))           # somando todos os requests
+
+# cache do resultado por certificado (os dados mudam no máximo 1x/dia)
+RESULTADO_CACHE_TTL = int(os.getenv("RESULTADO_CACHE_TTL", str(6 * 3600)))
+RESULTADO_CACHE_TTL_ERRO = 5 * 60       # cache negativo: não martelar a SEFIN fora do ar
+RESULTADO_CACHE_MAX_ENTRADAS = 5000
+
+# engine async (httpx): /fisconforme/async e /dares/async
+ASYNC_MAX_EMPRESAS = int(os.getenv("ASYNC_MAX_EMPRESAS", "200"))   # empresas simultâneas por request
+ASYNC_CONEXOES_POR_CERT = 6             # conexões keep-alive por AsyncClient (1 por certificado)
+ASYNC_MAX_DARES_POR_EMPRESA = 4         # DAREs em andamento por empresa (captcha é 1 por vez na sessão; dom/render sobrepõem)
+
+# =========================================================
+# CONFIG SNAPSHOTS (histórico de pendências/débitos)
+# =========================================================
+SNAPSHOT_ATIVO = os.getenv("SNAPSHOT_ATIVO", "1") == "1"
+SNAPSHOT_DB = os.getenv("SNAPSHOT_DB", os.path.join(tempfile.gettempdir(), "fisconforme_snapshots.sqlite3"))
+SNAPSHOT_RETENCAO_DIAS = int(os.getenv("SNAPSHOT_RETENCAO_DIAS", "90"))   # mudanças/execuções mais antigas são apagadas
+SNAPSHOT_INTERVALO_LIMPEZA_S = 3600
+SNAPSHOT_CHANGES_MAX = 5000             # mudanças por página em /fisconforme/changes
+
 # =========================================================
 # DARE: “caber na página” (estilo do seu exemplo)
 # =========================================================
@@ -59,6 +174,35 @@ ZOOM_DARE_2VIAS = 0.92           # se quebrar: 0.90 / 0.88
 LOGO_MAX_WIDTH_PX = 110
 LOGO_MAX_HEIGHT_PX = 50
 
+# =========================================================
+# CERT STORE (material decodificado em memória)
+# =========================================================
+CERT_STORE_TTL_BLOB = 6 * 3600          # rebaixa pem/key mesmo sem mudança de vencimento
+CERT_STORE_RETENCAO_ANTIGO = 60 * 60    # material substituído ainda pode estar numa sessão viva
+CERT_STORE_LOTE_IDS = 100               # ids por query id=in.(...)
+
+# =========================================================
+# CACHE DE PDF DARE (conteúdo endereçado, por dia)
+# =========================================================
+PDF_CACHE_ATIVO = os.getenv("PDF_CACHE_ATIVO", "1") == "1"
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "fisconforme_pdf_cache"))
+PDF_CACHE_MAX_MB = int(os.getenv("PDF_CACHE_MAX_MB", "512"))
+
+# =========================================================
+# POOL CHROMIUM (render de PDF)
+# =========================================================
+POOL_CHROMIUM_TAMANHO = int(os.getenv("POOL_CHROMIUM_TAMANHO", "2"))
+POOL_CHROMIUM_RECICLAR_APOS = 200       # renders por navegador antes de relançar
+POOL_CHROMIUM_MAX_HEAP_MB = 256         # JS heap da página quente (performance.memory)
+POOL_CHROMIUM_TIMEOUT_LEASE = 180       # s esperando um navegador livre
+POOL_CHROMIUM_TIMEOUT_RENDER = 120      # s por render
+
+# =========================================================
+# PREWARM (cold start)
+# =========================================================
+PREWARM_AO_INICIAR = os.getenv("PREWARM_AO_INICIAR", "0") == "1"   # startup dispara o prewarm em background
+PREWARM_CHROMIUM = os.getenv("PREWARM_CHROMIUM", "0") == "1"       # prewarm também sobe o pool Chromium
+
 # =========================================================
 # HELPERS
 # =========================================================
@@ -69,41 +213,631 @@ def _safe_filename(s: str) -> str:
     s = re.sub(r'[<>:"/\\|?*\n\r]+', "_", s or "")
     return s.strip()[:180] or "arquivo"
 
+# parse só dos trechos usados (SoupStrainer): páginas de débitos de contribuinte
+# grande passam de alguns MB e o resto da árvore não interessa.
+# Só o nome fica aqui; o SoupStrainer nasce no primeiro _soup que o usa.
+_SO_FORMS = "forms"
+_SO_FORM_DEBITOS = "form_debitos"
+_SO_SELECT_IE = "select_ie"
+_SO_FORM_CAPTCHA = "form_captcha"
+_ARGS_STRAINERS: Dict[str, Tuple[tuple, Dict[str, Any]]] = {
+    _SO_FORMS: (("form",), {}),
+    _SO_FORM_DEBITOS: ((["input", "select"],), {}),
+    _SO_SELECT_IE: (("select",), {"attrs": {"name": "inscricaoEstadual"}}),
+    _SO_FORM_CAPTCHA: ((["form", "img"],), {}),
+}
+_strainers: Dict[str, "SoupStrainer"] = {}
+
+_RE_LINK_DARE = re.compile(r"dare\.sefin\.ro\.gov\.br/adm")
+_RE_LINK_EXTRATO = re.compile(r"extrato\.jsp")
+
+def _soup(html: str, so: Optional[str] = None) -> "BeautifulSoup":
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    strainer = None
+    if so is not None:
+        strainer = _strainers.get(so)
+        if strainer is None:
+            args, kwargs = _ARGS_STRAINERS[so]
+            strainer = _strainers.setdefault(so, SoupStrainer(*args, **kwargs))
+    return BeautifulSoup(html, "lxml", parse_only=strainer)
+
+# tabelas grandes (débitos / pendências): lxml direto, sem montar árvore bs4
+_XP_TEXTO = ".//text()[not(parent::script) and not(parent::style) and not(parent::template)]"
+
+def _arvore_lxml(html: str):
+    import lxml.html
+    from lxml.etree import ParserError
+
+    if not html or not html.strip():
+        return None
+    try:
+        return lxml.html.document_fromstring(html)
+    except ValueError:
+        # str com <?xml encoding=...?>: lxml só aceita em bytes
+        return lxml.html.document_fromstring(html.encode("utf-8"))
+    except ParserError:
+        return None
+
+def _texto_lxml(el) -> str:
+    """Mesmo resultado de Tag.get_text(" ", strip=True) do bs4."""
+    return " ".join(t.strip() for t in el.xpath(_XP_TEXTO) if t.strip())
+
 def supabase_headers() -> Dict[str, str]:
     return {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"}
 
-def carregar_certificados_validos(user_filter: str) -> List[Dict[str, Any]]:
+_CAMPOS_CERT_META = 'id,empresa,codi,user,vencimento,"cnpj/cpf"'
+
+def _supabase_certs(params: Dict[str, str]) -> List[Dict[str, Any]]:
     url = f"{SUPABASE_URL}/rest/v1/{TABELA_CERTS}"
-    params: Dict[str, str] = {'select': 'id,pem,key,empresa,codi,user,vencimento,"cnpj/cpf"'}
-    params["user"] = f"eq.{user_filter}"
     r = requests.get(url, headers=supabase_headers(), params=params, timeout=30)
     r.raise_for_status()
     return r.json() or []
 
+def carregar_certificados_validos(user_filter: str) -> List[Dict[str, Any]]:
+    """
+    Só metadados vêm a cada chamada; pem/key são baixados apenas para ids
+    que o cert_store ainda não tem (ou cujo vencimento mudou).
+    """
+    rows = _supabase_certs({"select": _CAMPOS_CERT_META, "user": f"eq.{user_filter}"})
+    cert_store.sincronizar(rows)
+    return rows
+
+def _filtro_in(valores: List[str]) -> str:
+    """in.(...) do PostgREST com cada valor entre aspas (e-mail/nome com vírgula, ponto, parênteses)."""
+    return "in.(" + ",".join('"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"' for v in valores) + ")"
+
+def carregar_certificados_varios_users(users: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    carregar_certificados_validos de vários users numa query só
+    (user=in.(...), em lotes de CERT_STORE_LOTE_IDS users). Devolve
+    {user: linhas}, na ordem de users; user sem certificado vem com [].
+    """
+    users = list(dict.fromkeys(u for u in users if u))
+    por_user: Dict[str, List[Dict[str, Any]]] = {u: [] for u in users}
+    todas: List[Dict[str, Any]] = []
+    for i in range(0, len(users), CERT_STORE_LOTE_IDS):
+        lote = users[i:i + CERT_STORE_LOTE_IDS]
+        todas.extend(_supabase_certs({"select": _CAMPOS_CERT_META, "user": _filtro_in(lote)}))
+    cert_store.sincronizar(todas)
+    for row in todas:
+        if row.get("user") in por_user:
+            por_user[row["user"]].append(row)
+    return por_user
+
+def agrupar_certificados_compartilhados(
+    por_user: Dict[str, List[Dict[str, Any]]],
+) -> Tuple[List[Dict[str, Any]], Dict[str, List[Tuple[str, Dict[str, Any]]]]]:
+    """
+    Mesmo certificado (pem/key idênticos no cert_store, mesmo CNPJ/CPF)
+    cadastrado por mais de um user roda uma vez só. Devolve (linhas únicas,
+    {cert id da linha única: [(user, linha do user), ...]}).
+    """
+    unicos: List[Dict[str, Any]] = []
+    donos: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+    rep_por_hash: Dict[str, str] = {}
+    for user, rows in por_user.items():
+        for row in rows:
+            cid = _cert_id(row)
+            h = cert_store.hash_de(cid)
+            h = f"{h}|{row.get('cnpj/cpf') or ''}" if h else f"id:{cid}"
+            rep = rep_por_hash.setdefault(h, cid)
+            if rep == cid and cid not in donos:
+                unicos.append(row)
+            donos.setdefault(rep, []).append((user, row))
+    return unicos, donos
+
+# =========================================================
+# MÉTRICAS (/metrics) + TEMPO POR ETAPA
+# =========================================================
+_BUCKETS_ETAPA = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICA_ETAPA = Histogram(
+    "fisconforme_etapa_segundos", "Duração das etapas por empresa", ["fluxo", "etapa"], buckets=_BUCKETS_ETAPA
+)
+METRICA_CAPTCHA_TENTATIVAS = Counter("fisconforme_captcha_tentativas_total", "Captchas do DARE enviados ao solver")
+METRICA_CAPTCHA_FALHAS = Counter(
+    "fisconforme_captcha_falhas_total", "Captchas sem resposta do solver ou recusados pelo DARE", ["motivo"]
+)
+METRICA_HTTP = Counter("fisconforme_http_respostas_total", "Respostas HTTP da SEFIN por host e status", ["host", "status"])
+METRICA_PDFS = Counter("fisconforme_pdfs_total", "PDFs DARE entregues por origem (render | cache)", ["origem"])
+METRICA_RENDERS = Counter("fisconforme_renders_chromium_total", "page.pdf() executados no pool Chromium")
+METRICA_CACHE = Counter("fisconforme_cache_total", "Consultas aos caches (sessao | resultado | pdf)", ["cache", "resultado"])
+for _motivo in ("sem_resposta", "incorreto"):
+    METRICA_CAPTCHA_FALHAS.labels(_motivo)   # séries em 0 desde o start
+METRICA_HOST_TAXA = Gauge("fisconforme_host_taxa_req_s", "Taxa atual do limitador AIMD por host", ["host"])
+METRICA_HOST_CIRCUITO = Gauge("fisconforme_host_circuito_aberto", "1 = circuito aberto/meio aberto para o host", ["host"])
+METRICA_HTTP_RETRIES = Counter("fisconforme_http_retries_total", "Retries de GET por host", ["host"])
+METRICA_PDFS_DISCO = Counter("fisconforme_pdfs_em_disco_total", "PDFs que passaram do teto PDF_MEMORIA_MAX_MB e foram para disco")
+METRICA_PIPELINE_FILA = Gauge("fisconforme_pipeline_fila", "Itens esperando na fila de cada estágio do pipeline DARES", ["estagio"])
+METRICA_PIPELINE_OCUPADO = Counter(
+    "fisconforme_pipeline_ocupado_segundos_total", "Tempo de worker ocupado por estágio do pipeline DARES", ["estagio"]
+)
+
+def _metrica_resposta_http(r: requests.Response, *args, **kwargs):
+    # hook de resposta do requests: roda também em cada redirect
+    host = requests.compat.urlparse(r.url).hostname or ""
+    METRICA_HTTP.labels(host, str(r.status_code)).inc()
+
+def exportar_spans(fluxo: str, spans: List[Tuple[str, float]]):
+    for etapa, segundos in spans:
+        METRICA_ETAPA.labels(fluxo, etapa).observe(segundos)
+
+class Cronometro:
+    """
+    Spans de tempo das etapas de UMA empresa:
+
+        crono = Cronometro("dares")
+        with crono.etapa("captcha"):
+            ...
+
+    Os spans só vão para o histograma em exportar() (no modo process isso
+    acontece no processo pai, com os spans devolvidos pelo worker).
+    tempos_ms() soma por etapa, para o JSON da resposta.
+    """
+
+    def __init__(self, fluxo: str):
+        self.fluxo = fluxo
+        self.spans: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def registrar(self, etapa: str, segundos: float):
+        with self._lock:
+            self.spans.append((etapa, segundos))
+
+    @contextmanager
+    def etapa(self, nome: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nome, time.perf_counter() - t0)
+
+    def tempos_ms(self) -> Dict[str, float]:
+        return tempos_ms(self.spans)
+
+    def exportar(self):
+        exportar_spans(self.fluxo, self.spans)
+
+def tempos_ms(spans: List[Tuple[str, float]]) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for etapa, segundos in spans:
+        out[etapa] = out.get(etapa, 0.0) + segundos
+    return {k: round(v * 1000, 1) for k, v in out.items()}
+
+# =========================================================
+# LIMITE POR HOST (token bucket AIMD) + RETRY DE GET + CIRCUIT BREAKER
+# =========================================================
+class CircuitoAberto(RuntimeError):
+    """Host SEFIN marcado como fora do ar: falha na hora, sem ir à rede."""
+
+class ControleHost:
+    """
+    Estado compartilhado (threads e event loop) de um host SEFIN:
+
+    - token bucket com taxa AIMD: cada resposta boa soma ~LIMITE_HOST_AUMENTO
+      req/s por segundo de tráfego; erro (5xx/429/rede) ou latência acima do
+      alvo multiplica a taxa por LIMITE_HOST_FATOR_QUEDA (no máximo 1 corte
+      por LIMITE_HOST_INTERVALO_CORTE);
+    - circuit breaker: CIRCUITO_FALHAS falhas seguidas abrem o circuito por
+      CIRCUITO_ABERTO_S; depois passa uma requisição de sonda (meio aberto).
+
+    reservar() não bloqueia: devolve quanto esperar (a chamada sync dorme,
+    a async faz asyncio.sleep) e se a chamada é a sonda. Quem recebe a sonda
+    chama registrar() ou, se sair por qualquer outro caminho (cancelamento,
+    InvalidURL, KeyboardInterrupt...), liberar_sonda(); senão o circuito
+    fica meio aberto rejeitando tudo.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.taxa = LIMITE_HOST_TAXA_INICIAL
+        self.tokens = float(LIMITE_HOST_RAJADA)
+        self._t_tokens = time.monotonic()
+        self._ultimo_corte = 0.0
+        self.falhas_seguidas = 0
+        self.estado = "fechado"          # fechado | aberto | meio_aberto
+        self._aberto_ate = 0.0
+        self._sondando = False
+        self.respostas = 0
+        self.falhas = 0
+        self.retries = 0
+        self.rejeitadas = 0
+        self._lock = threading.Lock()
+        METRICA_HOST_TAXA.labels(host).set(self.taxa)
+        METRICA_HOST_CIRCUITO.labels(host).set(0)
+
+    # ---- circuito ----
+    def _permitir(self, agora: float) -> bool:
+        """True se esta chamada é a sonda do meio aberto."""
+        if self.estado == "fechado":
+            return False
+        if self.estado == "aberto" and agora >= self._aberto_ate:
+            self.estado = "meio_aberto"
+            self._sondando = False
+        if self.estado == "meio_aberto" and not self._sondando:
+            self._sondando = True
+            return True
+        self.rejeitadas += 1
+        falta = max(0.0, self._aberto_ate - agora)
+        raise CircuitoAberto(f"SEFIN fora do ar: circuito aberto para {self.host} (nova tentativa em {falta:.0f}s)")
+
+    def _abrir(self, agora: float):
+        self.estado = "aberto"
+        self._aberto_ate = agora + CIRCUITO_ABERTO_S
+        self._sondando = False
+        METRICA_HOST_CIRCUITO.labels(self.host).set(1)
+        print(f"[CIRCUITO] {self.host} aberto por {CIRCUITO_ABERTO_S}s após {self.falhas_seguidas} falhas seguidas")
+
+    # ---- API ----
+    def reservar(self) -> Tuple[float, bool]:
+        """Pega um token (pode ficar devendo); devolve (segundos a esperar antes de enviar, é sonda)."""
+        with self._lock:
+            agora = time.monotonic()
+            sonda = self._permitir(agora)
+            self.tokens = min(float(LIMITE_HOST_RAJADA), self.tokens + (agora - self._t_tokens) * self.taxa)
+            self._t_tokens = agora
+            self.tokens -= 1.0
+            return (0.0 if self.tokens >= 0 else -self.tokens / self.taxa), sonda
+
+    def liberar_sonda(self):
+        """A sonda saiu sem resposta nem falha de rede: a próxima requisição vira a sonda."""
+        with self._lock:
+            if self.estado == "meio_aberto":
+                self._sondando = False
+
+    def registrar(self, falha: bool, latencia: float):
+        with self._lock:
+            agora = time.monotonic()
+            self.respostas += 1
+            sobrecarga = falha or latencia > LIMITE_HOST_LATENCIA_ALVO
+            if sobrecarga:
+                if agora - self._ultimo_corte >= LIMITE_HOST_INTERVALO_CORTE:
+                    self.taxa = max(LIMITE_HOST_TAXA_MIN, self.taxa * LIMITE_HOST_FATOR_QUEDA)
+                    self._ultimo_corte = agora
+            else:
+                self.taxa = min(LIMITE_HOST_TAXA_MAX, self.taxa + LIMITE_HOST_AUMENTO / max(self.taxa, 1.0))
+            METRICA_HOST_TAXA.labels(self.host).set(self.taxa)
+
+            if falha:
+                self.falhas += 1
+                self.falhas_seguidas += 1
+                if self.estado == "meio_aberto" or (
+                    self.estado == "fechado" and self.falhas_seguidas >= CIRCUITO_FALHAS
+                ):
+                    self._abrir(agora)
+            else:
+                self.falhas_seguidas = 0
+                if self.estado != "fechado":
+                    print(f"[CIRCUITO] {self.host} fechado")
+                self.estado = "fechado"
+                self._sondando = False
+                METRICA_HOST_CIRCUITO.labels(self.host).set(0)
+
+    def contar_retry(self):
+        with self._lock:
+            self.retries += 1
+        METRICA_HTTP_RETRIES.labels(self.host).inc()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "taxa_req_s": round(self.taxa, 2),
+                "circuito": self.estado,
+                "falhas_seguidas": self.falhas_seguidas,
+                "respostas": self.respostas,
+                "falhas": self.falhas,
+                "retries": self.retries,
+                "rejeitadas": self.rejeitadas,
+            }
+
+class ControleHosts:
+    def __init__(self):
+        self._hosts: Dict[str, ControleHost] = {}
+        self._lock = threading.Lock()
+
+    def de(self, url: str) -> ControleHost:
+        host = requests.compat.urlparse(url).hostname or ""
+        with self._lock:
+            ctl = self._hosts.get(host)
+            if ctl is None:
+                ctl = self._hosts[host] = ControleHost(host)
+            return ctl
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            hosts = list(self._hosts.values())
+        return {c.host: c.status() for c in hosts}
+
+    def limpar(self):
+        with self._lock:
+            self._hosts.clear()
+
+controle_hosts = ControleHosts()
+
+_STATUS_TRANSITORIO = {429, 500, 502, 503, 504}
+
+def _espera_retry(tentativa: int, retry_after: Optional[str] = None) -> float:
+    """Backoff exponencial com jitter cheio; Retry-After (em s) do servidor tem prioridade."""
+    if retry_after and retry_after.strip().isdigit():
+        return min(float(retry_after), RETRY_GET_MAX)
+    return random.uniform(0, min(RETRY_GET_MAX, RETRY_GET_BASE * (2 ** tentativa)))
+
+class AdaptadorSefin(requests.adapters.HTTPAdapter):
+    """HTTPAdapter com limite por host, retry de GET/HEAD e circuit breaker (controle_hosts)."""
+
+    def send(self, request, **kwargs):
+        if not LIMITE_HOST_ATIVO:
+            return super().send(request, **kwargs)
+        ctl = controle_hosts.de(request.url)
+        idempotente = request.method in ("GET", "HEAD")
+        tentativa = 0
+        while True:
+            espera, sonda = ctl.reservar()
+            try:
+                if espera:
+                    time.sleep(espera)
+                t0 = time.perf_counter()
+                resp = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                ctl.registrar(True, time.perf_counter() - t0)
+                if not idempotente or tentativa >= RETRY_GET_TENTATIVAS:
+                    raise
+                ctl.contar_retry()
+                time.sleep(_espera_retry(tentativa))
+                tentativa += 1
+                continue
+            except BaseException:
+                if sonda:
+                    ctl.liberar_sonda()
+                raise
+
+            transitorio = resp.status_code in _STATUS_TRANSITORIO
+            ctl.registrar(transitorio, time.perf_counter() - t0)
+            if not transitorio or not idempotente or tentativa >= RETRY_GET_TENTATIVAS:
+                return resp
+            ctl.contar_retry()
+            espera = _espera_retry(tentativa, resp.headers.get("Retry-After"))
+            resp.close()
+            time.sleep(espera)
+            tentativa += 1
+
+class TransporteSefinAsync(httpx.AsyncBaseTransport):
+    """Par async do AdaptadorSefin, em volta do transporte httpx do certificado."""
+
+    def __init__(self, interno: httpx.AsyncBaseTransport):
+        self.interno = interno
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not LIMITE_HOST_ATIVO:
+            return await self.interno.handle_async_request(request)
+        ctl = controle_hosts.de(str(request.url))
+        idempotente = request.method in ("GET", "HEAD")
+        tentativa = 0
+        while True:
+            espera, sonda = ctl.reservar()
+            try:
+                if espera:
+                    await asyncio.sleep(espera)
+                t0 = time.perf_counter()
+                resp = await self.interno.handle_async_request(request)
+            except (httpx.TransportError,):
+                ctl.registrar(True, time.perf_counter() - t0)
+                if not idempotente or tentativa >= RETRY_GET_TENTATIVAS:
+                    raise
+                ctl.contar_retry()
+                await asyncio.sleep(_espera_retry(tentativa))
+                tentativa += 1
+                continue
+            except BaseException:
+                # CancelledError no sleep ou no request, etc.: não prende a sonda
+                if sonda:
+                    ctl.liberar_sonda()
+                raise
+
+            transitorio = resp.status_code in _STATUS_TRANSITORIO
+            ctl.registrar(transitorio, time.perf_counter() - t0)
+            if not transitorio or not idempotente or tentativa >= RETRY_GET_TENTATIVAS:
+                return resp
+            ctl.contar_retry()
+            espera = _espera_retry(tentativa, resp.headers.get("Retry-After"))
+            await resp.aclose()
+            await asyncio.sleep(espera)
+            tentativa += 1
+
+    async def aclose(self):
+        await self.interno.aclose()
+
 # =========================================================
-# CERT TEMP + SESSION
+# CERT STORE + SESSION
 # =========================================================
-def criar_arquivos_cert_temp(cert_row: Dict[str, Any]) -> Tuple[str, str]:
-    pem_bytes = base64.b64decode(cert_row.get("pem") or "")
-    key_bytes = base64.b64decode(cert_row.get("key") or "")
+def _hash_material(pem_b64: str, key_b64: str) -> str:
+    return hashlib.sha256(((pem_b64 or "") + "\n" + (key_b64 or "")).encode()).hexdigest()
+
+_DIR_TMPFS = "/dev/shm"
+
+class MaterialCertificado:
+    """
+    pem/key decodificados, expostos como caminho para o requests/OpenSSL.
+    Preferência: memfd (/proc/self/fd/N, nunca toca disco) > tmpfs
+    (/dev/shm) > tempdir. Na limpeza o conteúdo é zerado antes de soltar.
+    """
+
+    def __init__(self, cert_id: str, pem_b64: str, key_b64: str, vencimento: Any = None):
+        self.cert_id = cert_id
+        self.hash = _hash_material(pem_b64, key_b64)
+        self.vencimento = vencimento
+        self.baixado_em = time.time()
+        self._fds: List[int] = []
+        self._arquivos: List[str] = []
+        pem_bytes = base64.b64decode(pem_b64 or "")
+        key_bytes = base64.b64decode(key_b64 or "")
+        self.cert_path = self._materializar(pem_bytes, ".pem")
+        self.key_path = self._materializar(key_bytes, ".key")
+
+    def _materializar(self, dados: bytes, sufixo: str) -> str:
+        if hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd"):
+            try:
+                fd = os.memfd_create(f"cert-{_slug(self.cert_id)}{sufixo}", os.MFD_CLOEXEC)
+                os.write(fd, dados)
+                self._fds.append(fd)
+                return f"/proc/self/fd/{fd}"
+            except OSError:
+                pass
+        pasta = _DIR_TMPFS if os.path.isdir(_DIR_TMPFS) and os.access(_DIR_TMPFS, os.W_OK) else None
+        fd, path = tempfile.mkstemp(suffix=sufixo, dir=pasta)   # 0600
+        try:
+            os.write(fd, dados)
+        finally:
+            os.close(fd)
+        self._arquivos.append(path)
+        return path
+
+    def fechar(self):
+        for fd in self._fds:
+            try:
+                os.ftruncate(fd, 0)
+                os.close(fd)
+            except OSError:
+                pass
+        for path in self._arquivos:
+            try:
+                tam = os.path.getsize(path)
+                with open(path, "r+b") as f:
+                    f.write(b"\0" * tam)
+                os.remove(path)
+            except OSError:
+                pass
+        self._fds = []
+        self._arquivos = []
+
+class CertStore:
+    """
+    Material de certificado por cert id, decodificado uma vez e mantido em
+    memória. sincronizar() recebe as linhas de metadados do Supabase e só
+    baixa pem/key dos ids novos, com vencimento alterado ou com blob velho
+    (CERT_STORE_TTL_BLOB). Material substituído fica vivo por
+    CERT_STORE_RETENCAO_ANTIGO para não quebrar sessões em uso.
+    """
 
-    cert_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
-    key_file = tempfile.NamedTemporaryFile(delete=False, suffix=".key")
-    cert_file.write(pem_bytes); cert_file.close()
-    key_file.write(key_bytes); key_file.close()
-    return cert_file.name, key_file.name
+    def __init__(self):
+        self._materiais: Dict[str, MaterialCertificado] = {}
+        self._aposentados: List[Tuple[float, MaterialCertificado]] = []
+        self._lock = threading.Lock()
+
+    def _precisa_baixar(self, row: Dict[str, Any]) -> bool:
+        mat = self._materiais.get(_cert_id(row))
+        if mat is None:
+            return True
+        if str(mat.vencimento) != str(row.get("vencimento")):
+            return True
+        return time.time() - mat.baixado_em > CERT_STORE_TTL_BLOB
+
+    def _registrar(self, cert_id: str, pem_b64: str, key_b64: str, vencimento: Any) -> MaterialCertificado:
+        novo_hash = _hash_material(pem_b64, key_b64)
+        with self._lock:
+            atual = self._materiais.get(cert_id)
+            if atual is not None and atual.hash == novo_hash:
+                atual.vencimento = vencimento
+                atual.baixado_em = time.time()
+                return atual
+        mat = MaterialCertificado(cert_id, pem_b64, key_b64, vencimento)
+        with self._lock:
+            atual = self._materiais.get(cert_id)
+            self._materiais[cert_id] = mat
+            if atual is not None:
+                self._aposentados.append((time.time(), atual))
+        if atual is not None:
+            # certificado trocou: sessões logadas com o antigo não servem mais
+            cache_sessoes.invalidar({"id": cert_id})
+            cache_sessoes_async.invalidar({"id": cert_id})
+        self._limpar_aposentados()
+        return mat
+
+    def _limpar_aposentados(self):
+        limite = time.time() - CERT_STORE_RETENCAO_ANTIGO
+        with self._lock:
+            velhos = [m for ts, m in self._aposentados if ts < limite]
+            self._aposentados = [(ts, m) for ts, m in self._aposentados if ts >= limite]
+        for m in velhos:
+            m.fechar()
+
+    def _baixar(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        out: Dict[str, Dict[str, Any]] = {}
+        for i in range(0, len(ids), CERT_STORE_LOTE_IDS):
+            lote = ids[i:i + CERT_STORE_LOTE_IDS]
+            rows = _supabase_certs({"select": "id,pem,key,vencimento", "id": f"in.({','.join(lote)})"})
+            for row in rows:
+                out[_cert_id(row)] = row
+        return out
+
+    def hash_de(self, cert_id: str) -> Optional[str]:
+        mat = self._materiais.get(cert_id)
+        return mat.hash if mat is not None else None
+
+    def sincronizar(self, rows: List[Dict[str, Any]]):
+        faltando = []
+        for row in rows:
+            cid = _cert_id(row)
+            if not cid:
+                continue
+            if row.get("pem") and row.get("key"):
+                self._registrar(cid, row["pem"], row["key"], row.get("vencimento"))
+            elif self._precisa_baixar(row):
+                faltando.append(cid)
+        if faltando:
+            for cid, blob in self._baixar(faltando).items():
+                self._registrar(cid, blob.get("pem") or "", blob.get("key") or "", blob.get("vencimento"))
+
+    def material(self, cert_row: Dict[str, Any]) -> MaterialCertificado:
+        cid = _cert_id(cert_row)
+        if cert_row.get("pem") and cert_row.get("key"):
+            if not cid:
+                return MaterialCertificado("", cert_row["pem"], cert_row["key"], cert_row.get("vencimento"))
+            mat = self._materiais.get(cid)
+            if mat is not None and mat.hash == _hash_material(cert_row["pem"], cert_row["key"]):
+                return mat
+            return self._registrar(cid, cert_row["pem"], cert_row["key"], cert_row.get("vencimento"))
+        mat = self._materiais.get(cid)
+        if mat is None and cid:
+            # ex.: worker de processo (spawn) que não passou pelo sincronizar()
+            self.sincronizar([{"id": cid, "vencimento": cert_row.get("vencimento")}])
+            mat = self._materiais.get(cid)
+        if mat is None:
+            raise RuntimeError("Certificado sem pem/key disponível")
+        return mat
+
+    def hash(self, cert_row: Dict[str, Any]) -> Optional[str]:
+        mat = self._materiais.get(_cert_id(cert_row))
+        return mat.hash if mat else None
+
+    def limpar(self):
+        with self._lock:
+            todos = list(self._materiais.values()) + [m for _, m in self._aposentados]
+            self._materiais = {}
+            self._aposentados = []
+        for m in todos:
+            m.fechar()
+
+cert_store = CertStore()
+
+_HEADERS_SEFIN = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/120.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+}
 
 def criar_sessao(cert_path: str, key_path: str) -> requests.Session:
     s = requests.Session()
     s.cert = (cert_path, key_path)
-    s.headers.update({
-        "User-Agent": (
-            "Mozilla/5.0 (X11; Linux x86_64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/120.0.0.0 Safari/537.36"
-        ),
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-    })
+    s.hooks["response"].append(_metrica_resposta_http)
+    adaptador = AdaptadorSefin()
+    s.mount("https://", adaptador)
+    s.mount("http://", adaptador)
+    s.headers.update(_HEADERS_SEFIN)
     return s
 
 # =========================================================
@@ -114,7 +848,7 @@ def abrir_acesso_digital_e_entrar(sess: requests.Session) -> bool:
     if r.status_code != 200:
         return False
 
-    soup = BeautifulSoup(r.text, "lxml")
+    soup = _soup(r.text, _SO_FORMS)
     form = soup.find("form")
     if not form:
         return False
@@ -130,7 +864,7 @@ def abrir_acesso_digital_e_entrar(sess: requests.Session) -> bool:
     return True
 
 def extrair_form_logintoken(html: str) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
-    soup = BeautifulSoup(html, "lxml")
+    soup = _soup(html, _SO_FORMS)
     for form in soup.find_all("form"):
         action = form.get("action") or ""
         if "portalcontribuinte.sefin.ro.gov.br" in action or "LoginToken" in action:
@@ -176,11 +910,216 @@ def ir_para_portal_e_carregar_home(sess: requests.Session) -> Optional[str]:
 
     return None
 
+# =========================================================
+# SESSÃO AUTENTICADA + CACHE (pula DET/LoginToken em chamadas repetidas)
+# =========================================================
+def _cert_id(cert_row: Dict[str, Any]) -> str:
+    return str(cert_row.get("id") or "").strip()
+
+class SessaoAutenticada:
+    """Sessão requests já logada no portal + material de cert (cert_store) que ela usa."""
+
+    def __init__(self, cert_id: str):
+        self.cert_id = cert_id
+        self.sess: Optional[requests.Session] = None
+        self.cert_path: Optional[str] = None
+        self.key_path: Optional[str] = None
+        self.material: Optional[MaterialCertificado] = None
+        self.html_portal: Optional[str] = None
+        self.criado_em = time.time()
+        self.usado_em = self.criado_em
+        self.valida = False
+        self.lock = threading.Lock()
+
+    def login(self, cert_row: Dict[str, Any]):
+        mat = cert_store.material(cert_row)
+        self.material = mat
+        self.cert_path, self.key_path = mat.cert_path, mat.key_path
+        self.sess = criar_sessao(self.cert_path, self.key_path)
+
+        if not abrir_acesso_digital_e_entrar(self.sess):
+            raise RuntimeError("Falha ao entrar no Acesso Digital (DET)")
+
+        self.html_portal = ir_para_portal_e_carregar_home(self.sess)
+        if not self.html_portal:
+            raise RuntimeError("Falha ao abrir Portal (LoginToken/home)")
+
+        self.criado_em = self.usado_em = time.time()
+        self.valida = True
+
+    def revalidar(self) -> bool:
+        """Confere se o portal ainda reconhece a sessão (sem cair no LoginToken/DET)."""
+        try:
+            r = self.sess.get(URL_PORTAL_HOME_DEFAULT, timeout=30, allow_redirects=True)
+        except Exception:
+            return False
+        if r.status_code != 200 or "LoginToken" in r.url or "portalcontribuinte.sefin.ro.gov.br" not in r.url:
+            return False
+        self.html_portal = r.text
+        return True
+
+    def tamanho_aprox(self) -> int:
+        n = len(self.html_portal or "") + 4096
+        if self.sess is not None:
+            for c in self.sess.cookies:
+                n += len(c.name or "") + len(c.value or "")
+        return n
+
+    def fechar(self):
+        self.valida = False
+        try:
+            if self.sess is not None:
+                self.sess.close()
+        except Exception:
+            pass
+        # material com id pertence ao cert_store; sem id foi criado só para esta sessão
+        if self.material is not None and not self.material.cert_id:
+            self.material.fechar()
+
+class CacheSessoes:
+    """
+    LRU de SessaoAutenticada por cert id, com TTL, revalidação após ociosidade,
+    re-login automático e teto de entradas/memória. Uso:
+
+        with cache_sessoes.sessao(cert_row) as (sess, html_portal):
+            ...
+
+    A sessão fica exclusiva de quem está dentro do with.
+    """
+
+    def __init__(
+        self,
+        ttl: float = SESSAO_CACHE_TTL,
+        revalidar_apos: float = SESSAO_CACHE_REVALIDAR_APOS,
+        max_entradas: int = SESSAO_CACHE_MAX_ENTRADAS,
+        max_bytes: int = SESSAO_CACHE_MAX_MB * 1024 * 1024,
+        ativo: bool = SESSAO_CACHE_ATIVO,
+    ):
+        self.ttl = ttl
+        self.revalidar_apos = revalidar_apos
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.ativo = ativo
+        self._entradas: "OrderedDict[str, SessaoAutenticada]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remover(self, ent: SessaoAutenticada):
+        with self._lock:
+            if self._entradas.get(ent.cert_id) is ent:
+                del self._entradas[ent.cert_id]
+        ent.fechar()
+
+    def _evictar(self):
+        # chamado com self._lock; só fecha entradas que ninguém está usando
+        total = sum(e.tamanho_aprox() for e in self._entradas.values())
+        for chave in list(self._entradas.keys()):
+            if len(self._entradas) <= self.max_entradas and total <= self.max_bytes:
+                break
+            ent = self._entradas[chave]
+            if not ent.lock.acquire(blocking=False):
+                continue
+            try:
+                del self._entradas[chave]
+                total -= ent.tamanho_aprox()
+                ent.fechar()
+            finally:
+                ent.lock.release()
+
+    def _obter(self, cert_row: Dict[str, Any]) -> SessaoAutenticada:
+        chave = _cert_id(cert_row)
+        while True:
+            with self._lock:
+                ent = self._entradas.get(chave)
+                nova = ent is None
+                if nova:
+                    ent = SessaoAutenticada(chave)
+                    ent.lock.acquire()
+                    self._entradas[chave] = ent
+                else:
+                    self._entradas.move_to_end(chave)
+
+            if nova:
+                try:
+                    ent.login(cert_row)
+                except Exception:
+                    ent.lock.release()
+                    self._remover(ent)
+                    raise
+                self.misses += 1
+                METRICA_CACHE.labels("sessao", "miss").inc()
+                with self._lock:
+                    self._evictar()
+                return ent
+
+            ent.lock.acquire()
+            agora = time.time()
+            ok = ent.valida and (agora - ent.criado_em) < self.ttl
+            if ok and (agora - ent.usado_em) > self.revalidar_apos:
+                ok = ent.revalidar()
+            if ok:
+                self.hits += 1
+                METRICA_CACHE.labels("sessao", "hit").inc()
+                return ent
+
+            # expirada / derrubada pelo portal: descarta e tenta de novo (re-login)
+            ent.lock.release()
+            self._remover(ent)
+
+    @contextmanager
+    def sessao(self, cert_row: Dict[str, Any]):
+        if not self.ativo or not _cert_id(cert_row):
+            ent = SessaoAutenticada(_cert_id(cert_row))
+            try:
+                ent.login(cert_row)
+                yield ent.sess, ent.html_portal
+            finally:
+                ent.fechar()
+            return
+
+        ent = self._obter(cert_row)
+        try:
+            yield ent.sess, ent.html_portal
+        except Exception:
+            # erro no meio do fluxo: não reaproveita esta sessão
+            ent.valida = False
+            raise
+        finally:
+            ent.usado_em = time.time()
+            ent.lock.release()
+            with self._lock:
+                self._evictar()
+
+    def invalidar(self, cert_row: Dict[str, Any]):
+        with self._lock:
+            ent = self._entradas.get(_cert_id(cert_row))
+        if ent is not None:
+            ent.valida = False
+
+    def limpar(self):
+        with self._lock:
+            entradas = list(self._entradas.values())
+            self._entradas.clear()
+        for ent in entradas:
+            ent.fechar()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "bytes_aprox": sum(e.tamanho_aprox() for e in self._entradas.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+cache_sessoes = CacheSessoes()
+
 # =========================================================
 # FISCONFORME (opcional para o /fisconforme)
 # =========================================================
 def encontrar_form_fisconforme(html_portal: str) -> Optional[Tuple[str, str]]:
-    soup = BeautifulSoup(html_portal, "lxml")
+    soup = _soup(html_portal, _SO_FORMS)
     for f in soup.find_all("form"):
         action = f.get("action") or ""
         if "fisconforme" in action.lower():
@@ -200,30 +1139,29 @@ def acessar_fisconforme(sess: requests.Session, action_url: str, token: str) ->
     return r.text
 
 def obter_pendencias_fisconforme(html_fis: str) -> List[Dict[str, str]]:
-    soup = BeautifulSoup(html_fis, "lxml")
-    tables = soup.find_all("table")
-    if not tables:
+    doc = _arvore_lxml(html_fis)
+    if doc is None:
         return []
 
     tabela_alvo = None
-    for t in tables:
-        thead = t.find("thead")
-        if not thead:
+    for t in doc.iter("table"):
+        thead = next(t.iter("thead"), None)
+        if thead is None:
             continue
-        header_text = " ".join(thead.stripped_strings).upper()
+        header_text = _texto_lxml(thead).upper()
         if "CÓDIGO" in header_text and "DESCRIÇÃO DA PENDÊNCIA" in header_text:
             tabela_alvo = t
             break
-    if not tabela_alvo:
+    if tabela_alvo is None:
         return []
 
-    tbody = tabela_alvo.find("tbody")
-    if not tbody:
+    tbody = next(tabela_alvo.iter("tbody"), None)
+    if tbody is None:
         return []
 
     pendencias: List[Dict[str, str]] = []
-    for tr in tbody.find_all("tr"):
-        cols = [td.get_text(" ", strip=True) for td in tr.find_all("td")]
+    for tr in tbody.iter("tr"):
+        cols = [_texto_lxml(td) for td in tr.iter("td")]
         if len(cols) < 5:
             continue
         codigo, ie, nome, periodo, descricao = cols[:5]
@@ -248,63 +1186,67 @@ def parse_data_br(s: str) -> Optional[date]:
     except Exception:
         return None
 
+def _norm_url_debito(href: Optional[str]) -> str:
+    if not href:
+        return ""
+    href = href.replace("%22", "").strip('"')
+    if href.startswith("http"):
+        return href
+    return requests.compat.urljoin(URL_CONSULTA_DEBITOS_LISTA, href)
+
+def _primeiro_link(tr, regex) -> str:
+    for a in tr.iter("a"):
+        href = a.get("href")
+        if href is not None and regex.search(href):
+            return href
+    return ""
+
 def obter_debitos_inscricao_estadual(html_deb: str) -> List[Dict[str, str]]:
-    soup = BeautifulSoup(html_deb, "lxml")
+    doc = _arvore_lxml(html_deb)
+    if doc is None:
+        return []
+
     tabela_alvo = None
-    for tab in soup.find_all("table"):
-        ths = tab.find_all("th")
-        if not ths:
+    for tab in doc.iter("table"):
+        th0 = next(tab.iter("th"), None)
+        if th0 is None:
             continue
-        if "DÉBITOS NA INSCRIÇÃO ESTADUAL" in ths[0].get_text(" ", strip=True).upper():
+        if "DÉBITOS NA INSCRIÇÃO ESTADUAL" in _texto_lxml(th0).upper():
             tabela_alvo = tab
             break
-    if not tabela_alvo:
+    if tabela_alvo is None:
         return []
 
-    linhas = tabela_alvo.find_all("tr")
+    linhas = list(tabela_alvo.iter("tr"))
     if len(linhas) <= 2:
         return []
 
     debitos: List[Dict[str, str]] = []
     for tr in linhas[2:]:
-        tds = tr.find_all("td")
+        tds = list(tr.iter("td"))
         if len(tds) < 11:
             continue
 
-        def txt(i: int) -> str:
-            return tds[i].get_text(" ", strip=True) if i < len(tds) else ""
-
-        link_dare = tr.find("a", href=re.compile(r"dare\.sefin\.ro\.gov\.br/adm"))
-        link_extrato = tr.find("a", href=re.compile(r"extrato\.jsp"))
-
-        def norm_url(href: Optional[str]) -> str:
-            if not href:
-                return ""
-            href = href.replace("%22", "").strip('"')
-            if href.startswith("http"):
-                return href
-            return requests.compat.urljoin(URL_CONSULTA_DEBITOS_LISTA, href)
-
+        txt = [_texto_lxml(td) for td in tds[:11]]
         debitos.append({
-            "dare": txt(0),
-            "extrato": txt(1),
-            "nr_lancamento": txt(2),
-            "parcela": txt(3),
-            "referencia": txt(4),
-            "complemento": txt(5),
-            "receita": txt(6),
-            "situacao": txt(7),
-            "data_vencimento": txt(8),
-            "valor_lancamento": txt(9),
-            "valor_atualizado": txt(10),
-            "url_dare": norm_url(link_dare.get("href") if link_dare else ""),
-            "url_extrato": norm_url(link_extrato.get("href") if link_extrato else ""),
+            "dare": txt[0],
+            "extrato": txt[1],
+            "nr_lancamento": txt[2],
+            "parcela": txt[3],
+            "referencia": txt[4],
+            "complemento": txt[5],
+            "receita": txt[6],
+            "situacao": txt[7],
+            "data_vencimento": txt[8],
+            "valor_lancamento": txt[9],
+            "valor_atualizado": txt[10],
+            "url_dare": _norm_url_debito(_primeiro_link(tr, _RE_LINK_DARE)),
+            "url_extrato": _norm_url_debito(_primeiro_link(tr, _RE_LINK_EXTRATO)),
         })
 
     return debitos
 
-def _listar_inscricoes_estaduais(html: str) -> List[str]:
-    soup = BeautifulSoup(html, "lxml")
+def _listar_inscricoes_estaduais_soup(soup: "BeautifulSoup") -> List[str]:
     sel_ie = soup.find("select", {"name": "inscricaoEstadual"})
     if not sel_ie:
         return []
@@ -321,111 +1263,424 @@ def _listar_inscricoes_estaduais(html: str) -> List[str]:
         out.append(v)
     return out
 
-def consultar_debitos_ano(sess: requests.Session, ano: int) -> Tuple[List[Dict[str, str]], Optional[str]]:
-    r = sess.get(URL_CONSULTA_DEBITOS, timeout=30, allow_redirects=True)
-    if r.status_code != 200:
-        return [], f"Erro HTTP {r.status_code} ao abrir Consulta de Débitos"
+def _listar_inscricoes_estaduais(html: str) -> List[str]:
+    return _listar_inscricoes_estaduais_soup(_soup(html, _SO_SELECT_IE))
 
-    soup = BeautifulSoup(r.text, "lxml")
+def _ler_form_debitos(html: str) -> Tuple[str, List[str]]:
+    """(tipoDevedor, inscrições estaduais) do form da Consulta de Débitos."""
+    soup = _soup(html, _SO_FORM_DEBITOS)
     input_tipo = soup.find("input", {"name": "tipoDevedor"})
     tipo_devedor = input_tipo.get("value", "1") if input_tipo else "1"
+    return tipo_devedor, _listar_inscricoes_estaduais_soup(soup)
 
-    inscricoes = _listar_inscricoes_estaduais(r.text)
-    if not inscricoes:
-        return [], "Nenhuma inscrição estadual disponível (select vazio)"
-
-    last_err = None
-    for ie_val in inscricoes:
-        payload = {
-            "inscricaoEstadual": ie_val,
-            "ano": str(ano),
-            "tipoDevedor": tipo_devedor,
-            "Submit": "Consultar Débitos",
-        }
-        r2 = sess.post(URL_CONSULTA_DEBITOS_LISTA, data=payload, timeout=30, allow_redirects=True)
+def _payload_debitos(ie_val: str, ano: int, tipo_devedor: Optional[str]) -> Dict[str, str]:
+    return {
+        "inscricaoEstadual": ie_val,
+        "ano": str(ano),
+        "tipoDevedor": tipo_devedor or "1",
+        "Submit": "Consultar Débitos",
+    }
+
+def _debitos_da_lista(html: str, ie_val: str, ano: int) -> List[Dict[str, str]]:
+    debs = obter_debitos_inscricao_estadual(html)
+    for d in debs:
+        d["ie"] = ie_val
+        d["ano"] = str(ano)
+    return debs
+
+def _juntar_debitos(
+    resultados: List[Tuple[List[Dict[str, str]], Optional[str]]],
+) -> Tuple[Optional[List[Dict[str, str]]], List[str]]:
+    """Junta os (débitos, erro) de cada IE × ano sem duplicados; None se todas falharam."""
+    debitos: List[Dict[str, str]] = []
+    erros: List[str] = []
+    vistos = set()
+    for debs, e in resultados:
+        if e:
+            erros.append(e)
+        for d in debs:
+            chave = (d.get("ie"), d.get("nr_lancamento"), d.get("parcela"), d.get("referencia"), d.get("receita"))
+            if chave in vistos:
+                continue
+            vistos.add(chave)
+            debitos.append(d)
+
+    if len(erros) == len(resultados):
+        return None, erros
+    return debitos, erros
+
+class ConsultaDebitos:
+    """
+    Consulta de débitos de uma sessão: o form (tipoDevedor + lista de IEs) é
+    lido uma vez; cada IE × ano vira um POST, um por vez por padrão (a
+    lista.jsp lê IE/ano da sessão; ver DEBITOS_MAX_PARALELO). O resultado
+    junta tudo, sem duplicados, com "ie" e "ano" em cada débito.
+    """
+
+    def __init__(self, sess: requests.Session):
+        self.sess = sess
+        self.tipo_devedor: Optional[str] = None
+        self.inscricoes: Optional[List[str]] = None
+        self._lock = threading.Lock()
+
+    def carregar_form(self) -> Optional[str]:
+        with self._lock:
+            if self.inscricoes:
+                return None
+            r = self.sess.get(URL_CONSULTA_DEBITOS, timeout=30, allow_redirects=True)
+            if r.status_code != 200:
+                return f"Erro HTTP {r.status_code} ao abrir Consulta de Débitos"
+
+            self.tipo_devedor, inscricoes = _ler_form_debitos(r.text)
+            if not inscricoes:
+                return "Nenhuma inscrição estadual disponível (select vazio)"
+            self.inscricoes = inscricoes
+            return None
+
+    def consultar_ie_ano(self, ie_val: str, ano: int) -> Tuple[List[Dict[str, str]], Optional[str]]:
+        payload = _payload_debitos(ie_val, ano, self.tipo_devedor)
+        r2 = self.sess.post(URL_CONSULTA_DEBITOS_LISTA, data=payload, timeout=30, allow_redirects=True)
         if r2.status_code != 200:
-            last_err = f"Erro HTTP {r2.status_code} lista (ano {ano}) IE={ie_val}"
-            continue
+            return [], f"Erro HTTP {r2.status_code} lista (ano {ano}) IE={ie_val}"
+        return _debitos_da_lista(r2.text, ie_val, ano), None
+
+    def consultar(self, anos: List[int]) -> Tuple[Optional[List[Dict[str, str]]], List[str]]:
+        """
+        (débitos de todas as IEs/anos, erros das combinações que falharam).
+        Débitos = None quando nenhuma combinação respondeu.
+        """
+        err = self.carregar_form()
+        if err:
+            return None, [err]
+
+        combos = [(ie, ano) for ano in anos for ie in self.inscricoes]
+
+        def _um(c: Tuple[str, int]):
+            try:
+                return self.consultar_ie_ano(*c)
+            except Exception as e:
+                return [], f"{e} (ano {c[1]}) IE={c[0]}"
 
-        debs = obter_debitos_inscricao_estadual(r2.text)
-        return debs, None
+        n = max(1, min(DEBITOS_MAX_PARALELO, len(combos)))
+        if n == 1:
+            resultados = [_um(c) for c in combos]
+        else:
+            with ThreadPoolExecutor(max_workers=n, thread_name_prefix="debitos") as ex:
+                resultados = list(ex.map(_um, combos))
+
+        return _juntar_debitos(resultados)
+
+_consultas_por_sessao: "weakref.WeakKeyDictionary[requests.Session, ConsultaDebitos]" = weakref.WeakKeyDictionary()
+_consultas_lock = threading.Lock()
+
+def consulta_debitos_da_sessao(sess: requests.Session) -> ConsultaDebitos:
+    with _consultas_lock:
+        c = _consultas_por_sessao.get(sess)
+        if c is None:
+            c = ConsultaDebitos(sess)
+            _consultas_por_sessao[sess] = c
+        return c
 
-    return [], last_err or f"Falha ao consultar lista (ano {ano})"
+def anos_consulta_debitos(anos_atras: int = DEBITOS_ANOS_ATRAS) -> List[int]:
+    ano_atual = date.today().year
+    return list(range(ano_atual, ano_atual - max(0, anos_atras) - 1, -1))
+
+def consultar_debitos_anos(sess: requests.Session, anos: List[int]) -> Tuple[Optional[List[Dict[str, str]]], List[str]]:
+    return consulta_debitos_da_sessao(sess).consultar(anos)
+
+def consultar_debitos_ano(sess: requests.Session, ano: int) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    debs, erros = consultar_debitos_anos(sess, [ano])
+    if debs is None:
+        return [], erros[-1] if erros else f"Falha ao consultar lista (ano {ano})"
+    return debs, None
 
 # =========================================================
 # CAPTCHA DARE
 # =========================================================
-def resolver_captcha_automatico(img_bytes: bytes) -> Optional[str]:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-        tmp_file.write(img_bytes)
-        img_path = tmp_file.name
-    try:
+class BackendCaptchaAntiCaptcha:
+    """createTask / getTaskResult do anti-captcha, sem o wait_for_result bloqueante."""
+
+    nome = "anticaptcha"
+
+    def __init__(self, chave: str = ANTICAPTCHA_KEY):
+        self.chave = chave
+
+    def _cliente(self):
+        from anticaptchaofficial.imagecaptcha import imagecaptcha
+
         solver = imagecaptcha()
-        solver.set_key(ANTICAPTCHA_KEY)
-        resp = solver.solve_and_return_solution(img_path)
-        if resp != 0:
-            return str(resp)
+        solver.set_key(self.chave)
+        return solver
+
+    def enviar(self, img_bytes: bytes) -> str:
+        solver = self._cliente()
+        ok = solver.create_task({
+            "clientKey": self.chave,
+            "task": {"type": "ImageToTextTask", "body": base64.b64encode(img_bytes).decode("ascii")},
+            "softId": 0,
+        })
+        if ok != 1:
+            raise RuntimeError(f"anti-captcha createTask: {solver.err_string or 'falhou'}")
+        return str(solver.task_id)
+
+    def consultar(self, task_id: str) -> Optional[str]:
+        """None = ainda processando."""
+        r = self._cliente().make_request("getTaskResult", {"clientKey": self.chave, "taskId": int(task_id)})
+        if r == 0:
+            raise RuntimeError("anti-captcha getTaskResult: falha de rede")
+        if r.get("errorId"):
+            raise RuntimeError(f"anti-captcha: {r.get('errorCode')} {r.get('errorDescription') or ''}".strip())
+        if r.get("status") != "ready":
+            return None
+        return str((r.get("solution") or {}).get("text") or "") or None
+
+    def reportar_incorreto(self, task_id: str):
+        solver = self._cliente()
+        solver.task_id = int(task_id)
+        solver.report_incorrect_image_captcha()
+
+class BackendCaptchaLocal:
+    """
+    Solver local (testes / benchmark offline): resolve com uma função Python
+    depois de `atraso` segundos, sem rede.
+    """
+
+    nome = "local"
+
+    def __init__(self, resolver: Optional[Callable[[bytes], Optional[str]]] = None, atraso: float = 0.0):
+        self.resolver = resolver or (lambda img: "0000")
+        self.atraso = atraso
+        self._tasks: Dict[str, Tuple[float, Optional[str]]] = {}
+        self._lock = threading.Lock()
+        self.incorretos: List[str] = []
+
+    def enviar(self, img_bytes: bytes) -> str:
+        task_id = uuid.uuid4().hex
+        with self._lock:
+            self._tasks[task_id] = (time.time() + self.atraso, self.resolver(img_bytes))
+        return task_id
+
+    def consultar(self, task_id: str) -> Optional[str]:
+        with self._lock:
+            pronto_em, resp = self._tasks[task_id]
+            if time.time() < pronto_em:
+                return None
+            del self._tasks[task_id]
+        if not resp:
+            raise RuntimeError("solver local sem resposta")
+        return resp
+
+    def reportar_incorreto(self, task_id: str):
+        self.incorretos.append(task_id)
+
+class ServicoCaptcha:
+    """
+    Pipeline não-bloqueante de captcha: resolver() só enfileira e devolve um
+    Future; uma única thread envia as imagens e consulta todas as tasks
+    pendentes na mesma rodada. resolver() acorda a thread só para enviar; a
+    rodada de getTaskResult roda no máximo uma vez por `intervalo`. Quem
+    espera (fluxo do DARE) bloqueia só no .result() do seu Future. Mede
+    latência e acerto (reportar()).
+    """
+
+    def __init__(self, backend=None, intervalo: float = CAPTCHA_POLL_INTERVALO, timeout: float = CAPTCHA_TIMEOUT):
+        self.backend = backend
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self._novos: "queue.Queue[Tuple[bytes, Future]]" = queue.Queue()
+        self._pendentes: Dict[str, Tuple[float, Future]] = {}
+        self._acordar = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._latencias: "deque[float]" = deque(maxlen=500)
+        self.enviados = 0
+        self.resolvidos = 0
+        self.falhas = 0
+        self.corretos = 0
+        self.incorretos = 0
+
+    def _garantir_thread(self):
+        with self._lock:
+            if self.backend is None:
+                self.backend = BackendCaptchaLocal() if CAPTCHA_BACKEND == "local" else BackendCaptchaAntiCaptcha()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="captcha", daemon=True)
+                self._thread.start()
+
+    def _enviar_novos(self):
+        while True:
+            try:
+                img_bytes, fut = self._novos.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                task_id = self.backend.enviar(img_bytes)
+                fut.task_id = task_id
+                self._pendentes[task_id] = (time.time(), fut)
+                self.enviados += 1
+            except Exception as e:
+                self.falhas += 1
+                print(f"[CAPTCHA] envio falhou: {e}")
+                fut.set_result(None)
+
+    def _consultar_pendentes(self):
+        agora = time.time()
+        for task_id, (t0, fut) in list(self._pendentes.items()):
+            try:
+                resp = self.backend.consultar(task_id)
+            except Exception as e:
+                print(f"[CAPTCHA] task {task_id}: {e}")
+                self._pendentes.pop(task_id, None)
+                self.falhas += 1
+                fut.set_result(None)
+                continue
+            if resp:
+                self._pendentes.pop(task_id, None)
+                self.resolvidos += 1
+                self._latencias.append(time.time() - t0)
+                fut.set_result(resp)
+            elif agora - t0 > self.timeout:
+                self._pendentes.pop(task_id, None)
+                self.falhas += 1
+                fut.set_result(None)
+
+    def _loop(self):
+        ultima_rodada = 0.0
+        while True:
+            # limpa antes de enviar: resolver() chegando durante a rodada não se perde
+            self._acordar.clear()
+            try:
+                self._enviar_novos()
+                if self._pendentes and time.monotonic() - ultima_rodada >= self.intervalo:
+                    ultima_rodada = time.monotonic()
+                    self._consultar_pendentes()
+            except Exception as e:
+                print(f"[CAPTCHA] loop: {e}")
+            if self._pendentes:
+                self._acordar.wait(max(0.0, ultima_rodada + self.intervalo - time.monotonic()))
+            else:
+                self._acordar.wait(30)
+
+    # ---- API ----
+    def resolver(self, img_bytes: bytes) -> Future:
+        """Future com o texto do captcha (ou None se o solver falhou/expirou)."""
+        self._garantir_thread()
+        fut: Future = Future()
+        fut.task_id = None
+        self._novos.put((img_bytes, fut))
+        self._acordar.set()
+        return fut
+
+    def reportar(self, fut: Future, correto: bool):
+        if correto:
+            self.corretos += 1
+            return
+        self.incorretos += 1
+        task_id = getattr(fut, "task_id", None)
+        if task_id:
+            try:
+                self.backend.reportar_incorreto(task_id)
+            except Exception:
+                pass
+
+    def status(self) -> Dict[str, Any]:
+        lat = sorted(self._latencias)
+
+        def pct(q: float) -> Optional[float]:
+            return round(lat[min(len(lat) - 1, int(q * len(lat)))], 3) if lat else None
+
+        avaliados = self.corretos + self.incorretos
+        return {
+            "backend": getattr(self.backend, "nome", None),
+            "pendentes": len(self._pendentes),
+            "enviados": self.enviados,
+            "resolvidos": self.resolvidos,
+            "falhas": self.falhas,
+            "latencia_p50_s": pct(0.5),
+            "latencia_p95_s": pct(0.95),
+            "acerto": round(self.corretos / avaliados, 3) if avaliados else None,
+        }
+
+servico_captcha = ServicoCaptcha()
+
+def resolver_captcha_automatico(img_bytes: bytes) -> Optional[str]:
+    return servico_captcha.resolver(img_bytes).result(timeout=CAPTCHA_TIMEOUT + 30)
+
+def _captcha_do_dare(html: str) -> Optional[Tuple["Tag", bytes]]:
+    """(form, bytes da imagem) da página de captcha do DARE; None se não for essa página."""
+    soup = _soup(html, _SO_FORM_CAPTCHA)
+    form = soup.find("form", id="adm_processar_form")
+    img = soup.find("img", id="captcha-imagem")
+    if not form or not img:
         return None
-    finally:
-        try:
-            os.remove(img_path)
-        except Exception:
-            pass
+
+    src = img.get("src", "")
+    if not src.startswith("data:image"):
+        return None
+
+    _, b64_data = src.split(",", 1)
+    return form, base64.b64decode(b64_data)
+
+def _post_captcha_dare(form: "Tag", captcha_resp: str) -> Tuple[str, Dict[str, str]]:
+    data: Dict[str, str] = {}
+    for inp in form.find_all("input"):
+        name = inp.get("name")
+        if name:
+            data[name] = inp.get("value", "") or ""
+    data["captcha[resposta]"] = captcha_resp
+
+    for sel in form.find_all("select"):
+        name = sel.get("name")
+        if not name:
+            continue
+        opt = sel.find("option", selected=True) or sel.find("option")
+        if opt:
+            data[name] = opt.get("value", "") or ""
+
+    action = form.get("action") or ""
+    if not action.startswith("http"):
+        action = requests.compat.urljoin(BASE_DARE, action)
+    return action, data
+
+def abrir_pagina_dare(sess: requests.Session, url_dare: str) -> str:
+    r = sess.get(url_dare, timeout=30, allow_redirects=True)
+    if r.status_code != 200:
+        raise RuntimeError(f"Falha ao abrir DARE: HTTP {r.status_code}")
+    return r.text
 
 def carregar_html_dare_final(sess: requests.Session, url_dare: str, max_tentativas: int = 5) -> str:
     """
     ✅ Agora com 5 tentativas (como você pediu)
+    O captcha fica na sessão do dare: cada GET invalida o anterior, então
+    numa mesma sessão só pode haver uma chamada desta por vez.
     """
     for _ in range(max_tentativas):
-        r = sess.get(url_dare, timeout=30, allow_redirects=True)
-        if r.status_code != 200:
-            raise RuntimeError(f"Falha ao abrir DARE: HTTP {r.status_code}")
+        html = abrir_pagina_dare(sess, url_dare)
 
         # guia final (sem captcha)
-        if "copy-cb" in r.text:
-            return r.text
-
-        soup = BeautifulSoup(r.text, "lxml")
-        form = soup.find("form", id="adm_processar_form")
-        img = soup.find("img", id="captcha-imagem")
-        if not form or not img:
-            return r.text
-
-        src = img.get("src", "")
-        if not src.startswith("data:image"):
-            return r.text
+        if "copy-cb" in html:
+            return html
 
-        _, b64_data = src.split(",", 1)
-        img_bytes = base64.b64decode(b64_data)
+        captcha = _captcha_do_dare(html)
+        if captcha is None:
+            return html
+        form, img_bytes = captcha
 
-        captcha_resp = resolver_captcha_automatico(img_bytes)
+        METRICA_CAPTCHA_TENTATIVAS.inc()
+        fut_captcha = servico_captcha.resolver(img_bytes)
+        captcha_resp = fut_captcha.result(timeout=CAPTCHA_TIMEOUT + 30)
         if not captcha_resp:
-            time.sleep(1.2)
+            METRICA_CAPTCHA_FALHAS.labels("sem_resposta").inc()
             continue
 
-        data: Dict[str, str] = {}
-        for inp in form.find_all("input"):
-            name = inp.get("name")
-            if name:
-                data[name] = inp.get("value", "") or ""
-        data["captcha[resposta]"] = captcha_resp
-
-        for sel in form.find_all("select"):
-            name = sel.get("name")
-            if not name:
-                continue
-            opt = sel.find("option", selected=True) or sel.find("option")
-            if opt:
-                data[name] = opt.get("value", "") or ""
-
-        action = form.get("action") or ""
-        if not action.startswith("http"):
-            action = requests.compat.urljoin(BASE_DARE, action)
-
+        action, data = _post_captcha_dare(form, captcha_resp)
         r2 = sess.post(action, data=data, timeout=30, allow_redirects=True)
         if r2.status_code == 200 and "copy-cb" in r2.text:
+            servico_captcha.reportar(fut_captcha, True)
             return r2.text
 
+        servico_captcha.reportar(fut_captcha, False)
+        METRICA_CAPTCHA_FALHAS.labels("incorreto").inc()
         time.sleep(1.2)
 
     raise RuntimeError("Não foi possível emitir o DARE (CAPTCHA).")
@@ -433,39 +1688,265 @@ def carregar_html_dare_final(sess: requests.Session, url_dare: str, max_tentativ
 # =========================================================
 # PDF via Playwright (Render)  ✅ sem base_url no set_content
 # =========================================================
-def html_para_pdf_playwright(html: str, pdf_path: str):
-    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
+class NavegadorChromium:
+    """
+    Um Chromium headless com contexto/página quentes.
+    A API sync do Playwright fica presa à thread que a iniciou, então cada
+    navegador tem a sua thread e recebe os renders por fila.
+    Render que estoura o timeout encerra o navegador (a thread pode estar
+    presa no Playwright); encerrado=True diz ao pool para não devolvê-lo.
+    """
+
+    def __init__(self, indice: int):
+        self.indice = indice
+        self.renders = 0
+        self.reciclagens = 0
+        self.encerrado = False
+        self._pw = None
+        self._browser = None
+        self._context = None
+        self._page = None
+        self._fila: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name=f"chromium-{indice}", daemon=True)
+        self._thread.start()
+
+    # ---- roda só na thread do navegador ----
+    def _iniciar(self):
+        if self._pw is None:
+            from playwright.sync_api import sync_playwright
+
+            self._pw = sync_playwright().start()
+        self._browser = self._pw.chromium.launch(
             headless=True,
-            args=["--no-sandbox", "--disable-dev-shm-usage"]
+            args=["--no-sandbox", "--disable-dev-shm-usage", "--enable-precise-memory-info"]
         )
-        page = browser.new_page()
+        self._context = self._browser.new_context()
+        self._page = self._context.new_page()
+        self.renders = 0
 
-        # ✅ Compatível: NÃO passa base_url aqui
-        page.set_content(html, wait_until="load")
-
-        page.pdf(path=pdf_path, format="A4", print_background=True)
-        browser.close()
+    def _descartar(self):
+        try:
+            if self._browser is not None:
+                self._browser.close()
+        except Exception:
+            pass
+        self._browser = self._context = self._page = None
 
-def absolutizar_recursos(html_fragment: str, base_url: str) -> str:
-    soup = BeautifulSoup(html_fragment, "lxml")
-    for tag in soup.find_all(src=True):
-        src = tag.get("src", "")
-        if src and not src.startswith(("http://", "https://", "data:")):
-            tag["src"] = requests.compat.urljoin(base_url, src)
-    for tag in soup.find_all(href=True):
-        href = tag.get("href", "")
-        if href and not href.startswith(("http://", "https://", "data:", "javascript:", "#")):
-            tag["href"] = requests.compat.urljoin(base_url, href)
-    return str(soup)
+    def _saudavel(self) -> bool:
+        try:
+            return (
+                self._browser is not None
+                and self._browser.is_connected()
+                and self._page is not None
+                and not self._page.is_closed()
+            )
+        except Exception:
+            return False
 
-def merge_pdfs(pdf_paths: List[str], output_path: str):
-    writer = PdfWriter()
-    for p in pdf_paths:
-        if not os.path.exists(p):
-            continue
-        reader = PdfReader(p)
+    def _heap_mb(self) -> float:
+        try:
+            usado = self._page.evaluate("() => (performance.memory && performance.memory.usedJSHeapSize) || 0")
+            return float(usado or 0) / (1024 * 1024)
+        except Exception:
+            return 0.0
+
+    def _precisa_reciclar(self) -> bool:
+        if self.renders >= POOL_CHROMIUM_RECICLAR_APOS:
+            return True
+        return self._heap_mb() > POOL_CHROMIUM_MAX_HEAP_MB
+
+    def _loop(self):
+        while True:
+            job = self._fila.get()
+            if job is None:
+                break
+            func, fut = job
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                if not self._saudavel():
+                    self._descartar()
+                    self._iniciar()
+                if func is None:
+                    # aquecer(): só garante o navegador de pé, não conta como render
+                    fut.set_result(None)
+                    continue
+                fut.set_result(func(self._page))
+                self.renders += 1
+                METRICA_RENDERS.inc()
+                if self._precisa_reciclar():
+                    self._descartar()
+                    self.reciclagens += 1
+            except Exception as e:
+                # navegador pode ter ficado inconsistente: relança no próximo job
+                self._descartar()
+                fut.set_exception(e)
+
+        self._descartar()
+        try:
+            if self._pw is not None:
+                self._pw.stop()
+        except Exception:
+            pass
+        self._pw = None
+
+    # ---- API (qualquer thread) ----
+    def executar(self, func, timeout: Optional[float] = POOL_CHROMIUM_TIMEOUT_RENDER):
+        fut: Future = Future()
+        self._fila.put((func, fut))
+        try:
+            return fut.result(timeout)
+        except FuturoTimeout:
+            fut.cancel()
+            print(f"[CHROMIUM] navegador {self.indice} sem resposta em {timeout}s: descartado")
+            self.encerrar()
+            raise RuntimeError(f"Render Chromium excedeu {timeout}s")
+
+    def pdf(self, html: str, pdf_path: Optional[str] = None) -> bytes:
+        def _render(page) -> bytes:
+            # ✅ Compatível: NÃO passa base_url aqui
+            page.set_content(html, wait_until="load")
+            return page.pdf(path=pdf_path, format="A4", print_background=True)
+        return self.executar(_render)
+
+    def aquecer(self, timeout: Optional[float] = POOL_CHROMIUM_TIMEOUT_RENDER):
+        self.executar(None, timeout)
+
+    def encerrar(self):
+        self.encerrado = True
+        self._fila.put(None)
+
+
+class PoolChromium:
+    """
+    Pool limitado de navegadores quentes. Uso:
+
+        with pool_chromium.emprestar() as nav:
+            nav.pdf(html_a, path_a)
+            nav.pdf(html_b, path_b)
+
+    Navegador encerrado durante o empréstimo (timeout de render ou
+    encerrar() do pool) sai de _todos na devolução em vez de voltar à fila.
+    """
+
+    def __init__(self, tamanho: int = POOL_CHROMIUM_TAMANHO):
+        self.tamanho = max(1, tamanho)
+        self._livres: "queue.Queue[NavegadorChromium]" = queue.Queue()
+        self._todos: List[NavegadorChromium] = []
+        self._criados = 0
+        self._lock = threading.Lock()
+
+    def _obter(self, timeout: float) -> NavegadorChromium:
+        limite = time.monotonic() + timeout
+        while True:
+            try:
+                return self._livres.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                if len(self._todos) < self.tamanho:
+                    nav = NavegadorChromium(self._criados)
+                    self._criados += 1
+                    self._todos.append(nav)
+                    return nav
+            falta = limite - time.monotonic()
+            if falta <= 0:
+                raise RuntimeError(f"Pool Chromium ocupado: nenhum navegador livre em {timeout}s")
+            # espera em fatias: vaga aberta por navegador descartado (ou fila
+            # trocada por encerrar()) não chega por esta fila
+            try:
+                return self._livres.get(timeout=min(falta, 0.5))
+            except queue.Empty:
+                pass
+
+    def _devolver(self, nav: NavegadorChromium):
+        # sob o lock: encerrar() não troca a fila entre o teste e o put
+        with self._lock:
+            if nav.encerrado:
+                if nav in self._todos:
+                    self._todos.remove(nav)
+                return
+            self._livres.put(nav)
+
+    @contextmanager
+    def emprestar(self, timeout: float = POOL_CHROMIUM_TIMEOUT_LEASE):
+        nav = self._obter(timeout)
+        try:
+            yield nav
+        finally:
+            self._devolver(nav)
+
+    def renderizar_pdf(self, html: str, pdf_path: Optional[str] = None) -> bytes:
+        with self.emprestar() as nav:
+            return nav.pdf(html, pdf_path)
+
+    def aquecer(self) -> int:
+        """Sobe até `tamanho` navegadores com página quente; devolve quantos ficaram prontos."""
+        navs: List[NavegadorChromium] = []
+        try:
+            while len(navs) < self.tamanho:
+                navs.append(self._obter(POOL_CHROMIUM_TIMEOUT_LEASE))
+            for nav in navs:
+                nav.aquecer()
+        finally:
+            for nav in navs:
+                self._devolver(nav)
+        return len(navs)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "tamanho": self.tamanho,
+            "navegadores": len(self._todos),
+            "livres": self._livres.qsize(),
+            "renders": [n.renders for n in self._todos],
+            "reciclagens": sum(n.reciclagens for n in self._todos),
+        }
+
+    def encerrar(self):
+        with self._lock:
+            for nav in self._todos:
+                nav.encerrar()
+            self._todos = []
+            self._livres = queue.Queue()
+
+pool_chromium = PoolChromium()
+
+def html_para_pdf_playwright(html: str, pdf_path: str):
+    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+    pool_chromium.renderizar_pdf(html, pdf_path)
+
+def absolutizar_recursos(html_fragment: str, base_url: str) -> str:
+    soup = _soup(html_fragment)
+    for tag in soup.find_all(src=True):
+        src = tag.get("src", "")
+        if src and not src.startswith(("http://", "https://", "data:")):
+            tag["src"] = requests.compat.urljoin(base_url, src)
+    for tag in soup.find_all(href=True):
+        href = tag.get("href", "")
+        if href and not href.startswith(("http://", "https://", "data:", "javascript:", "#")):
+            tag["href"] = requests.compat.urljoin(base_url, href)
+    return str(soup)
+
+def merge_pdfs_bytes(pdfs: List[bytes]) -> bytes:
+    """merge_pdfs sem disco: PDFs em bytes -> PDF em bytes."""
+    from pypdf import PdfReader, PdfWriter
+
+    writer = PdfWriter()
+    for dados in pdfs:
+        for page in PdfReader(io.BytesIO(dados)).pages:
+            writer.add_page(page)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def merge_pdfs(pdf_paths: List[str], output_path: str):
+    from pypdf import PdfReader, PdfWriter
+
+    writer = PdfWriter()
+    for p in pdf_paths:
+        if not os.path.exists(p):
+            continue
+        reader = PdfReader(p)
         for page in reader.pages:
             writer.add_page(page)
     with open(output_path, "wb") as f:
@@ -474,72 +1955,131 @@ def merge_pdfs(pdf_paths: List[str], output_path: str):
 # =========================================================
 # DARE: preparar "caber na página" (2 vias / zoom / logo / barcode)
 # =========================================================
-def _remover_textos_menu(soup: BeautifulSoup):
-    for txt in ["Voltar", "Imprimir", "COPIAR CÓDIGO DE BARRAS", "COPIAR QR CODE PIX"]:
-        for node in soup.find_all(string=re.compile(re.escape(txt), re.I)):
-            p = node.find_parent(["a", "button", "div", "span"])
-            if p:
-                try:
-                    p.decompose()
-                except Exception:
-                    pass
+_RE_MENU_DARE = re.compile(
+    "|".join(re.escape(t) for t in ["Voltar", "Imprimir", "COPIAR CÓDIGO DE BARRAS", "COPIAR QR CODE PIX"]),
+    re.I,
+)
+_RE_BARCODE_DARE = re.compile(r"\b\d{11}\s+\d{12}\s+\d{12}\s+\d{12}\b")
+_RE_VIA_BANCO = re.compile(r"Autenticação\s*mecânica\s*/\s*Via\s*banco", re.I)
+_RE_VIA_USUARIO = re.compile(r"Autenticação\s*mecânica\s*/\s*Via\s*Usu[aá]rio", re.I)
+_TAGS_BLOCO_VIA = ("table", "div", "section", "article")
+
+def _absolutizar_tag(tag, base_url: str):
+    src = tag.get("src")
+    if src and not src.startswith(("http://", "https://", "data:")):
+        tag["src"] = requests.compat.urljoin(base_url, src)
+    href = tag.get("href")
+    if href and not href.startswith(("http://", "https://", "data:", "javascript:", "#")):
+        tag["href"] = requests.compat.urljoin(base_url, href)
+
+def _transformar_dare(soup: "BeautifulSoup", base_url: str) -> Dict[str, Any]:
+    """
+    Uma passada pela árvore: remove textos de menu, neutraliza page-breaks,
+    marca o logo, centraliza códigos de barras, absolutiza src/href e anota
+    onde estão os rótulos das 2 vias. As remoções ficam para o fim (não dá
+    para decompor durante a iteração). A versão multipasso antiga ficou em
+    tests/dare_multipasso_referencia.py.
+    """
+    from bs4 import NavigableString, Tag
 
-def _neutralizar_pagebreaks(soup: BeautifulSoup):
-    for tag in soup.find_all(True):
-        st = (tag.get("style") or "")
-        cls = " ".join(tag.get("class") or [])
-        if "page-break" in st.lower() or "break-after" in st.lower() or "pagebreak" in cls.lower():
-            try:
-                tag["style"] = re.sub(r"page-break-[^;]+;?", "", st, flags=re.I)
-                tag["style"] = re.sub(r"break-[^;]+;?", "", tag.get("style",""), flags=re.I)
-            except Exception:
-                pass
+    remover: Dict[int, Any] = {}
+    imgs_com_src = []
+    alvos_banco = []
+    alvos_usuario = []
+
+    for node in soup.descendants:
+        if isinstance(node, NavigableString):
+            if not node.strip():
+                continue
+            if _RE_MENU_DARE.search(node):
+                p = node.find_parent(["a", "button", "div", "span"])
+                if p is not None:
+                    remover[id(p)] = p
+            if _RE_BARCODE_DARE.search(node):
+                parent = node.find_parent(["td", "div", "p", "span"])
+                if parent is not None:
+                    st = parent.get("style") or ""
+                    parent["style"] = (st + ";text-align:center;").strip(";")
+            if _RE_VIA_BANCO.search(node):
+                alvos_banco.append(node)
+            if _RE_VIA_USUARIO.search(node):
+                alvos_usuario.append(node)
+            continue
 
-def _marcar_primeira_img_como_logo(soup: BeautifulSoup):
-    for img in soup.find_all("img"):
-        src = (img.get("src") or "").strip()
-        if not src:
+        if not isinstance(node, Tag):
             continue
-        classes = img.get("class") or []
+
+        st = node.get("style") or ""
+        cls = " ".join(node.get("class") or [])
+        st_low = st.lower()
+        if "page-break" in st_low or "break-after" in st_low or "pagebreak" in cls.lower():
+            st = re.sub(r"page-break-[^;]+;?", "", st, flags=re.I)
+            st = re.sub(r"break-[^;]+;?", "", st, flags=re.I)
+            node["style"] = st
+
+        if node.name == "img" and (node.get("src") or "").strip():
+            imgs_com_src.append(node)
+
+        if node.name in ("img", "svg"):
+            src = (node.get("src") or "").lower()
+            if node.name == "svg" or ("barra" in src) or ("barcode" in src) or ("codigo" in src) or ("qrcode" in src):
+                st = node.get("style") or ""
+                node["style"] = (st + ";display:block;margin:0 auto;").strip(";")
+                p = node.find_parent(["td", "div", "p", "span"])
+                if p is not None:
+                    pst = p.get("style") or ""
+                    p["style"] = (pst + ";text-align:center;").strip(";")
+
+        _absolutizar_tag(node, base_url)
+
+    def _removido(n) -> bool:
+        while n is not None:
+            if id(n) in remover:
+                return True
+            n = n.parent
+        return False
+
+    # decide antes de decompor: depois disso os nós removidos perdem os pais
+    logo = next((img for img in imgs_com_src if not _removido(img)), None)
+    alvo_banco = next((n for n in alvos_banco if not _removido(n)), None)
+    alvo_usuario = next((n for n in alvos_usuario if not _removido(n)), None)
+
+    for p in remover.values():
+        try:
+            p.decompose()
+        except Exception:
+            pass
+
+    if logo is not None:
+        classes = logo.get("class") or []
         if "logo-sefin" not in classes:
             classes.append("logo-sefin")
-        img["class"] = classes
-        break
+        logo["class"] = classes
 
-def _centralizar_barcodes(soup: BeautifulSoup):
-    padrao = re.compile(r"\b\d{11}\s+\d{12}\s+\d{12}\s+\d{12}\b")
-    for node in soup.find_all(string=padrao):
-        parent = node.find_parent(["td", "div", "p", "span"])
-        if parent:
-            st = parent.get("style") or ""
-            parent["style"] = (st + ";text-align:center;").strip(";")
-
-    for tag in soup.find_all(["img", "svg"]):
-        src = (tag.get("src") or "").lower()
-        if tag.name == "svg" or ("barra" in src) or ("barcode" in src) or ("codigo" in src) or ("qrcode" in src):
-            st = tag.get("style") or ""
-            tag["style"] = (st + ";display:block;margin:0 auto;").strip(";")
-            p = tag.find_parent(["td","div","p","span"])
-            if p:
-                pst = p.get("style") or ""
-                p["style"] = (pst + ";text-align:center;").strip(";")
-
-def _extrair_bloco_via(soup: BeautifulSoup, regex_alvo: str, regex_proibido: str) -> Optional[str]:
-    alvo = re.compile(regex_alvo, re.I)
-    proib = re.compile(regex_proibido, re.I)
-
-    node = soup.find(string=alvo)
-    if not node:
+    return {"alvo_banco": alvo_banco, "alvo_usuario": alvo_usuario}
+
+def _bloco_via(node, proib: "re.Pattern", textos: Dict[int, str]) -> Optional["Tag"]:
+    """
+    Menor bloco ancestral do rótulo (>= 200 caracteres) sem o rótulo da outra
+    via; get_text em cache (as 2 vias compartilham ancestrais).
+    """
+    if node is None:
         return None
 
+    def texto(t: "Tag") -> str:
+        k = id(t)
+        if k not in textos:
+            textos[k] = t.get_text(" ", strip=True)
+        return textos[k]
+
     cur = node
     candidates = []
     for _ in range(18):
         cur = cur.parent if hasattr(cur, "parent") else None
         if not cur or not getattr(cur, "name", None):
             break
-        if cur.name in ("table","div","section","article"):
-            txt = cur.get_text(" ", strip=True)
+        if cur.name in _TAGS_BLOCO_VIA:
+            txt = texto(cur)
             if len(txt) < 200:
                 continue
             if proib.search(txt):
@@ -547,64 +2087,48 @@ def _extrair_bloco_via(soup: BeautifulSoup, regex_alvo: str, regex_proibido: str
             candidates.append(cur)
 
     if not candidates:
-        parent = node.find_parent(["table","div","section","article"])
+        parent = node.find_parent(list(_TAGS_BLOCO_VIA))
         if parent:
-            txt = parent.get_text(" ", strip=True)
+            txt = texto(parent)
             if len(txt) >= 200 and not proib.search(txt):
-                return str(parent)
+                return parent
         return None
 
-    best = min(candidates, key=lambda t: len(t.get_text(" ", strip=True)))
-    return str(best)
+    return min(candidates, key=lambda t: len(texto(t)))
 
 def preparar_dare_duas_vias(html_dare_final: str) -> str:
     """
     Tenta extrair Via Banco e Via Usuário (2 vias) e montar em 1 página,
-    aplicando recursos absolutos.
-    """
-    soup = BeautifulSoup(html_dare_final, "lxml")
-    _remover_textos_menu(soup)
-    _neutralizar_pagebreaks(soup)
-    _marcar_primeira_img_como_logo(soup)
-    _centralizar_barcodes(soup)
-
-    via_banco = _extrair_bloco_via(
-        soup,
-        r"Autenticação\s*mecânica\s*/\s*Via\s*banco",
-        r"Autenticação\s*mecânica\s*/\s*Via\s*Usu[aá]rio",
-    )
-    via_usuario = _extrair_bloco_via(
-        soup,
-        r"Autenticação\s*mecânica\s*/\s*Via\s*Usu[aá]rio",
-        r"Autenticação\s*mecânica\s*/\s*Via\s*banco",
-    )
-
-    if via_banco and via_usuario:
-        body = f"""
+    aplicando recursos absolutos. Uma passada só (_transformar_dare) e saída
+    direto do DOM, sem re-parse.
+    """
+    soup = _soup(html_dare_final)
+    achados = _transformar_dare(soup, BASE_DARE)
+    textos: Dict[int, str] = {}
+    via_banco = _bloco_via(achados["alvo_banco"], _RE_VIA_USUARIO, textos)
+    via_usuario = _bloco_via(achados["alvo_usuario"], _RE_VIA_BANCO, textos)
+
+    if via_banco is not None and via_usuario is not None:
+        return f"""
 <div class="vias">
   <div class="via">{via_banco}</div>
   <div class="corte">------------------------------------ corte aqui ------------------------------------</div>
   <div class="via">{via_usuario}</div>
 </div>
 """
-        return absolutizar_recursos(body, BASE_DARE)
 
     # fallback: corpo inteiro
-    body = soup.body.decode_contents() if soup.body else str(soup)
-    return absolutizar_recursos(body, BASE_DARE)
+    return soup.body.decode_contents() if soup.body else str(soup)
 
-def montar_html_dare_1_pagina(body_dare_2vias: str) -> str:
+def _css_dare_1_pagina(escopo: str = "") -> str:
     """
-    HTML final do DARE: 2 vias + zoom + logo menor + evitar quebra.
+    CSS do DARE em 1 página. escopo prefixa os seletores (ex.: ".dare-doc ")
+    quando o DARE divide o documento com o extrato.
     """
-    return f"""<!doctype html>
-<html lang="pt-BR">
-<head>
-<meta charset="utf-8">
-<base href="{BASE_DARE}">
-<style>
-  * {{ box-sizing: border-box; }}
-  @page {{ size: A4 portrait; margin: {MARGEM_DARE_MM}mm; }}
+    e = escopo
+    todos = f"{e.strip()}, {e}*" if e else "*"
+    return f"""
+  {todos} {{ box-sizing: border-box; }}
   html, body {{ margin:0; padding:0; }}
   body {{ overflow: visible !important; }}
 
@@ -614,8 +2138,8 @@ def montar_html_dare_1_pagina(body_dare_2vias: str) -> str:
     page-break-before: avoid !important;
   }}
 
-  .via {{ zoom: {ZOOM_DARE_2VIAS}; transform-origin: top center; }}
-  .corte {{
+  {e}.via {{ zoom: {ZOOM_DARE_2VIAS}; transform-origin: top center; }}
+  {e}.corte {{
     text-align:center;
     font: 10px/1.2 Arial, sans-serif;
     opacity:.8;
@@ -623,7 +2147,7 @@ def montar_html_dare_1_pagina(body_dare_2vias: str) -> str:
     white-space: nowrap;
   }}
 
-  img.logo-sefin {{
+  {e}img.logo-sefin {{
     max-width: {LOGO_MAX_WIDTH_PX}px !important;
     max-height: {LOGO_MAX_HEIGHT_PX}px !important;
     width: auto !important;
@@ -632,98 +2156,327 @@ def montar_html_dare_1_pagina(body_dare_2vias: str) -> str:
     margin: 2px auto !important;
   }}
 
-  img[src*="barra"], img[src*="barcode"], svg {{
+  {e}img[src*="barra"], {e}img[src*="barcode"], {e}svg {{
     display:block;
     margin:0 auto;
   }}
 
-  .via, .via * {{
+  {e}.via, {e}.via * {{
     break-inside: avoid !important;
     page-break-inside: avoid !important;
   }}
+"""
+
+def montar_html_dare_1_pagina(body_dare_2vias: str) -> str:
+    """
+    HTML final do DARE: 2 vias + zoom + logo menor + evitar quebra.
+    """
+    return f"""<!doctype html>
+<html lang="pt-BR">
+<head>
+<meta charset="utf-8">
+<base href="{BASE_DARE}">
+<style>
+  @page {{ size: A4 portrait; margin: {MARGEM_DARE_MM}mm; }}
+{_css_dare_1_pagina()}
+</style>
+</head>
+<body>
+{body_dare_2vias}
+</body>
+</html>
+"""
+
+def montar_html_dare_e_extrato(body_dare_2vias: str, ext_body_html: str) -> str:
+    """
+    DARE (CSS de 1 página, página nomeada "dare") + extrato a partir de uma
+    página nova, num documento só: 1 page.pdf() em vez de 2 renders + merge.
+    """
+    return f"""<!doctype html>
+<html lang="pt-BR">
+<head>
+<meta charset="utf-8">
+<base href="{BASE_DARE}">
+<style>
+  @page {{ size: A4 portrait; }}
+  @page dare {{ size: A4 portrait; margin: {MARGEM_DARE_MM}mm; }}
+  .dare-doc {{ page: dare; }}
+  .extrato-doc {{
+    break-before: page !important;
+    page-break-before: always !important;
+  }}
+{_css_dare_1_pagina(".dare-doc ")}
 </style>
 </head>
 <body>
+<div class="dare-doc">
 {body_dare_2vias}
+</div>
+<div class="extrato-doc">
+{ext_body_html}
+</div>
 </body>
 </html>
 """
 
+def _body_extrato(html_ext: str) -> str:
+    """Corpo do extrato com recursos absolutos (um parse só)."""
+    soup = _soup(html_ext)
+    raiz = soup.body or soup
+    for tag in raiz.find_all(True):
+        _absolutizar_tag(tag, BASE_PORTAL)
+    return raiz.decode_contents() if soup.body else str(soup)
+
+# =========================================================
+# CACHE DE PDF DARE
+# =========================================================
+_CAMPOS_CHAVE_PDF = ("nr_lancamento", "parcela", "data_vencimento", "valor_atualizado")
+
+def chave_pdf_dare(cert_id: str, deb: Dict[str, str], dia: Optional[date] = None) -> str:
+    partes = {"cert_id": cert_id, "dia": (dia or date.today()).isoformat()}
+    for campo in _CAMPOS_CHAVE_PDF:
+        partes[campo] = (deb.get(campo) or "").strip()
+    return hashlib.sha256(json.dumps(partes, sort_keys=True).encode()).hexdigest()
+
+class CachePdfDare:
+    """
+    PDFs DARE(+extrato) em disco, endereçados por chave_pdf_dare(): mesmo
+    débito, mesmo certificado, mesmo dia = mesmo PDF, sem captcha nem render.
+    LRU por mtime (tocado a cada hit) com teto de tamanho total.
+    """
+
+    def __init__(self, pasta: str = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_MB * 1024 * 1024, ativo: bool = PDF_CACHE_ATIVO):
+        self.pasta = pasta
+        self.max_bytes = max_bytes
+        self.ativo = ativo
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _arquivo(self, chave: str) -> str:
+        return os.path.join(self.pasta, chave[:2], chave + ".pdf")
+
+    def _listar(self) -> List[Tuple[float, int, str]]:
+        itens = []
+        for raiz, _, nomes in os.walk(self.pasta):
+            for nome in nomes:
+                if not nome.endswith(".pdf"):
+                    continue
+                path = os.path.join(raiz, nome)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                itens.append((st.st_mtime, st.st_size, path))
+        return itens
+
+    def obter(self, chave: str) -> Optional[bytes]:
+        if not self.ativo:
+            return None
+        path = self._arquivo(chave)
+        try:
+            with open(path, "rb") as f:
+                dados = f.read()
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            METRICA_CACHE.labels("pdf", "miss").inc()
+            return None
+        self.hits += 1
+        METRICA_CACHE.labels("pdf", "hit").inc()
+        return dados
+
+    def guardar(self, chave: str, dados: bytes):
+        if not self.ativo or not dados:
+            return
+        path = self._arquivo(chave)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(dados)
+        with self._lock:
+            # mesma chave regravada: soma só a diferença, senão _total infla e evicta cedo
+            try:
+                anterior = os.path.getsize(path)
+            except OSError:
+                anterior = 0
+            os.replace(tmp, path)
+            if self._total is None:
+                self._total = sum(t for _, t, _ in self._listar())
+            else:
+                self._total += len(dados) - anterior
+            if self._total > self.max_bytes:
+                self._evictar()
+
+    def _evictar(self):
+        # chamado com self._lock; desce até 90% do teto para não varrer a cada PDF
+        itens = sorted(self._listar())
+        total = sum(t for _, t, _ in itens)
+        alvo = int(self.max_bytes * 0.9)
+        for _, tam, path in itens:
+            if total <= alvo:
+                break
+            try:
+                os.remove(path)
+                total -= tam
+            except OSError:
+                pass
+        self._total = total
+
+    def status(self) -> Dict[str, Any]:
+        return {"ativo": self.ativo, "bytes": self._total, "hits": self.hits, "misses": self.misses}
+
+cache_pdf_dare = CachePdfDare()
+
 # =========================================================
 # PDF DARE + EXTRATO
 # =========================================================
-def gerar_pdf_dare_e_extrato(sess: requests.Session, deb: Dict[str, str], pasta: str) -> Optional[str]:
+RENDER_COMBINADO = os.getenv("RENDER_COMBINADO", "1") == "1"
+
+def _dare_no_prazo(deb: Dict[str, str]) -> bool:
+    venc_date = parse_data_br((deb.get("data_vencimento") or "").strip())
+    return not venc_date or venc_date <= date.today() + timedelta(days=DIAS_MAX_FUTURO_DARE)
+
+def _nome_pdf_dare(deb: Dict[str, str]) -> str:
     venc_txt = (deb.get("data_vencimento") or "").strip()
-    venc_date = parse_data_br(venc_txt)
-    if venc_date:
-        limite = date.today() + timedelta(days=DIAS_MAX_FUTURO_DARE)
-        if venc_date > limite:
-            return None
+    receita = (deb.get("receita") or "0").strip()
+    valor = (deb.get("valor_atualizado") or deb.get("valor_lancamento") or "0").strip()
+    return _safe_filename(f"DARE_{venc_txt.replace('/','-')}_{receita}_{valor}.pdf")
+
+def _nome_pdf_unico(nome_pdf: str, usados: set) -> str:
+    """
+    Mesmo vencimento/receita/valor em outra IE/lançamento dá o mesmo
+    _nome_pdf_dare: o segundo ganha _2, _3... em vez de sobrescrever o
+    primeiro na pasta da empresa.
+    """
+    raiz, n, nome = nome_pdf[:-4], 2, nome_pdf
+    while nome in usados:
+        nome = f"{raiz}_{n}.pdf"
+        n += 1
+    usados.add(nome)
+    return nome
+
+def _pdf_dare_bytes(body_dare_2vias: str, ext_body_html: Optional[str], crono: Cronometro) -> bytes:
+    """Render do DARE (+extrato) no pool Chromium, tudo em memória (bytes do page.pdf())."""
+    t_fila = time.perf_counter()
+    with pool_chromium.emprestar() as nav:
+        crono.registrar("fila_chromium", time.perf_counter() - t_fila)
+
+        # a) sem extrato: só DARE, bytes direto do page.pdf()
+        if ext_body_html is None:
+            with crono.etapa("render"):
+                return nav.pdf(montar_html_dare_1_pagina(body_dare_2vias))
+
+        # b) DARE + extrato num documento só (sem __tmp_*.pdf nem merge)
+        if RENDER_COMBINADO:
+            try:
+                with crono.etapa("render"):
+                    return nav.pdf(montar_html_dare_e_extrato(body_dare_2vias, ext_body_html))
+            except Exception as e:
+                # timeout: executar() já encerrou o navegador e outro render nele só esperaria de novo
+                if nav.encerrado:
+                    raise
+                print(f"[PDF] render combinado falhou, usando 2 renders + merge: {e}")
+
+        # c) fallback: 2 renders + merge (em memória)
+        ext_html = f"""<!doctype html><html><head><meta charset="utf-8"><base href="{BASE_PORTAL}"></head>
+<body>{ext_body_html}</body></html>"""
+        with crono.etapa("render"):
+            pdf_dare = nav.pdf(montar_html_dare_1_pagina(body_dare_2vias))
+            pdf_ext = nav.pdf(ext_html)
+
+    with crono.etapa("merge"):
+        return merge_pdfs_bytes([pdf_dare, pdf_ext])
+
+def gerar_pdf_dare_bytes(
+    sess: requests.Session,
+    deb: Dict[str, str],
+    cert_id: Optional[str] = None,
+    stats: Optional[Dict[str, int]] = None,
+    crono: Optional[Cronometro] = None,
+) -> Optional[bytes]:
+    """
+    PDF DARE(+extrato) em bytes, sem tocar em disco; None se o débito está
+    fora do prazo ou sem link. Com cert_id consulta/alimenta o
+    cache_pdf_dare; stats["cache_hits"] conta os PDFs vindos do cache.
+    crono recebe os spans captcha / dom / extrato / fila_chromium / render / merge.
+    """
+    crono = crono or Cronometro("dares")
+    if not _dare_no_prazo(deb):
+        return None
 
     url_dare = (deb.get("url_dare") or "").strip()
     url_ext  = (deb.get("url_extrato") or "").strip()
     if not url_dare:
         return None
 
-    receita = (deb.get("receita") or "0").strip()
-    valor = (deb.get("valor_atualizado") or deb.get("valor_lancamento") or "0").strip()
-    nome = _safe_filename(f"DARE_{venc_txt.replace('/','-')}_{receita}_{valor}.pdf")
-    out_pdf = os.path.join(pasta, nome)
+    # 0) mesmo débito já gerado hoje para este certificado: sem captcha/render/merge
+    chave = chave_pdf_dare(cert_id, deb) if cert_id else None
+    if chave:
+        em_cache = cache_pdf_dare.obter(chave)
+        if em_cache is not None:
+            if stats is not None:
+                stats["cache_hits"] = stats.get("cache_hits", 0) + 1
+            METRICA_PDFS.labels("cache").inc()
+            return em_cache
 
     # 1) pega HTML final (com captcha até 5 tentativas)
-    html_dare_final = carregar_html_dare_final(sess, url_dare, max_tentativas=5)
+    with crono.etapa("captcha"):
+        html_dare_final = carregar_html_dare_final(sess, url_dare, max_tentativas=5)
 
     # 2) prepara 2 vias + CSS para caber em 1 página
-    body_dare_2vias = preparar_dare_duas_vias(html_dare_final)
-    dare_html = montar_html_dare_1_pagina(body_dare_2vias)
-
-    tmp_dare = os.path.join(pasta, "__tmp_dare.pdf")
-    html_para_pdf_playwright(dare_html, tmp_dare)
-
-    # sem extrato: só DARE
-    if not url_ext:
-        os.replace(tmp_dare, out_pdf)
-        return out_pdf
-
-    # com extrato: render normal e faz merge
-    r_ext = sess.get(url_ext, timeout=30, allow_redirects=True)
-    if r_ext.status_code != 200:
-        os.replace(tmp_dare, out_pdf)
-        return out_pdf
-
-    ext_body = BeautifulSoup(r_ext.text, "lxml").body
-    ext_body_html = absolutizar_recursos(ext_body.decode_contents() if ext_body else r_ext.text, BASE_PORTAL)
-    ext_html = f"""<!doctype html><html><head><meta charset="utf-8"><base href="{BASE_PORTAL}"></head>
-<body>{ext_body_html}</body></html>"""
-
-    tmp_ext = os.path.join(pasta, "__tmp_ext.pdf")
-    html_para_pdf_playwright(ext_html, tmp_ext)
-
-    merge_pdfs([tmp_dare, tmp_ext], out_pdf)
-
-    for p in (tmp_dare, tmp_ext):
-        try:
-            if os.path.exists(p):
-                os.remove(p)
-        except Exception:
-            pass
+    with crono.etapa("dom"):
+        body_dare_2vias = preparar_dare_duas_vias(html_dare_final)
+
+    # 3) extrato (HTML) antes de pegar um navegador do pool
+    ext_body_html = None
+    if url_ext:
+        with crono.etapa("extrato"):
+            r_ext = sess.get(url_ext, timeout=30, allow_redirects=True)
+            if r_ext.status_code == 200:
+                ext_body_html = _body_extrato(r_ext.text)
+
+    # 4) render (1 documento; 2 renders + merge só no fallback)
+    pdf_bytes = _pdf_dare_bytes(body_dare_2vias, ext_body_html, crono)
+    if chave:
+        cache_pdf_dare.guardar(chave, pdf_bytes)
+    METRICA_PDFS.labels("render").inc()
+    return pdf_bytes
+
+def gerar_pdf_dare_e_extrato(
+    sess: requests.Session,
+    deb: Dict[str, str],
+    pasta: str,
+    cert_id: Optional[str] = None,
+    stats: Optional[Dict[str, int]] = None,
+    crono: Optional[Cronometro] = None,
+) -> Optional[str]:
+    """gerar_pdf_dare_bytes gravado em pasta; devolve o caminho do PDF."""
+    pdf_bytes = gerar_pdf_dare_bytes(sess, deb, cert_id=cert_id, stats=stats, crono=crono)
+    if pdf_bytes is None:
+        return None
 
+    out_pdf = os.path.join(pasta, _nome_pdf_dare(deb))
+    # mesmo vencimento/receita/valor em outra IE/lançamento: não sobrescreve o PDF anterior
+    raiz_pdf, n = out_pdf[:-4], 2
+    while os.path.exists(out_pdf):
+        out_pdf = f"{raiz_pdf}_{n}.pdf"
+        n += 1
+    os.makedirs(pasta, exist_ok=True)
+    with open(out_pdf, "wb") as f:
+        f.write(pdf_bytes)
     return out_pdf
 
 # =========================================================
 # FLUXO /fisconforme (JSON)
 # =========================================================
-def fluxo_fisconforme(cert_row: Dict[str, Any]) -> Dict[str, Any]:
-    empresa = cert_row.get("empresa") or ""
-    user = cert_row.get("user") or ""
-    doc = cert_row.get("cnpj/cpf") or ""
-    codi = cert_row.get("codi") or ""
-
-    res: Dict[str, Any] = {
-        "empresa": empresa,
-        "user": user,
-        "cnpj": doc,
-        "codi": codi,
+def _resultado_vazio(cert_row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "empresa": cert_row.get("empresa") or "",
+        "user": cert_row.get("user") or "",
+        "cnpj": cert_row.get("cnpj/cpf") or "",
+        "codi": cert_row.get("codi") or "",
         "situacao_geral": "erro",
         "pendencias": [],
         "qtd_pendencias": 0,
@@ -732,66 +2485,68 @@ def fluxo_fisconforme(cert_row: Dict[str, Any]) -> Dict[str, Any]:
         "erro_fisconforme": None,
         "erro_debitos": None,
         "erro": None,
+        "tempos_ms": {},
     }
 
-    cert_path = key_path = None
-    try:
-        cert_path, key_path = criar_arquivos_cert_temp(cert_row)
-        sess = criar_sessao(cert_path, key_path)
+def _situacao_geral(res: Dict[str, Any]) -> str:
+    tem_p = res["qtd_pendencias"] > 0
+    tem_d = res["qtd_debitos"] > 0
+    tem_e = bool(res["erro_fisconforme"] or res["erro_debitos"] or res["erro"])
+
+    if tem_e and not (tem_p or tem_d):
+        return "erro"
+    if tem_p and tem_d:
+        return "pendencia_fis_e_debitos"
+    if tem_p:
+        return "pendencia_fis"
+    if tem_d:
+        return "debitos"
+    return "regular"
 
-        if not abrir_acesso_digital_e_entrar(sess):
-            res["erro"] = "Falha ao entrar no Acesso Digital"
-            return res
+def fluxo_fisconforme(cert_row: Dict[str, Any]) -> Dict[str, Any]:
+    res = _resultado_vazio(cert_row)
+    crono = Cronometro("fisconforme")
 
-        html_portal = ir_para_portal_e_carregar_home(sess)
-        if not html_portal:
-            res["erro"] = "Falha ao abrir Portal"
-            return res
+    try:
+        t_sessao = time.perf_counter()
+        with cache_sessoes.sessao(cert_row) as (sess, html_portal):
+            crono.registrar("sessao", time.perf_counter() - t_sessao)
 
-        # FisConforme
-        try:
-            form = encontrar_form_fisconforme(html_portal)
-            if form:
-                action, token = form
-                html_fis = acessar_fisconforme(sess, action, token)
-                if html_fis:
-                    pend = obter_pendencias_fisconforme(html_fis)
-                    res["pendencias"] = pend
-                    res["qtd_pendencias"] = len(pend)
+            # FisConforme
+            try:
+                with crono.etapa("fisconforme"):
+                    form = encontrar_form_fisconforme(html_portal)
+                    if form:
+                        action, token = form
+                        html_fis = acessar_fisconforme(sess, action, token)
+                        if html_fis:
+                            pend = obter_pendencias_fisconforme(html_fis)
+                            res["pendencias"] = pend
+                            res["qtd_pendencias"] = len(pend)
+                        else:
+                            res["erro_fisconforme"] = "Erro ao abrir FisConforme"
+                    else:
+                        res["erro_fisconforme"] = "Form FisConforme não encontrado"
+            except Exception as e:
+                res["erro_fisconforme"] = str(e)
+
+            # Débitos (ano atual)
+            try:
+                with crono.etapa("debitos"):
+                    debitos, err = consultar_debitos_ano(sess, date.today().year)
+                if err:
+                    res["erro_debitos"] = err
                 else:
-                    res["erro_fisconforme"] = "Erro ao abrir FisConforme"
-            else:
-                res["erro_fisconforme"] = "Form FisConforme não encontrado"
-        except Exception as e:
-            res["erro_fisconforme"] = str(e)
+                    res["debitos"] = debitos
+                    res["qtd_debitos"] = len(debitos)
+            except Exception as e:
+                res["erro_debitos"] = str(e)
 
-        # Débitos (ano atual)
-        try:
-            debitos, err = consultar_debitos_ano(sess, date.today().year)
-            if err:
-                res["erro_debitos"] = err
-            else:
-                res["debitos"] = debitos
-                res["qtd_debitos"] = len(debitos)
-        except Exception as e:
-            res["erro_debitos"] = str(e)
-
-        tem_p = res["qtd_pendencias"] > 0
-        tem_d = res["qtd_debitos"] > 0
-        tem_e = bool(res["erro_fisconforme"] or res["erro_debitos"] or res["erro"])
-
-        if tem_e and not (tem_p or tem_d):
-            sit = "erro"
-        elif tem_p and tem_d:
-            sit = "pendencia_fis_e_debitos"
-        elif tem_p:
-            sit = "pendencia_fis"
-        elif tem_d:
-            sit = "debitos"
-        else:
-            sit = "regular"
+        # nada funcionou com esta sessão: provável sessão derrubada pelo portal
+        if res["erro_fisconforme"] and res["erro_debitos"]:
+            cache_sessoes.invalidar(cert_row)
 
-        res["situacao_geral"] = sit
+        res["situacao_geral"] = _situacao_geral(res)
         return res
 
     except Exception as e:
@@ -800,124 +2555,2353 @@ def fluxo_fisconforme(cert_row: Dict[str, Any]) -> Dict[str, Any]:
         return res
 
     finally:
-        try:
-            if cert_path and os.path.exists(cert_path): os.remove(cert_path)
-            if key_path and os.path.exists(key_path): os.remove(key_path)
-        except Exception:
-            pass
+        crono.exportar()
+        res["tempos_ms"] = crono.tempos_ms()
 
 # =========================================================
-# ZIP DARES (com relatório dentro)
+# CACHE DE RESULTADO /fisconforme (TTL por certificado)
 # =========================================================
-def gerar_zip_dares(user: str) -> Tuple[str, str, int, int, int, List[Dict[str, str]]]:
-    certs = carregar_certificados_validos(user)
-    if not certs:
-        raise RuntimeError("Nenhuma empresa para este user.")
+class CacheResultados:
+    """
+    Resultado de fluxo_fisconforme por cert id. Resultados com
+    situacao_geral == "erro" ficam só RESULTADO_CACHE_TTL_ERRO (cache negativo).
+    """
 
-    tmpdir = tempfile.gettempdir()
-    zip_name = f"dares_{_slug(user)}_{date.today().isoformat()}_{int(time.time())}.zip"
-    zip_path = os.path.join(tmpdir, zip_name)
+    def __init__(
+        self,
+        ttl: float = RESULTADO_CACHE_TTL,
+        ttl_erro: float = RESULTADO_CACHE_TTL_ERRO,
+        max_entradas: int = RESULTADO_CACHE_MAX_ENTRADAS,
+    ):
+        self.ttl = ttl
+        self.ttl_erro = ttl_erro
+        self.max_entradas = max_entradas
+        self._entradas: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _ttl_de(self, res: Dict[str, Any]) -> float:
+        return self.ttl_erro if res.get("situacao_geral") == "erro" else self.ttl
+
+    def obter(self, chave: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            ent = self._entradas.get(chave)
+            if ent is None:
+                self.misses += 1
+                METRICA_CACHE.labels("resultado", "miss").inc()
+                return None
+            ts, res = ent
+            idade = time.time() - ts
+            if idade > self._ttl_de(res):
+                del self._entradas[chave]
+                self.misses += 1
+                METRICA_CACHE.labels("resultado", "miss").inc()
+                return None
+            self._entradas.move_to_end(chave)
+            self.hits += 1
+            METRICA_CACHE.labels("resultado", "hit").inc()
+        out = copy.deepcopy(res)
+        out["from_cache"] = True
+        out["cache_age_s"] = round(idade, 3)
+        return out
+
+    def guardar(self, chave: str, res: Dict[str, Any]):
+        with self._lock:
+            self._entradas[chave] = (time.time(), copy.deepcopy(res))
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+
+cache_resultados = CacheResultados()
 
-    pdfs = 0
-    erros = 0
-    empresas = len(certs)
-    erros_list: List[Dict[str, str]] = []
+# =========================================================
+# SNAPSHOTS (SQLite): estado atual por empresa + log de mudanças
+# =========================================================
+_CAMPOS_CHAVE_SNAPSHOT = {
+    "pendencia": ("codigo", "ie", "periodo"),
+    "debito": ("ie", "nr_lancamento", "parcela"),
+}
+_SNAPSHOT_VERSAO_CHAVES = 1   # PRAGMA user_version: 1 = "ie" na chave do débito
+# links do portal carregam token de sessão: mudam a cada login sem o item mudar
+_CAMPOS_FORA_DO_HASH = ("url_dare", "url_extrato")
+
+def _itens_snapshot(tipo: str, itens: List[Dict[str, str]]) -> Dict[str, Tuple[str, str]]:
+    """
+    chave -> (hash, json) dos itens de um tipo; chaves repetidas ganham sufixo
+    #2, #3... na ordem do hash, não da resposta: as consultas por IE/ano
+    voltam em qualquer ordem e a mesma lista tem que dar as mesmas chaves.
+    """
+    calculados = []
+    for item in itens:
+        base = "|".join((item.get(c) or "").strip() for c in _CAMPOS_CHAVE_SNAPSHOT[tipo])
+        estavel = {k: v for k, v in item.items() if k not in _CAMPOS_FORA_DO_HASH}
+        h = hashlib.sha1(json.dumps(estavel, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        calculados.append((base, h, item))
+    out: Dict[str, Tuple[str, str]] = {}
+    for base, h, item in sorted(calculados, key=lambda c: (c[0], c[1])):
+        chave, n = base, 1
+        while chave in out:
+            n += 1
+            chave = f"{base}#{n}"
+        out[chave] = (h, json.dumps(item, ensure_ascii=False))
+    return out
 
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        resumo = (
-            f"DARES ZIP\n"
-            f"User: {user}\n"
-            f"Data: {date.today().isoformat()}\n"
-            f"Empresas (certificados): {empresas}\n"
-            f"Filtro vencimento: até hoje+{DIAS_MAX_FUTURO_DARE} dias\n"
-        )
-        zf.writestr("RESUMO.txt", resumo)
+class SnapshotStore:
+    """
+    Guarda, por certificado, as pendências e débitos da última execução
+    (tabela itens) e registra em `mudancas` só o que foi adicionado,
+    removido ou alterado em relação a ela. `seq` de mudancas é o cursor de
+    /fisconforme/changes?since=. Uma parte que deu erro (FisConforme ou
+    débitos) não é comparada, para não virar "tudo removido".
+    """
 
-        for cert in certs:
-            empresa = (cert.get("empresa") or "empresa").strip()
-            codi = str(cert.get("codi") or "0").strip()
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS itens (
+        cert_id TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        chave TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        dados TEXT NOT NULL,
+        visto_em REAL NOT NULL,
+        PRIMARY KEY (cert_id, tipo, chave)
+    );
+    CREATE TABLE IF NOT EXISTS mudancas (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        cert_id TEXT NOT NULL,
+        user TEXT NOT NULL,
+        empresa TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        chave TEXT NOT NULL,
+        acao TEXT NOT NULL,
+        dados TEXT,
+        anterior TEXT,
+        em REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_mudancas_user_seq ON mudancas (user, seq);
+    CREATE INDEX IF NOT EXISTS ix_mudancas_em ON mudancas (em);
+    CREATE TABLE IF NOT EXISTS execucoes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        cert_id TEXT NOT NULL,
+        user TEXT NOT NULL,
+        situacao_geral TEXT NOT NULL,
+        qtd_pendencias INTEGER NOT NULL,
+        qtd_debitos INTEGER NOT NULL,
+        mudancas INTEGER NOT NULL,
+        em REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_execucoes_cert ON execucoes (cert_id, seq);
+    """
 
-            cert_path = key_path = None
+    def __init__(self, caminho: str = SNAPSHOT_DB, retencao_dias: int = SNAPSHOT_RETENCAO_DIAS):
+        self.caminho = caminho
+        self.retencao_dias = retencao_dias
+        self._con: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._ultima_limpeza = 0.0
+
+    def _conexao(self) -> sqlite3.Connection:
+        if self._con is None:
+            pasta = os.path.dirname(self.caminho)
+            if pasta:
+                os.makedirs(pasta, exist_ok=True)
+            con = sqlite3.connect(self.caminho, check_same_thread=False, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.executescript(self._SCHEMA)
+            if con.execute("PRAGMA user_version").fetchone()[0] < _SNAPSHOT_VERSAO_CHAVES:
+                self._rechavear(con)
+            self._con = con
+        return self._con
+
+    def _rechavear(self, con: sqlite3.Connection):
+        """
+        Banco gravado com a chave antiga: recalcula as chaves de itens a partir
+        dos dados guardados, para a próxima execução não virar removido+adicionado.
+        """
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            grupos: Dict[Tuple[str, str], List[Tuple[str, float]]] = {}
+            for cert_id, tipo, dados, visto_em in con.execute("SELECT cert_id, tipo, dados, visto_em FROM itens"):
+                grupos.setdefault((cert_id, tipo), []).append((dados, visto_em))
+            for (cert_id, tipo), linhas in grupos.items():
+                novos = _itens_snapshot(tipo, [json.loads(d) for d, _ in linhas])
+                visto_em = max(v for _, v in linhas)
+                con.execute("DELETE FROM itens WHERE cert_id = ? AND tipo = ?", (cert_id, tipo))
+                con.executemany(
+                    "INSERT INTO itens (cert_id, tipo, chave, hash, dados, visto_em) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(cert_id, tipo, chave, h, d, visto_em) for chave, (h, d) in novos.items()],
+                )
+            con.execute(f"PRAGMA user_version = {_SNAPSHOT_VERSAO_CHAVES}")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+    def registrar(self, cert_row: Dict[str, Any], res: Dict[str, Any]) -> int:
+        """Compara o resultado com o último snapshot do cert e grava as diferenças. Devolve quantas."""
+        cert_id = _cert_id(cert_row)
+        if not cert_id or res.get("erro"):
+            return 0
+        partes: List[Tuple[str, List[Dict[str, str]]]] = []
+        if not res.get("erro_fisconforme"):
+            partes.append(("pendencia", res.get("pendencias") or []))
+        if not res.get("erro_debitos"):
+            partes.append(("debito", res.get("debitos") or []))
+
+        user = res.get("user") or ""
+        empresa = res.get("empresa") or ""
+        agora = time.time()
+        total = 0
+        with self._lock:
+            con = self._conexao()
+            con.execute("BEGIN IMMEDIATE")
             try:
-                cert_path, key_path = criar_arquivos_cert_temp(cert)
-                sess = criar_sessao(cert_path, key_path)
+                for tipo, itens in partes:
+                    novos = _itens_snapshot(tipo, itens)
+                    antigos = {
+                        chave: (h, dados)
+                        for chave, h, dados in con.execute(
+                            "SELECT chave, hash, dados FROM itens WHERE cert_id = ? AND tipo = ?", (cert_id, tipo)
+                        )
+                    }
+                    mud: List[Tuple[str, str, Optional[str], Optional[str]]] = []
+                    for chave, (h, dados) in novos.items():
+                        ant = antigos.get(chave)
+                        if ant is None:
+                            mud.append((chave, "adicionado", dados, None))
+                        elif ant[0] != h:
+                            mud.append((chave, "alterado", dados, ant[1]))
+                    for chave, (_, dados) in antigos.items():
+                        if chave not in novos:
+                            mud.append((chave, "removido", None, dados))
+
+                    con.executemany(
+                        "INSERT INTO mudancas (cert_id, user, empresa, tipo, chave, acao, dados, anterior, em) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(cert_id, user, empresa, tipo, chave, acao, d, a, agora) for chave, acao, d, a in mud],
+                    )
+                    con.execute("DELETE FROM itens WHERE cert_id = ? AND tipo = ?", (cert_id, tipo))
+                    con.executemany(
+                        "INSERT INTO itens (cert_id, tipo, chave, hash, dados, visto_em) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(cert_id, tipo, chave, h, dados, agora) for chave, (h, dados) in novos.items()],
+                    )
+                    total += len(mud)
+
+                con.execute(
+                    "INSERT INTO execucoes (cert_id, user, situacao_geral, qtd_pendencias, qtd_debitos, mudancas, em) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (cert_id, user, res.get("situacao_geral") or "", int(res.get("qtd_pendencias") or 0),
+                     int(res.get("qtd_debitos") or 0), total, agora),
+                )
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+            self._limpar_antigos(con, agora)
+        return total
+
+    def _limpar_antigos(self, con: sqlite3.Connection, agora: float):
+        if agora - self._ultima_limpeza < SNAPSHOT_INTERVALO_LIMPEZA_S:
+            return
+        self._ultima_limpeza = agora
+        limite = agora - self.retencao_dias * 86400
+        con.execute("DELETE FROM mudancas WHERE em < ?", (limite,))
+        con.execute("DELETE FROM execucoes WHERE em < ?", (limite,))
+
+    def mudancas(self, user: str, desde: int = 0, limite: int = SNAPSHOT_CHANGES_MAX) -> Tuple[List[Dict[str, Any]], int, bool]:
+        """Mudanças do user com seq > desde, em ordem. Devolve (mudancas, cursor, tem_mais)."""
+        limite = max(1, min(int(limite or 1), SNAPSHOT_CHANGES_MAX))
+        with self._lock:
+            con = self._conexao()
+            linhas = con.execute(
+                "SELECT seq, cert_id, empresa, tipo, chave, acao, dados, anterior, em FROM mudancas "
+                "WHERE user = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user, int(desde), limite + 1),
+            ).fetchall()
+            if not linhas:
+                ultimo = con.execute("SELECT COALESCE(MAX(seq), 0) FROM mudancas").fetchone()[0]
+        tem_mais = len(linhas) > limite
+        linhas = linhas[:limite]
+        out = [
+            {
+                "seq": seq,
+                "cert_id": cert_id,
+                "empresa": empresa,
+                "tipo": tipo,
+                "chave": chave,
+                "acao": acao,
+                "item": json.loads(dados) if dados else None,
+                "anterior": json.loads(anterior) if anterior else None,
+                "em": datetime.fromtimestamp(em).isoformat(timespec="seconds"),
+            }
+            for seq, cert_id, empresa, tipo, chave, acao, dados, anterior, em in linhas
+        ]
+        # sem mudanças: cursor avança até o fim do log (seq é global, não por user)
+        cursor = out[-1]["seq"] if out else max(int(desde), int(ultimo))
+        return out, cursor, tem_mais
+
+    def seq_em(self, quando: datetime) -> int:
+        """Último seq gravado antes de `quando` (para since=<data ISO>)."""
+        with self._lock:
+            con = self._conexao()
+            row = con.execute("SELECT MAX(seq) FROM mudancas WHERE em < ?", (quando.timestamp(),)).fetchone()
+        return int(row[0] or 0)
+
+    def fechar(self):
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+snapshots = SnapshotStore()
+
+def registrar_snapshot(cert_row: Dict[str, Any], res: Dict[str, Any]):
+    if not SNAPSHOT_ATIVO:
+        return
+    try:
+        res["mudancas"] = snapshots.registrar(cert_row, res)
+    except Exception as e:
+        print(f"[SNAPSHOT] falha ao gravar {_cert_id(cert_row)}: {e}")
 
-                if not abrir_acesso_digital_e_entrar(sess):
-                    raise RuntimeError("Falha ao entrar no Acesso Digital (DET)")
+_sem_fisconforme_global = threading.BoundedSemaphore(FISCONFORME_MAX_GLOBAL)
 
-                html_portal = ir_para_portal_e_carregar_home(sess)
-                if not html_portal:
-                    raise RuntimeError("Falha ao abrir Portal (LoginToken/home)")
+def _fluxo_fisconforme_limitado(cert_row: Dict[str, Any], refresh: bool = False) -> Dict[str, Any]:
+    chave = _cert_id(cert_row)
+    if chave and not refresh:
+        res = cache_resultados.obter(chave)
+        if res is not None:
+            return res
 
-                ano_atual = date.today().year
-                ano_ant = ano_atual - 1
-                deb_a, err_a = consultar_debitos_ano(sess, ano_atual)
-                deb_b, err_b = consultar_debitos_ano(sess, ano_ant)
+    with _sem_fisconforme_global:
+        res = fluxo_fisconforme(cert_row)
+    registrar_snapshot(cert_row, res)
+    res["cached_at"] = datetime.now().isoformat(timespec="seconds")
+    if chave:
+        cache_resultados.guardar(chave, res)
+    res["from_cache"] = False
+    res["cache_age_s"] = 0.0
+    return res
+
+def fluxo_fisconforme_varios(
+    certs: List[Dict[str, Any]],
+    workers: int = FISCONFORME_MAX_WORKERS,
+    refresh: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    fluxo_fisconforme em paralelo, mantendo a ordem de certs.
+    workers limita este request; _sem_fisconforme_global limita o processo.
+    Resultados do cache (refresh=False) não ocupam worker nem semáforo.
+    """
+    workers = max(1, min(int(workers or 1), FISCONFORME_MAX_WORKERS, len(certs) or 1))
+    if workers == 1:
+        return [_fluxo_fisconforme_limitado(c, refresh) for c in certs]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fisconforme") as ex:
+        return list(ex.map(lambda c: _fluxo_fisconforme_limitado(c, refresh), certs))
+
+def fluxo_fisconforme_conforme_termina(
+    certs: List[Dict[str, Any]],
+    workers: int = FISCONFORME_MAX_WORKERS,
+    refresh: bool = False,
+):
+    """
+    Gerador de (índice em certs, resultado) na ordem em que as empresas
+    terminam. No máximo 2*workers empresas em voo: resultado já entregue não
+    fica preso aqui, então a memória não cresce com a carteira. Fechar o
+    gerador (cliente desconectou) cancela o que ainda não começou.
+    """
+    workers = max(1, min(int(workers or 1), FISCONFORME_MAX_WORKERS, len(certs) or 1))
+    ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fisconforme-stream")
+    em_voo: Dict[Future, int] = {}
+    proximo = 0
+    try:
+        while proximo < len(certs) or em_voo:
+            while proximo < len(certs) and len(em_voo) < 2 * workers:
+                em_voo[ex.submit(_fluxo_fisconforme_limitado, certs[proximo], refresh)] = proximo
+                proximo += 1
+            prontos, _ = wait(list(em_voo), return_when=FIRST_COMPLETED)
+            for fut in prontos:
+                i = em_voo.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    res = _resultado_vazio(certs[i])
+                    res["erro"] = str(e)
+                yield i, res
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+def _linha_stream(dados: Dict[str, Any], formato: str, evento: str) -> bytes:
+    texto = json.dumps(dados, ensure_ascii=False, default=str)
+    if formato == "sse":
+        return f"event: {evento}\ndata: {texto}\n\n".encode("utf-8")
+    return (texto + "\n").encode("utf-8")
+
+def gerar_fisconforme_stream(
+    user: str,
+    certs: List[Dict[str, Any]],
+    workers: int = FISCONFORME_MAX_WORKERS,
+    refresh: bool = False,
+    timing: bool = False,
+    formato: str = "ndjson",
+):
+    """
+    Corpo do /fisconforme?stream=1: uma linha NDJSON (ou evento SSE
+    "empresa") por empresa assim que ela termina, com "indice" = posição na
+    lista de certificados, e uma linha final "resumo" com os totais.
+    """
+    t0 = time.perf_counter()
+    situacoes: Dict[str, int] = {}
+    do_cache = 0
+    for i, res in fluxo_fisconforme_conforme_termina(certs, workers=workers, refresh=refresh):
+        situacoes[res.get("situacao_geral") or ""] = situacoes.get(res.get("situacao_geral") or "", 0) + 1
+        do_cache += 1 if res.get("from_cache") else 0
+        # res pode ser o dict do cache_resultados: filtra numa cópia rasa
+        linha = {"tipo": "empresa", "indice": i, **{k: v for k, v in res.items() if timing or k != "tempos_ms"}}
+        yield _linha_stream(linha, formato, "empresa")
+    resumo = {
+        "tipo": "resumo",
+        "ok": True,
+        "user": user,
+        "total_empresas": len(certs),
+        "situacoes": situacoes,
+        "from_cache": do_cache,
+        "duracao_s": round(time.perf_counter() - t0, 3),
+    }
+    print(f"[FISCONFORME-STREAM] user={user} empresas={len(certs)} situacoes={situacoes} cache={do_cache}")
+    yield _linha_stream(resumo, formato, "resumo")
+
+def _resultado_do_dono(res: Dict[str, Any], row: Dict[str, Any], compartilhado: bool) -> Dict[str, Any]:
+    out = copy.deepcopy(res) if compartilhado else res
+    out.update({
+        "empresa": row.get("empresa") or "",
+        "user": row.get("user") or "",
+        "cnpj": row.get("cnpj/cpf") or "",
+        "codi": row.get("codi") or "",
+        "compartilhado": compartilhado,
+    })
+    return out
 
-                if err_a and err_b:
-                    raise RuntimeError(f"Consulta falhou nos 2 anos: {err_a} | {err_b}")
+def fluxo_fisconforme_lote(
+    users: List[str],
+    workers: int = FISCONFORME_MAX_WORKERS,
+    refresh: bool = False,
+) -> Tuple[Dict[str, List[Dict[str, Any]]], int]:
+    """
+    fluxo_fisconforme de vários users: uma query no Supabase, certificado
+    repetido entre users roda uma vez só e todas as empresas dividem o mesmo
+    pool. Devolve ({user: resultados na ordem das empresas dele}, empresas únicas).
+    """
+    por_user = carregar_certificados_varios_users(users)
+    unicos, donos = agrupar_certificados_compartilhados(por_user)
+    resultados = fluxo_fisconforme_varios(unicos, workers=workers, refresh=refresh)
+
+    por_cert: Dict[str, Dict[str, Any]] = {}
+    for rep, res in zip(unicos, resultados):
+        rep_id = _cert_id(rep)
+        compartilhado = len(donos.get(rep_id) or []) > 1
+        for user, row in donos.get(rep_id) or [(rep.get("user") or "", rep)]:
+            r = _resultado_do_dono(res, row, compartilhado)
+            # snapshot do rep já foi gravado no fluxo; os outros ids também precisam do seu
+            if row is not rep and not r.get("from_cache"):
+                registrar_snapshot(row, r)
+            por_cert[_cert_id(row)] = r
+    out = {u: [por_cert[_cert_id(row)] for row in rows] for u, rows in por_user.items()}
+    return out, len(unicos)
 
-                todos = (deb_a or []) + (deb_b or [])
-                if not todos:
-                    continue
+# =========================================================
+# ZIP DARES (com relatório dentro)
+# =========================================================
+class PdfPronto:
+    """PDF esperando o writer do ZIP: bytes em memória ou arquivo no scratch da execução."""
+
+    __slots__ = ("dados", "caminho", "tamanho", "_orcamento")
+
+    def __init__(self, dados: Optional[bytes], caminho: Optional[str], tamanho: int, orcamento=None):
+        self.dados = dados
+        self.caminho = caminho
+        self.tamanho = tamanho
+        self._orcamento = orcamento
+
+    # modo process: atravessa o pickle sem o orçamento (que é do processo filho)
+    def __getstate__(self):
+        return (self.dados, self.caminho, self.tamanho)
+
+    def __setstate__(self, estado):
+        self.dados, self.caminho, self.tamanho = estado
+        self._orcamento = None
+
+    def ler(self) -> bytes:
+        if self.dados is not None:
+            return self.dados
+        with open(self.caminho, "rb") as f:
+            return f.read()
+
+    def descartar(self):
+        if self.dados is not None:
+            self.dados = None
+            if self._orcamento is not None:
+                self._orcamento.liberar(self.tamanho)
+        elif self.caminho:
+            try:
+                os.remove(self.caminho)
+            except Exception:
+                pass
+            self.caminho = None
 
-                pasta_emp = os.path.join(tmpdir, f"{_slug(codi)}_{_slug(empresa)[:30]}")
-                os.makedirs(pasta_emp, exist_ok=True)
+class OrcamentoPdfs:
+    """
+    Teto de memória para os PDFs prontos que ainda não entraram no ZIP. Abaixo
+    de max_bytes o PDF fica em memória; acima, vai para um arquivo em pasta
+    (scratch da execução, apagado no fim). O writer libera ao gravar.
+    """
 
-                for deb in todos:
-                    try:
-                        pdf_path = gerar_pdf_dare_e_extrato(sess, deb, pasta_emp)
-                        if pdf_path and os.path.exists(pdf_path):
-                            arcname = os.path.join(os.path.basename(pasta_emp), os.path.basename(pdf_path))
-                            zf.write(pdf_path, arcname=arcname)
-                            pdfs += 1
-                    except Exception as e_pdf:
-                        erros += 1
-                        erros_list.append({
-                            "empresa": empresa,
-                            "codi": codi,
-                            "erro": f"PDF DARE/Extrato: {str(e_pdf)}"
-                        })
-
-            except Exception as e_emp:
-                erros += 1
-                erros_list.append({
-                    "empresa": empresa,
-                    "codi": codi,
-                    "erro": str(e_emp)
-                })
-            finally:
-                try:
-                    if cert_path and os.path.exists(cert_path): os.remove(cert_path)
-                    if key_path and os.path.exists(key_path): os.remove(key_path)
-                except Exception:
-                    pass
+    def __init__(self, pasta: str, max_bytes: int = PDF_MEMORIA_MAX_MB * 1024 * 1024):
+        self.pasta = pasta
+        self.max_bytes = max_bytes
+        self.em_memoria = 0
+        self.pico = 0
+        self.em_disco = 0
+        self._lock = threading.Lock()
+
+    def guardar(self, dados: bytes) -> PdfPronto:
+        n = len(dados)
+        with self._lock:
+            if self.em_memoria + n <= self.max_bytes:
+                self.em_memoria += n
+                self.pico = max(self.pico, self.em_memoria)
+                return PdfPronto(dados, None, n, self)
+            self.em_disco += 1
+        METRICA_PDFS_DISCO.inc()
+        os.makedirs(self.pasta, exist_ok=True)
+        caminho = os.path.join(self.pasta, f"pdf_{uuid.uuid4().hex}.pdf")
+        with open(caminho, "wb") as f:
+            f.write(dados)
+        return PdfPronto(None, caminho, n)
+
+    def liberar(self, n: int):
+        with self._lock:
+            self.em_memoria -= n
+
+def otimizar_pdf(writer: "PdfWriter"):
+    """Uma cópia só de cada objeto idêntico (logo da SEFIN, fontes) + remove órfãos."""
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+def otimizar_pdf_bytes(dados: bytes) -> bytes:
+    from pypdf import PdfReader, PdfWriter
+
+    writer = PdfWriter(clone_from=PdfReader(io.BytesIO(dados)))
+    otimizar_pdf(writer)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+class ArquivoDares:
+    """
+    Como os PDFs de cada empresa entram no ZIP de saída:
 
-        if erros_list:
-            linhas = []
-            for e in erros_list:
-                linhas.append(f"Empresa: {e.get('empresa')} | CODI: {e.get('codi')} | Erro: {e.get('erro')}")
-            zf.writestr("RELATORIO_ERROS.txt", "\n".join(linhas))
-        else:
-            zf.writestr("RELATORIO_ERROS.txt", "Sem erros.\n")
-
-        resumo_final = (
-            f"DARES ZIP\n"
-            f"User: {user}\n"
-            f"Data: {date.today().isoformat()}\n"
-            f"Empresas (certificados): {empresas}\n"
-            f"PDFs gerados: {pdfs}\n"
-            f"Erros: {erros}\n"
-            f"Filtro vencimento: até hoje+{DIAS_MAX_FUTURO_DARE} dias\n"
-            f"\nObs: veja RELATORIO_ERROS.txt para detalhes.\n"
-        )
-        zf.writestr("RESUMO_FINAL.txt", resumo_final)
+      deflate          um PDF por débito, ZIP_DEFLATED (padrão antigo)
+      store            um PDF por débito, sem recomprimir (PDF já é comprimido)
+      zip_por_empresa  um <empresa>.zip (store) por empresa dentro do ZIP
+      pdf_por_empresa  um <empresa>.pdf com todos os DAREs da empresa
 
-    return zip_path, zip_name, empresas, pdfs, erros, erros_list
+    otimizar passa o PDF (ou o PDF combinado) por otimizar_pdf. Mede
+    bytes de entrada/saída e tempo gasto aqui para o RESUMO_FINAL.txt.
+    Só o writer do ZIP chama; nos modos por empresa os PDFs ficam
+    guardados (PdfPronto, dentro do orçamento) até fechar_empresa().
+    """
 
-# =========================================================
-# FASTAPI
-# =========================================================
+    MODOS = ("deflate", "store", "zip_por_empresa", "pdf_por_empresa")
+
+    def __init__(self, zf: zipfile.ZipFile, modo: str = DARES_ARQUIVO_MODO, otimizar: bool = DARES_PDF_OTIMIZAR):
+        if modo not in self.MODOS:
+            raise ValueError(f"modo de arquivo inválido: {modo} (use {', '.join(self.MODOS)})")
+        self.zf = zf
+        self.modo = modo
+        self.otimizar = otimizar
+        self.compressao = zipfile.ZIP_DEFLATED if modo == "deflate" else zipfile.ZIP_STORED
+        self._empresas: Dict[str, List[Tuple[str, PdfPronto]]] = {}
+        self.bytes_pdfs = 0
+        self.bytes_zip = 0
+        self.tempo_s = 0.0
+
+    def _gravar(self, arcname: str, dados: bytes):
+        self.zf.writestr(arcname, dados, compress_type=self.compressao)
+        self.bytes_zip += self.zf.filelist[-1].compress_size
+
+    def _gravar_pdf(self, arcname: str, pdf: PdfPronto):
+        try:
+            if self.otimizar:
+                self._gravar(arcname, otimizar_pdf_bytes(pdf.ler()))
+            elif pdf.dados is not None:
+                self._gravar(arcname, pdf.dados)
+            else:
+                self.zf.write(pdf.caminho, arcname=arcname, compress_type=self.compressao)
+                self.bytes_zip += self.zf.filelist[-1].compress_size
+        finally:
+            pdf.descartar()
+
+    def adicionar(self, pasta: str, nome: str, pdf: PdfPronto):
+        t0 = time.perf_counter()
+        self.bytes_pdfs += pdf.tamanho
+        try:
+            if self.modo in ("zip_por_empresa", "pdf_por_empresa"):
+                self._empresas.setdefault(pasta, []).append((nome, pdf))
+            else:
+                self._gravar_pdf(f"{pasta}/{nome}", pdf)
+        finally:
+            self.tempo_s += time.perf_counter() - t0
+
+    def fechar_empresa(self, pasta: str):
+        itens = self._empresas.pop(pasta, None)
+        if not itens:
+            return
+        t0 = time.perf_counter()
+        try:
+            if self.modo == "zip_por_empresa":
+                info = zipfile.ZipInfo(f"{pasta}.zip", date_time=time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                with self.zf.open(info, "w", force_zip64=True) as destino:
+                    with zipfile.ZipFile(destino, "w", zipfile.ZIP_STORED) as interno:
+                        for nome, pdf in itens:
+                            dados = pdf.ler()
+                            interno.writestr(nome, otimizar_pdf_bytes(dados) if self.otimizar else dados)
+                self.bytes_zip += self.zf.filelist[-1].compress_size
+            else:
+                from pypdf import PdfReader, PdfWriter
+
+                writer = PdfWriter()
+                for _nome, pdf in itens:
+                    writer.append(PdfReader(io.BytesIO(pdf.ler())))
+                if self.otimizar:
+                    otimizar_pdf(writer)
+                buf = io.BytesIO()
+                writer.write(buf)
+                self._gravar(f"{pasta}.pdf", buf.getvalue())
+        finally:
+            for _nome, pdf in itens:
+                pdf.descartar()
+            self.tempo_s += time.perf_counter() - t0
+
+    def texto_resumo(self) -> str:
+        mb = 1024 * 1024
+        razao = f" ({self.bytes_zip / self.bytes_pdfs:.1%})" if self.bytes_pdfs else ""
+        return (
+            f"Arquivo: {self.modo}{' + otimização de objetos idênticos' if self.otimizar else ''}\n"
+            f"PDFs originais: {self.bytes_pdfs / mb:.2f} MB -> no ZIP: {self.bytes_zip / mb:.2f} MB{razao}\n"
+            f"Tempo de arquivamento (compressão/merge/otimização): {self.tempo_s:.2f} s\n"
+        )
+
+def _processar_empresa_dares(
+    cert: Dict[str, Any],
+    tmpdir: str,
+    orcamento: Optional[OrcamentoPdfs] = None,
+) -> Dict[str, Any]:
+    """
+    Login (ou sessão do cache) + débitos + PDFs de UMA empresa.
+    Não toca no ZIP: devolve os PDFs gerados ([(PdfPronto, nome)]) e os
+    erros para o writer. Sem orcamento (modo process) usa um só desta
+    empresa, com o teto dividido pelos workers.
+    """
+    empresa = (cert.get("empresa") or "empresa").strip()
+    codi = str(cert.get("codi") or "0").strip()
+    out: Dict[str, Any] = {
+        "id": _cert_id(cert), "empresa": empresa, "codi": codi, "pdfs": [], "erros": [], "cache_hits": 0, "spans": [],
+    }
+    crono = Cronometro("dares")
+
+    try:
+        t_sessao = time.perf_counter()
+        with cache_sessoes.sessao(cert) as (sess, _html_portal):
+            crono.registrar("sessao", time.perf_counter() - t_sessao)
+            if orcamento is None:
+                orcamento = OrcamentoPdfs(tmpdir, PDF_MEMORIA_MAX_MB * 1024 * 1024 // DARES_MAX_WORKERS_LIMITE)
+            _gerar_pdfs_empresa(sess, _cert_id(cert), empresa, codi, orcamento, out, crono)
+    except Exception as e_emp:
+        out["erros"].append({
+            "empresa": empresa,
+            "codi": codi,
+            "erro": str(e_emp)
+        })
+
+    # spans vão para o histograma no writer (processo pai, mesmo no modo process)
+    out["spans"] = crono.spans
+    return out
+
+def _gerar_pdfs_empresa(
+    sess: requests.Session,
+    cert_id: str,
+    empresa: str,
+    codi: str,
+    orcamento: OrcamentoPdfs,
+    out: Dict[str, Any],
+    crono: Optional[Cronometro] = None,
+):
+    crono = crono or Cronometro("dares")
+    anos = anos_consulta_debitos()
+    with crono.etapa("debitos"):
+        todos, erros_cons = consultar_debitos_anos(sess, anos)
+
+    if todos is None:
+        raise RuntimeError(f"Consulta de débitos falhou ({len(anos)} anos): " + " | ".join(erros_cons[:4]))
+    for e in erros_cons:
+        out["erros"].append({"empresa": empresa, "codi": codi, "erro": f"Consulta parcial: {e}"})
+
+    if not todos:
+        return
+
+    usados = set()
+
+    for deb in todos:
+        try:
+            pdf_bytes = gerar_pdf_dare_bytes(sess, deb, cert_id=cert_id, stats=out, crono=crono)
+            if pdf_bytes is None:
+                continue
+            nome = _nome_pdf_unico(_nome_pdf_dare(deb), usados)
+            out["pdfs"].append((orcamento.guardar(pdf_bytes), nome))
+        except Exception as e_pdf:
+            out["erros"].append({
+                "empresa": empresa,
+                "codi": codi,
+                "erro": f"PDF DARE/Extrato: {str(e_pdf)}"
+            })
+
+def _iterar_empresas(func, itens: List[Any], modo: str, workers: int, *args):
+    """
+    Roda func(item, *args) para cada item e devolve os resultados conforme terminam.
+    modo: "serial" | "thread" | "process" ("pipeline" não passa por aqui).
+    """
+    # valida antes do atalho serial: o mesmo modo ruim falha com 1 ou com N empresas
+    if modo not in ("serial", "thread", "process"):
+        raise ValueError(f"modo de execução inválido: {modo}")
+    workers = max(1, min(int(workers or 1), DARES_MAX_WORKERS_LIMITE))
+    if modo == "serial" or workers == 1 or len(itens) <= 1:
+        for item in itens:
+            yield func(item, *args)
+        return
+
+    if modo == "process":
+        # spawn: o filho não herda threads do pai (pool Chromium, uvicorn)
+        ex = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dares")
+
+    with ex:
+        futs = [ex.submit(func, item, *args) for item in itens]
+        for fut in as_completed(futs):
+            yield fut.result()
+
+# =========================================================
+# PIPELINE DARES: http -> captcha -> dom -> render -> archive
+# =========================================================
+def _pasta_empresa_zip(codi: str, empresa: str) -> str:
+    return f"{_slug(codi)}_{_slug(empresa)[:30]}"
+
+class _EmpresaPipeline:
+    """
+    Uma empresa dentro do pipeline. A sessão do cache_sessoes fica presa
+    (exclusiva) até o último débito dela chegar no archive. O estágio http
+    só escreve debitos_enviados antes de mandar o item de fim de listagem;
+    o resto dos contadores é só do writer, então não precisa de lock.
+    captcha_fila/captcha_ativo (sob _lock) garantem um DARE por vez na
+    sessão: o captcha fica na sessão do dare e um GET novo invalida o
+    pendente.
+    """
+
+    def __init__(self, cert: Dict[str, Any]):
+        self.cert = cert
+        self.cert_id = _cert_id(cert)
+        self.empresa = (cert.get("empresa") or "empresa").strip()
+        self.codi = str(cert.get("codi") or "0").strip()
+        self.pasta_zip = _pasta_empresa_zip(self.codi, self.empresa)
+        self.crono = Cronometro("dares")
+        self.sess: Optional[requests.Session] = None
+        self._ctx = None
+        self.debitos_enviados = 0
+        self.debitos_recebidos = 0
+        self.listagem_recebida = False
+        self.pdfs = 0
+        self.cache_hits = 0
+        self.erros: List[Dict[str, str]] = []
+        self.nomes: set = set()
+        self.captcha_fila: "deque[_ItemDare]" = deque()
+        self.captcha_ativo = False
+        self._lock = threading.Lock()
+
+    def abrir_sessao(self):
+        t0 = time.perf_counter()
+        self._ctx = cache_sessoes.sessao(self.cert)
+        self.sess, _html_portal = self._ctx.__enter__()
+        self.crono.registrar("sessao", time.perf_counter() - t0)
+
+    def fechar_sessao(self, falhou: bool = False):
+        ctx, self._ctx = self._ctx, None
+        if ctx is None:
+            return
+        if falhou:
+            cache_sessoes.invalidar(self.cert)
+        ctx.__exit__(None, None, None)
+
+    def erro(self, msg: str):
+        self.erros.append({"empresa": self.empresa, "codi": self.codi, "erro": msg})
+
+    def nome_unico(self, nome_pdf: str) -> str:
+        return _nome_pdf_unico(nome_pdf, self.nomes)
+
+class _ItemDare:
+    """Um débito atravessando os estágios; cada estágio preenche o que o próximo usa."""
+
+    __slots__ = ("emp", "deb", "chave", "html", "html_ext", "body_dare", "body_ext", "pdf", "origem", "erro", "fim_listagem")
+
+    def __init__(self, emp: _EmpresaPipeline, deb: Optional[Dict[str, str]] = None):
+        self.emp = emp
+        self.deb = deb
+        self.chave: Optional[str] = None
+        self.html: Optional[str] = None
+        self.html_ext: Optional[str] = None
+        self.body_dare: Optional[str] = None
+        self.body_ext: Optional[str] = None
+        self.pdf: Optional[PdfPronto] = None
+        self.origem = "render"
+        self.erro: Optional[str] = None
+        self.fim_listagem = deb is None
+
+class _Estagio:
+    """Fila limitada + N workers. Mede fila (atual/pico), itens e tempo ocupado."""
+
+    def __init__(self, nome: str, workers: int, func: Callable[[Any], None], cancelado: threading.Event):
+        self.nome = nome
+        self.workers = max(1, int(workers))
+        self.func = func
+        self.cancelado = cancelado
+        self.fila: "queue.Queue" = queue.Queue(maxsize=PIPELINE_FILA_MAX)
+        self.fila_pico = 0
+        self.itens = 0
+        self.ocupado_s = 0.0
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def iniciar(self):
+        for i in range(self.workers):
+            th = threading.Thread(target=self._loop, name=f"pipeline-{self.nome}-{i}", daemon=True)
+            th.start()
+            self._threads.append(th)
+
+    def colocar(self, item: Any):
+        while True:
+            if self.cancelado.is_set():
+                raise RuntimeError("Pipeline DARES cancelado")
+            try:
+                self.fila.put(item, timeout=1)
+                break
+            except queue.Full:
+                continue
+        n = self.fila.qsize()
+        METRICA_PIPELINE_FILA.labels(self.nome).set(n)
+        if n > self.fila_pico:
+            self.fila_pico = n
+
+    def _loop(self):
+        while True:
+            item = self.fila.get()
+            METRICA_PIPELINE_FILA.labels(self.nome).set(self.fila.qsize())
+            if item is None:
+                return
+            if self.cancelado.is_set():
+                continue
+            t0 = time.perf_counter()
+            try:
+                self.func(item)
+            except Exception as e:
+                if not self.cancelado.is_set():
+                    print(f"[PIPELINE] {self.nome}: {e}")
+            dt = time.perf_counter() - t0
+            METRICA_PIPELINE_OCUPADO.labels(self.nome).inc(dt)
+            with self._lock:
+                self.itens += 1
+                self.ocupado_s += dt
+
+    def parar(self):
+        for _ in self._threads:
+            self.fila.put(None)
+        for th in self._threads:
+            th.join()
+        self._threads.clear()
+
+    def status(self, decorrido: float) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "fila": self.fila.qsize(),
+            "fila_pico": self.fila_pico,
+            "itens": self.itens,
+            "ocupacao": round(self.ocupado_s / (self.workers * decorrido), 3) if decorrido > 0 else 0.0,
+        }
+
+class PipelineDares:
+    """
+    gerar_zip_dares em estágios sobrepostos, com fila limitada entre eles:
+
+      http    login/sessão + débitos da empresa (PDFs do cache já vão para o ZIP)
+      captcha GET do DARE + solver + POST (retentativas incluídas) e extrato,
+              um débito por vez em cada sessão, empresas em paralelo
+      dom     2 vias do DARE + corpo do extrato
+      render  pool Chromium (bytes do page.pdf())
+      archive o chamador de executar(): único writer do ZIP
+
+    Enquanto um DARE renderiza, os captchas das outras empresas já estão no
+    solver. Dentro da empresa o captcha é sequencial: o dare guarda o captcha
+    na sessão e cada GET invalida o anterior.
+    Fila cheia trava o estágio anterior (backpressure), então a memória fica
+    limitada a ~PIPELINE_FILA_MAX itens por estágio. status() traz fila e
+    ocupação por estágio.
+    """
+
+    def __init__(self, certs: List[Dict[str, Any]], workers: int, orcamento: OrcamentoPdfs):
+        self.certs = certs
+        self.orcamento = orcamento
+        self.cancelado = threading.Event()
+        self.t0 = 0.0
+        workers = max(1, min(int(workers or 1), DARES_MAX_WORKERS_LIMITE))
+        self.archive: "queue.Queue[_ItemDare]" = queue.Queue(maxsize=PIPELINE_FILA_MAX)
+        self.archive_pico = 0
+        self.archive_itens = 0
+        self.archive_ocupado_s = 0.0
+        self.estagios = {
+            "http": _Estagio("http", workers, self._http, self.cancelado),
+            "captcha": _Estagio("captcha", PIPELINE_WORKERS_CAPTCHA, self._captcha, self.cancelado),
+            "dom": _Estagio("dom", PIPELINE_WORKERS_DOM, self._dom, self.cancelado),
+            "render": _Estagio("render", PIPELINE_WORKERS_RENDER or POOL_CHROMIUM_TAMANHO, self._render, self.cancelado),
+        }
+
+    # ---- estágios (threads dos workers) ----
+    def _para_archive(self, item: _ItemDare):
+        while True:
+            if self.cancelado.is_set():
+                raise RuntimeError("Pipeline DARES cancelado")
+            try:
+                self.archive.put(item, timeout=1)
+                break
+            except queue.Full:
+                continue
+        n = self.archive.qsize()
+        METRICA_PIPELINE_FILA.labels("archive").set(n)
+        if n > self.archive_pico:
+            self.archive_pico = n
+
+    def _falhar(self, item: _ItemDare, etapa: str, e: Exception):
+        item.erro = f"PDF DARE/Extrato ({etapa}): {e}"
+        self._para_archive(item)
+
+    def _http(self, emp: _EmpresaPipeline):
+        fim = _ItemDare(emp)
+        todos: List[Dict[str, str]] = []
+        try:
+            emp.abrir_sessao()
+            anos = anos_consulta_debitos()
+            with emp.crono.etapa("debitos"):
+                todos, erros_cons = consultar_debitos_anos(emp.sess, anos)
+            if todos is None:
+                raise RuntimeError(f"Consulta de débitos falhou ({len(anos)} anos): " + " | ".join(erros_cons[:4]))
+            for e in erros_cons:
+                emp.erro(f"Consulta parcial: {e}")
+        except Exception as e:
+            fim.erro = str(e)
+            self._para_archive(fim)
+            return
+
+        for deb in todos:
+            if self.cancelado.is_set():
+                break
+            url_dare = (deb.get("url_dare") or "").strip()
+            if not url_dare or not _dare_no_prazo(deb):
+                continue
+            item = _ItemDare(emp, deb)
+            emp.debitos_enviados += 1
+            try:
+                # mesmo débito já gerado hoje para este certificado: direto para o ZIP
+                item.chave = chave_pdf_dare(emp.cert_id, deb) if emp.cert_id else None
+                if item.chave:
+                    em_cache = cache_pdf_dare.obter(item.chave)
+                    if em_cache is not None:
+                        item.pdf, item.origem = self.orcamento.guardar(em_cache), "cache"
+                        self._para_archive(item)
+                        continue
+            except Exception as e:
+                self._falhar(item, "http", e)
+                continue
+            self.estagios["captcha"].colocar(item)
+
+        self._para_archive(fim)
+
+    def _captcha(self, item: _ItemDare):
+        """
+        Um débito por vez na sessão da empresa. Item de empresa que já tem
+        captcha em andamento entra na captcha_fila dela e o worker fica
+        livre para outra empresa; quem está com a vez esvazia a fila.
+        """
+        emp = item.emp
+        with emp._lock:
+            if emp.captcha_ativo:
+                emp.captcha_fila.append(item)
+                return
+            emp.captcha_ativo = True
+        proximo: Optional[_ItemDare] = item
+        try:
+            while proximo is not None and not self.cancelado.is_set():
+                self._captcha_um(proximo)
+                with emp._lock:
+                    proximo = emp.captcha_fila.popleft() if emp.captcha_fila else None
+                    if proximo is None:
+                        emp.captcha_ativo = False
+        finally:
+            if proximo is not None:
+                # cancelado ou exceção: devolve a vez sem processar o resto
+                with emp._lock:
+                    emp.captcha_ativo = False
+
+    def _captcha_um(self, item: _ItemDare):
+        emp = item.emp
+        try:
+            # GET do DARE aqui, logo antes de resolver: um GET antecipado invalidaria o captcha pendente
+            with emp.crono.etapa("captcha"):
+                item.html = carregar_html_dare_final(emp.sess, item.deb["url_dare"].strip(), max_tentativas=5)
+            url_ext = (item.deb.get("url_extrato") or "").strip()
+            if url_ext:
+                with emp.crono.etapa("extrato"):
+                    r_ext = emp.sess.get(url_ext, timeout=30, allow_redirects=True)
+                if r_ext.status_code == 200:
+                    item.html_ext = r_ext.text
+        except Exception as e:
+            self._falhar(item, "captcha", e)
+            return
+        self.estagios["dom"].colocar(item)
+
+    def _dom(self, item: _ItemDare):
+        try:
+            with item.emp.crono.etapa("dom"):
+                item.body_dare = preparar_dare_duas_vias(item.html)
+                if item.html_ext is not None:
+                    item.body_ext = _body_extrato(item.html_ext)
+            item.html = item.html_ext = None
+        except Exception as e:
+            self._falhar(item, "dom", e)
+            return
+        self.estagios["render"].colocar(item)
+
+    def _render(self, item: _ItemDare):
+        try:
+            pdf_bytes = _pdf_dare_bytes(item.body_dare, item.body_ext, item.emp.crono)
+            item.body_dare = item.body_ext = None
+            if item.chave:
+                cache_pdf_dare.guardar(item.chave, pdf_bytes)
+            item.pdf = self.orcamento.guardar(pdf_bytes)
+        except Exception as e:
+            self._falhar(item, "render", e)
+            return
+        self._para_archive(item)
+
+    # ---- archive (thread chamadora) ----
+    def executar(self, arquivo: ArquivoDares, empresa_concluida: Callable[[_EmpresaPipeline], None]):
+        """Roda o pipeline passando cada PDF ao arquivo assim que chega; chama empresa_concluida por empresa."""
+        self.t0 = time.perf_counter()
+        for est in self.estagios.values():
+            est.iniciar()
+
+        def _alimentar():
+            for cert in self.certs:
+                try:
+                    self.estagios["http"].colocar(_EmpresaPipeline(cert))
+                except RuntimeError:
+                    return
+
+        alimentador = threading.Thread(target=_alimentar, name="pipeline-alimentador", daemon=True)
+        alimentador.start()
+
+        abertas: Dict[int, _EmpresaPipeline] = {}
+        restantes = len(self.certs)
+        try:
+            while restantes:
+                item = self.archive.get()
+                METRICA_PIPELINE_FILA.labels("archive").set(self.archive.qsize())
+                t0 = time.perf_counter()
+                emp = item.emp
+                abertas[id(emp)] = emp
+                if item.erro:
+                    emp.erro(item.erro)
+                elif item.pdf is not None:
+                    arquivo.adicionar(emp.pasta_zip, emp.nome_unico(_nome_pdf_dare(item.deb)), item.pdf)
+                    emp.pdfs += 1
+                    if item.origem == "cache":
+                        emp.cache_hits += 1
+                    METRICA_PDFS.labels(item.origem).inc()
+                    item.pdf = None
+                emp.crono.registrar("zip", time.perf_counter() - t0)
+                self.archive_ocupado_s += time.perf_counter() - t0
+                self.archive_itens += 1
+
+                if item.fim_listagem:
+                    emp.listagem_recebida = True
+                else:
+                    emp.debitos_recebidos += 1
+                if emp.listagem_recebida and emp.debitos_recebidos == emp.debitos_enviados:
+                    emp.fechar_sessao(falhou=item.fim_listagem and bool(item.erro))
+                    t_fechar = time.perf_counter()
+                    arquivo.fechar_empresa(emp.pasta_zip)
+                    emp.crono.registrar("zip", time.perf_counter() - t_fechar)
+                    del abertas[id(emp)]
+                    restantes -= 1
+                    empresa_concluida(emp)
+        finally:
+            self.cancelado.set()
+            for est in self.estagios.values():
+                est.parar()
+            alimentador.join()
+            for emp in abertas.values():
+                emp.fechar_sessao()
+            for nome in list(self.estagios) + ["archive"]:
+                METRICA_PIPELINE_FILA.labels(nome).set(0)
+
+    def status(self) -> Dict[str, Any]:
+        decorrido = time.perf_counter() - self.t0 if self.t0 else 0.0
+        out = {nome: est.status(decorrido) for nome, est in self.estagios.items()}
+        out["archive"] = {
+            "workers": 1,
+            "fila": self.archive.qsize(),
+            "fila_pico": self.archive_pico,
+            "itens": self.archive_itens,
+            "ocupacao": round(self.archive_ocupado_s / decorrido, 3) if decorrido > 0 else 0.0,
+        }
+        return out
+
+def _rodar_dares(
+    certs: List[Dict[str, Any]],
+    workers: int,
+    modo: str,
+    tmpdir: str,
+    arquivo: "ArquivoDares",
+    empresa_concluida: Callable[[Dict[str, Any]], None],
+):
+    """
+    Roda as empresas (PipelineDares no modo "pipeline", senão o pool de
+    _iterar_empresas) mandando os PDFs para arquivo (adicionar/fechar_empresa).
+    empresa_concluida recebe, por empresa, {"id", "empresa", "codi", "pdfs"
+    (quantidade), "cache_hits", "erros", "spans"} e, no pipeline, "pipeline"
+    (fila e ocupação por estágio). Os PDFs chegam em memória (OrcamentoPdfs:
+    disco em tmpdir só acima de PDF_MEMORIA_MAX_MB) e são liberados assim que
+    entram no ZIP.
+    """
+    orcamento = OrcamentoPdfs(tmpdir)
+
+    if modo == "pipeline":
+        pipeline = PipelineDares(certs, workers, orcamento)
+        pipeline.executar(arquivo, lambda emp: empresa_concluida({
+            "id": emp.cert_id, "empresa": emp.empresa, "codi": emp.codi, "pdfs": emp.pdfs,
+            "cache_hits": emp.cache_hits, "erros": emp.erros, "spans": emp.crono.spans,
+            "pipeline": pipeline.status(),
+        }))
+        st = pipeline.status()
+        print("[PIPELINE] " + " | ".join(
+            f"{nome} fila_pico={e['fila_pico']} ocupacao={e['ocupacao']:.0%}" for nome, e in st.items()
+        ))
+    else:
+        # processo filho não enxerga este orçamento: cada empresa leva o seu
+        orc_empresa = None if modo == "process" else orcamento
+        for res_emp in _iterar_empresas(_processar_empresa_dares, certs, modo, workers, tmpdir, orc_empresa):
+            t_zip = time.perf_counter()
+            pasta = _pasta_empresa_zip(res_emp["codi"], res_emp["empresa"])
+            for pdf, nome in res_emp["pdfs"]:
+                arquivo.adicionar(pasta, nome, pdf)
+            arquivo.fechar_empresa(pasta)
+            res_emp["spans"] = list(res_emp.get("spans") or []) + [("zip", time.perf_counter() - t_zip)]
+            res_emp["pdfs"] = len(res_emp["pdfs"])
+            empresa_concluida(res_emp)
+
+    if orcamento.em_disco:
+        print(f"[ZIP] {orcamento.em_disco} PDFs passaram do teto de {orcamento.max_bytes // (1024 * 1024)} MB e foram para disco")
+
+def _escrever_zip_dares(
+    zf: zipfile.ZipFile,
+    user: str,
+    certs: List[Dict[str, Any]],
+    workers: int,
+    modo: str,
+    tmpdir: str,
+    progresso: Optional[Callable[[Dict[str, Any]], None]] = None,
+    tempos: Optional[List[Dict[str, Any]]] = None,
+    arquivo_modo: str = DARES_ARQUIVO_MODO,
+    otimizar: bool = DARES_PDF_OTIMIZAR,
+) -> Tuple[int, int, List[Dict[str, str]]]:
+    """
+    Escreve o conteúdo do ZIP de DARES em zf (arquivo ou stream), com os PDFs
+    organizados conforme arquivo_modo (ArquivoDares).
+    Único writer: só a thread chamadora mexe no zf (_rodar_dares). tempos
+    recebe {"empresa", "codi", "tempos_ms"} por empresa; no modo pipeline
+    progresso também recebe "pipeline" (fila e ocupação por estágio).
+    """
+    tot = {"pdfs": 0, "erros": 0, "cache_hits": 0, "concluidas": 0}
+    empresas = len(certs)
+    erros_list: List[Dict[str, str]] = []
+    arquivo = ArquivoDares(zf, arquivo_modo, otimizar)
+
+    def _concluida(res_emp: Dict[str, Any]):
+        exportar_spans("dares", res_emp["spans"])
+        if tempos is not None:
+            tempos.append({"empresa": res_emp["empresa"], "codi": res_emp["codi"], "tempos_ms": tempos_ms(res_emp["spans"])})
+        tot["pdfs"] += res_emp["pdfs"]
+        tot["cache_hits"] += res_emp.get("cache_hits", 0)
+        tot["erros"] += len(res_emp["erros"])
+        tot["concluidas"] += 1
+        erros_list.extend(res_emp["erros"])
+        if progresso:
+            p = {
+                "empresas_concluidas": tot["concluidas"], "pdfs": tot["pdfs"], "cache_hits": tot["cache_hits"],
+                "erros": tot["erros"], "erros_list": erros_list,
+            }
+            if "pipeline" in res_emp:
+                p["pipeline"] = res_emp["pipeline"]
+            progresso(p)
+
+    zf.writestr("RESUMO.txt", _texto_resumo_zip(user, empresas))
+    _rodar_dares(certs, workers, modo, tmpdir, arquivo, _concluida)
+    _escrever_relatorios_zip(zf, user, empresas, tot["pdfs"], tot["cache_hits"], erros_list, arquivo)
+    return tot["pdfs"], tot["erros"], erros_list
+
+def _texto_resumo_zip(user: str, empresas: int) -> str:
+    return (
+        f"DARES ZIP\n"
+        f"User: {user}\n"
+        f"Data: {date.today().isoformat()}\n"
+        f"Empresas (certificados): {empresas}\n"
+        f"Filtro vencimento: até hoje+{DIAS_MAX_FUTURO_DARE} dias\n"
+    )
+
+def _escrever_relatorios_zip(
+    zf: zipfile.ZipFile,
+    user: str,
+    empresas: int,
+    pdfs: int,
+    cache_hits: int,
+    erros_list: List[Dict[str, str]],
+    arquivo: Optional[ArquivoDares] = None,
+):
+    """RELATORIO_ERROS.txt + RESUMO_FINAL.txt, no fim do ZIP."""
+    if erros_list:
+        linhas = []
+        for e in erros_list:
+            linhas.append(f"Empresa: {e.get('empresa')} | CODI: {e.get('codi')} | Erro: {e.get('erro')}")
+        zf.writestr("RELATORIO_ERROS.txt", "\n".join(linhas))
+    else:
+        zf.writestr("RELATORIO_ERROS.txt", "Sem erros.\n")
+
+    resumo_final = (
+        f"DARES ZIP\n"
+        f"User: {user}\n"
+        f"Data: {date.today().isoformat()}\n"
+        f"Empresas (certificados): {empresas}\n"
+        f"PDFs gerados: {pdfs}\n"
+        f"PDFs do cache (sem captcha/render): {cache_hits}\n"
+        f"Erros: {len(erros_list)}\n"
+        f"Filtro vencimento: até hoje+{DIAS_MAX_FUTURO_DARE} dias\n"
+        f"{arquivo.texto_resumo() if arquivo else ''}"
+        f"\nObs: veja RELATORIO_ERROS.txt para detalhes.\n"
+    )
+    zf.writestr("RESUMO_FINAL.txt", resumo_final)
+
+def _nome_zip_dares(user: str) -> str:
+    return f"dares_{_slug(user)}_{date.today().isoformat()}_{int(time.time())}.zip"
+
+def gerar_zip_dares(
+    user: str,
+    workers: int = DARES_MAX_WORKERS,
+    modo: str = DARES_MODO_EXECUCAO,
+    destino_dir: Optional[str] = None,
+    progresso: Optional[Callable[[Dict[str, Any]], None]] = None,
+    tempos: Optional[List[Dict[str, Any]]] = None,
+    arquivo_modo: str = DARES_ARQUIVO_MODO,
+    otimizar: bool = DARES_PDF_OTIMIZAR,
+) -> Tuple[str, str, int, int, int, List[Dict[str, str]]]:
+    t0 = time.perf_counter()
+    certs = carregar_certificados_validos(user)
+    METRICA_ETAPA.labels("dares", "certificados").observe(time.perf_counter() - t0)
+    if not certs:
+        raise RuntimeError("Nenhuma empresa para este user.")
+    if progresso:
+        progresso({"empresas": len(certs)})
+
+    zip_name = _nome_zip_dares(user)
+    zip_path = os.path.join(destino_dir or tempfile.gettempdir(), zip_name)
+
+    # scratch só desta execução (PDFs acima do teto de memória); some no fim, com ou sem erro
+    tmpdir = tempfile.mkdtemp(prefix=f"dares_{_slug(user)[:30]}_")
+    try:
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            pdfs, erros, erros_list = _escrever_zip_dares(
+                zf, user, certs, workers, modo, tmpdir, progresso, tempos, arquivo_modo, otimizar
+            )
+    except Exception:
+        try:
+            os.remove(zip_path)
+        except Exception:
+            pass
+        raise
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return zip_path, zip_name, len(certs), pdfs, erros, erros_list
+
+# =========================================================
+# ZIP DARES de vários users (um ZIP por user, um pool só)
+# =========================================================
+class _ArquivosLote:
+    """
+    Faz o papel de ArquivoDares para _rodar_dares num lote de users: a pasta
+    da empresa única é repassada ao ArquivoDares de cada dono, com a pasta
+    do dono. Certificado de um dono só passa o PdfPronto direto; com vários,
+    cada dono recebe a sua cópia dos bytes.
+    """
+
+    def __init__(self, destinos: Dict[str, List[Tuple[ArquivoDares, str]]]):
+        self.destinos = destinos
+
+    def adicionar(self, pasta: str, nome: str, pdf: PdfPronto):
+        destinos = self.destinos.get(pasta) or []
+        if len(destinos) == 1:
+            arquivo, pasta_dono = destinos[0]
+            arquivo.adicionar(pasta_dono, nome, pdf)
+            return
+        dados = pdf.ler()
+        pdf.descartar()
+        for arquivo, pasta_dono in destinos:
+            arquivo.adicionar(pasta_dono, nome, PdfPronto(dados, None, len(dados)))
+
+    def fechar_empresa(self, pasta: str):
+        for arquivo, pasta_dono in self.destinos.get(pasta) or []:
+            arquivo.fechar_empresa(pasta_dono)
+
+def gerar_zips_dares_lote(
+    users: List[str],
+    workers: int = DARES_MAX_WORKERS,
+    modo: str = DARES_MODO_EXECUCAO,
+    destino_dir: Optional[str] = None,
+    arquivo_modo: str = DARES_ARQUIVO_MODO,
+    otimizar: bool = DARES_PDF_OTIMIZAR,
+) -> List[Dict[str, Any]]:
+    """
+    gerar_zip_dares de vários users: uma query no Supabase, certificado
+    repetido entre users roda uma vez só e todas as empresas dividem o mesmo
+    pool/pipeline. Devolve, por user (na ordem de users), {"user", "ok",
+    "zip_path", "zip", "empresas", "pdfs", "erros", "erros_list"} ou
+    {"user", "ok": False, "error"}.
+    """
+    if arquivo_modo not in ArquivoDares.MODOS:
+        raise ValueError(f"modo de arquivo inválido: {arquivo_modo}")
+
+    t0 = time.perf_counter()
+    por_user = carregar_certificados_varios_users(users)
+    METRICA_ETAPA.labels("dares", "certificados").observe(time.perf_counter() - t0)
+    unicos, donos = agrupar_certificados_compartilhados(por_user)
+
+    saidas: List[Dict[str, Any]] = []
+    por_user_saida: Dict[str, Dict[str, Any]] = {}
+    for user, rows in por_user.items():
+        if not rows:
+            saidas.append({"user": user, "ok": False, "error": "Nenhuma empresa para este user."})
+            continue
+        zip_name = _nome_zip_dares(user)
+        zip_path = os.path.join(destino_dir or tempfile.gettempdir(), zip_name)
+        saida = {
+            "user": user, "ok": True, "zip_path": zip_path, "zip": zip_name, "empresas": len(rows),
+            "pdfs": 0, "erros": 0, "erros_list": [], "cache_hits": 0,
+        }
+        saidas.append(saida)
+        por_user_saida[user] = saida
+    if not unicos:
+        return saidas
+
+    # a pasta da empresa é a chave entre _rodar_dares e os donos: linha única
+    # com a mesma pasta de outra ganha codi próprio para não misturar users
+    certs: List[Dict[str, Any]] = []
+    donos_por_id: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+    pastas_usadas = set()
+    for rep in unicos:
+        cid = _cert_id(rep)
+        pasta = _pasta_empresa_zip(str(rep.get("codi") or ""), rep.get("empresa") or "")
+        if pasta in pastas_usadas:
+            rep = dict(rep, codi=f"{rep.get('codi') or ''}_{cid}")
+            pasta = _pasta_empresa_zip(str(rep["codi"]), rep.get("empresa") or "")
+        pastas_usadas.add(pasta)
+        certs.append(rep)
+        donos_por_id[cid] = donos.get(cid) or [(rep.get("user") or "", rep)]
+
+    tmpdir = tempfile.mkdtemp(prefix="dares_lote_")
+    abertos: Dict[str, Tuple[zipfile.ZipFile, ArquivoDares]] = {}
+    try:
+        for user, saida in por_user_saida.items():
+            zf = zipfile.ZipFile(saida["zip_path"], "w", zipfile.ZIP_DEFLATED)
+            abertos[user] = (zf, ArquivoDares(zf, arquivo_modo, otimizar))
+            zf.writestr("RESUMO.txt", _texto_resumo_zip(user, saida["empresas"]))
+
+        destinos: Dict[str, List[Tuple[ArquivoDares, str]]] = {}
+        for rep in certs:
+            pasta = _pasta_empresa_zip(str(rep.get("codi") or ""), rep.get("empresa") or "")
+            destinos[pasta] = [
+                (abertos[user][1], _pasta_empresa_zip(str(row.get("codi") or ""), row.get("empresa") or ""))
+                for user, row in donos_por_id[_cert_id(rep)]
+            ]
+
+        def _concluida(res_emp: Dict[str, Any]):
+            exportar_spans("dares", res_emp["spans"])
+            for user, row in donos_por_id.get(res_emp["id"]) or []:
+                saida = por_user_saida[user]
+                saida["pdfs"] += res_emp["pdfs"]
+                saida["cache_hits"] += res_emp.get("cache_hits", 0)
+                saida["erros"] += len(res_emp["erros"])
+                saida["erros_list"].extend(
+                    dict(e, empresa=row.get("empresa") or "", codi=row.get("codi") or "") for e in res_emp["erros"]
+                )
+
+        _rodar_dares(certs, workers, modo, tmpdir, _ArquivosLote(destinos), _concluida)
+
+        for user, (zf, arquivo) in abertos.items():
+            saida = por_user_saida[user]
+            _escrever_relatorios_zip(
+                zf, user, saida["empresas"], saida["pdfs"], saida["cache_hits"], saida["erros_list"], arquivo
+            )
+            zf.close()
+    except Exception:
+        for zf, _ in abertos.values():
+            try:
+                zf.close()
+            except Exception:
+                pass
+        for saida in por_user_saida.values():
+            try:
+                os.remove(saida["zip_path"])
+            except Exception:
+                pass
+        raise
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return saidas
+
+# =========================================================
+# ZIP DARES em streaming (StreamingResponse)
+# =========================================================
+class _SaidaStreamZip:
+    """
+    "Arquivo" só de escrita, não-seekable, para o zipfile: junta os bytes em
+    blocos e entrega para o gerador HTTP por uma fila limitada (backpressure).
+    """
+
+    def __init__(self, tamanho_bloco: int = ZIP_STREAM_BLOCO, max_blocos: int = ZIP_STREAM_MAX_BLOCOS):
+        self.tamanho_bloco = tamanho_bloco
+        self.fila: "queue.Queue" = queue.Queue(maxsize=max_blocos)
+        self.cancelado = threading.Event()
+        self._buf = bytearray()
+
+    def _put(self, item):
+        while True:
+            if self.cancelado.is_set():
+                raise RuntimeError("Cliente desconectou durante o download do ZIP")
+            try:
+                self.fila.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data) -> int:
+        self._buf += data
+        if len(self._buf) >= self.tamanho_bloco:
+            self._put(bytes(self._buf))
+            self._buf = bytearray()
+        return len(data)
+
+    def flush(self):
+        if self._buf:
+            self._put(bytes(self._buf))
+            self._buf = bytearray()
+
+_FIM_STREAM = object()
+
+def gerar_zip_dares_stream(
+    user: str,
+    certs: List[Dict[str, Any]],
+    workers: int = DARES_MAX_WORKERS,
+    modo: str = DARES_MODO_EXECUCAO,
+    arquivo_modo: str = DARES_ARQUIVO_MODO,
+    otimizar: bool = DARES_PDF_OTIMIZAR,
+):
+    """
+    Gerador de bytes do ZIP: cada PDF vai para o cliente assim que a empresa
+    termina; RELATORIO_ERROS.txt/RESUMO_FINAL.txt fecham o arquivo.
+    """
+    saida = _SaidaStreamZip()
+    tmpdir = tempfile.mkdtemp(prefix=f"dares_{_slug(user)[:30]}_")
+
+    def _produzir():
+        try:
+            with zipfile.ZipFile(saida, "w", zipfile.ZIP_DEFLATED) as zf:
+                pdfs, erros, erros_list = _escrever_zip_dares(
+                    zf, user, certs, workers, modo, tmpdir, arquivo_modo=arquivo_modo, otimizar=otimizar
+                )
+            saida.flush()
+            print(f"[ZIP-STREAM] user={user} empresas={len(certs)} pdfs={pdfs} erros={erros}")
+            for e in erros_list[:50]:
+                print("[ERRO]", e)
+            saida._put(_FIM_STREAM)
+        except Exception as e:
+            print(f"[ZIP-STREAM] user={user} abortado: {e}")
+            if not saida.cancelado.is_set():
+                saida._put(e)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    th = threading.Thread(target=_produzir, name=f"zip-stream-{_slug(user)[:20]}", daemon=True)
+    th.start()
+    try:
+        while True:
+            item = saida.fila.get()
+            if item is _FIM_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        saida.cancelado.set()
+
+# =========================================================
+# JOBS /dares: fila local em processo com estado em disco
+# =========================================================
+class FilaJobsDares:
+    """
+    Fila em processo para gerar_zip_dares. O estado de cada job fica em
+    JOBS_DIR/<id>.json (reescrito a cada empresa), então um restart recoloca
+    na fila o que estava pendente/rodando. ZIPs finalizados expiram após
+    JOBS_RETENCAO_S.
+    """
+
+    def __init__(self, pasta: str = JOBS_DIR, workers: int = JOBS_WORKERS, retencao_s: float = JOBS_RETENCAO_S):
+        self.pasta = pasta
+        self.workers = max(1, workers)
+        self.retencao_s = retencao_s
+        self._fila: "queue.Queue[str]" = queue.Queue()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._ultima_limpeza = 0.0
+
+    # ---- persistência ----
+    def _arquivo(self, job_id: str) -> str:
+        return os.path.join(self.pasta, f"{job_id}.json")
+
+    def _salvar(self, job: Dict[str, Any]):
+        tmp = self._arquivo(job["id"]) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, self._arquivo(job["id"]))
+
+    def _atualizar(self, job_id: str, **campos):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(campos)
+            self._salvar(job)
+
+    def _carregar(self):
+        for nome in os.listdir(self.pasta):
+            if not nome.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.pasta, nome), encoding="utf-8") as f:
+                    job = json.load(f)
+            except Exception:
+                continue
+            self._jobs[job["id"]] = job
+            if job.get("status") in ("na_fila", "rodando"):
+                # interrompido por restart: recomeça do zero
+                job["status"] = "na_fila"
+                job["reinicios"] = int(job.get("reinicios") or 0) + 1
+                self._salvar(job)
+                self._fila.put(job["id"])
+
+    # ---- ciclo de vida ----
+    def iniciar(self):
+        with self._lock:
+            if self._threads:
+                return
+            os.makedirs(self.pasta, exist_ok=True)
+            self._carregar()
+            for i in range(self.workers):
+                th = threading.Thread(target=self._loop, name=f"jobs-dares-{i}", daemon=True)
+                th.start()
+                self._threads.append(th)
+
+    def _loop(self):
+        while True:
+            try:
+                job_id = self._fila.get(timeout=60)
+            except queue.Empty:
+                self.limpar_expirados()
+                continue
+            self._executar(job_id)
+            self.limpar_expirados()
+
+    def _executar(self, job_id: str):
+        with self._lock:
+            job = dict(self._jobs.get(job_id) or {})
+        if not job or job.get("status") != "na_fila":
+            return
+        self._atualizar(job_id, status="rodando", iniciado_em=time.time(),
+                        empresas_concluidas=0, pdfs=0, erros=0, erros_list=[])
+
+        def _progresso(p: Dict[str, Any]):
+            campos = {k: v for k, v in p.items() if k != "erros_list"}
+            if "erros_list" in p:
+                campos["erros_list"] = list(p["erros_list"][:200])
+            self._atualizar(job_id, **campos)
+
+        try:
+            zip_path, zip_name, empresas, pdfs, erros, erros_list = gerar_zip_dares(
+                job["user"], workers=job["workers"], modo=job["modo"],
+                destino_dir=self.pasta, progresso=_progresso,
+                arquivo_modo=job.get("arquivo") or DARES_ARQUIVO_MODO,
+                otimizar=bool(job.get("otimizar", DARES_PDF_OTIMIZAR)),
+            )
+            self._atualizar(
+                job_id, status="concluido", finalizado_em=time.time(),
+                zip_path=zip_path, zip_name=zip_name, empresas=empresas,
+                empresas_concluidas=empresas, pdfs=pdfs, erros=erros, erros_list=erros_list[:200],
+            )
+            print(f"[JOB] {job_id} user={job['user']} empresas={empresas} pdfs={pdfs} erros={erros}")
+        except Exception as e:
+            self._atualizar(job_id, status="erro", finalizado_em=time.time(), error=str(e))
+            print(f"[JOB] {job_id} user={job['user']} erro: {e}")
+
+    # ---- API ----
+    def submeter(
+        self,
+        user: str,
+        workers: int,
+        modo: str,
+        arquivo: str = DARES_ARQUIVO_MODO,
+        otimizar: bool = DARES_PDF_OTIMIZAR,
+    ) -> Dict[str, Any]:
+        # valida aqui: job inválido não entra na fila nem no disco
+        if modo not in DARES_MODOS_EXECUCAO:
+            raise ValueError(f"modo de execução inválido: {modo} (use {', '.join(DARES_MODOS_EXECUCAO)})")
+        if arquivo not in ArquivoDares.MODOS:
+            raise ValueError(f"modo de arquivo inválido: {arquivo} (use {', '.join(ArquivoDares.MODOS)})")
+        self.iniciar()
+        job = {
+            "id": uuid.uuid4().hex,
+            "user": user,
+            "workers": workers,
+            "modo": modo,
+            "arquivo": arquivo,
+            "otimizar": otimizar,
+            "status": "na_fila",
+            "criado_em": time.time(),
+            "iniciado_em": None,
+            "finalizado_em": None,
+            "empresas": None,
+            "empresas_concluidas": 0,
+            "pdfs": 0,
+            "erros": 0,
+            "erros_list": [],
+            "zip_path": None,
+            "zip_name": None,
+            "error": None,
+            "reinicios": 0,
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._salvar(job)
+        self._fila.put(job["id"])
+        return dict(job)
+
+    def obter(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def limpar_expirados(self, forcar: bool = False):
+        agora = time.time()
+        if not forcar and agora - self._ultima_limpeza < JOBS_INTERVALO_LIMPEZA_S:
+            return
+        self._ultima_limpeza = agora
+        with self._lock:
+            expirados = [
+                j for j in self._jobs.values()
+                if j.get("status") in ("concluido", "erro")
+                and agora - float(j.get("finalizado_em") or agora) > self.retencao_s
+            ]
+            for job in expirados:
+                for path in (job.get("zip_path"), self._arquivo(job["id"])):
+                    try:
+                        if path and os.path.exists(path):
+                            os.remove(path)
+                    except Exception:
+                        pass
+                del self._jobs[job["id"]]
+
+fila_jobs_dares = FilaJobsDares()
+
+def _job_publico(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: v for k, v in job.items() if k not in ("zip_path",)}
+    out["job_id"] = out.pop("id")
+    return out
+
+# =========================================================
+# ENGINE ASYNC (httpx): centenas de empresas num event loop
+# =========================================================
+def _ssl_contexto_cert(mat: MaterialCertificado) -> ssl.SSLContext:
+    # mesma base de CAs do requests (certifi). Carregar a base custa dezenas de
+    # ms de CPU: é 1 contexto por certificado, criado no login (fora do loop)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.load_verify_locations(cafile=requests.certs.where())
+    ctx.load_cert_chain(mat.cert_path, mat.key_path)
+    return ctx
+
+async def _metrica_resposta_http_async(r: httpx.Response):
+    METRICA_HTTP.labels(r.url.host or "", str(r.status_code)).inc()
+
+def criar_cliente_async(mat: MaterialCertificado) -> httpx.AsyncClient:
+    """
+    AsyncClient com o certificado do cliente no contexto TLS, conexões
+    keep-alive e o TransporteSefinAsync (limite/retry/circuito por host).
+    """
+    transporte = httpx.AsyncHTTPTransport(
+        verify=_ssl_contexto_cert(mat),
+        limits=httpx.Limits(max_connections=ASYNC_CONEXOES_POR_CERT, max_keepalive_connections=ASYNC_CONEXOES_POR_CERT),
+    )
+    return httpx.AsyncClient(
+        transport=TransporteSefinAsync(transporte),
+        headers=_HEADERS_SEFIN,
+        timeout=httpx.Timeout(30.0),
+        follow_redirects=True,
+        event_hooks={"response": [_metrica_resposta_http_async]},
+    )
+
+async def abrir_acesso_digital_e_entrar_async(cli: httpx.AsyncClient) -> bool:
+    r = await cli.get(URL_DET_HOME)
+    if r.status_code != 200:
+        return False
+
+    soup = _soup(r.text, _SO_FORMS)
+    form = soup.find("form")
+    if not form:
+        return False
+
+    action = form.get("action") or URL_ENTRAR
+    if not action.startswith("http"):
+        action = requests.compat.urljoin(URL_DET_HOME, action)
+
+    r_ent = await cli.get(action)
+    return r_ent.status_code == 200 and "/certificado/acessos" in str(r_ent.url)
+
+async def ir_para_portal_e_carregar_home_async(cli: httpx.AsyncClient) -> Optional[str]:
+    r_red = await cli.get(URL_REDIRECT_PORTAL)
+    if r_red.status_code != 200:
+        return None
+
+    action_form, data_form = extrair_form_logintoken(r_red.text)
+    if action_form:
+        r_login = await cli.post(action_form, data=data_form)
+        url_login = str(r_login.url)
+        if r_login.status_code == 200 and "LoginToken" not in url_login:
+            return r_login.text
+        if r_login.status_code == 200 and "LoginToken" in url_login:
+            next_url = extrair_redirect_do_logintoken(r_login.text) or URL_PORTAL_HOME_DEFAULT
+            r_home = await cli.get(next_url)
+            if r_home.status_code == 200 and "portalcontribuinte.sefin.ro.gov.br" in str(r_home.url):
+                return r_home.text
+
+    r_portal = await cli.get(URL_PORTAL_HOME_DEFAULT)
+    if r_portal.status_code == 200 and "LoginToken" not in str(r_portal.url):
+        return r_portal.text
+
+    return None
+
+async def acessar_fisconforme_async(cli: httpx.AsyncClient, action_url: str, token: str) -> Optional[str]:
+    r = await cli.post(action_url, data={"token": token})
+    if r.status_code != 200:
+        return None
+    return r.text
+
+async def consultar_debitos_anos_async(
+    cli: httpx.AsyncClient, anos: List[int]
+) -> Tuple[Optional[List[Dict[str, str]]], List[str]]:
+    """
+    Mesmo contrato de consultar_debitos_anos: cada IE × ano é um POST, no
+    máximo DEBITOS_MAX_PARALELO ao mesmo tempo no cliente (1 por padrão).
+    O parse das páginas (a lista pode ter vários MB) roda em thread para não
+    travar as outras empresas no event loop.
+    """
+    r = await cli.get(URL_CONSULTA_DEBITOS)
+    if r.status_code != 200:
+        return None, [f"Erro HTTP {r.status_code} ao abrir Consulta de Débitos"]
+
+    tipo_devedor, inscricoes = await asyncio.to_thread(_ler_form_debitos, r.text)
+    if not inscricoes:
+        return None, ["Nenhuma inscrição estadual disponível (select vazio)"]
+
+    sem = asyncio.Semaphore(DEBITOS_MAX_PARALELO)
+
+    async def _um(ie_val: str, ano: int) -> Tuple[List[Dict[str, str]], Optional[str]]:
+        try:
+            async with sem:
+                r2 = await cli.post(URL_CONSULTA_DEBITOS_LISTA, data=_payload_debitos(ie_val, ano, tipo_devedor))
+            if r2.status_code != 200:
+                return [], f"Erro HTTP {r2.status_code} lista (ano {ano}) IE={ie_val}"
+            return await asyncio.to_thread(_debitos_da_lista, r2.text, ie_val, ano), None
+        except Exception as e:
+            return [], f"{e} (ano {ano}) IE={ie_val}"
+
+    resultados = await asyncio.gather(*[_um(ie, ano) for ano in anos for ie in inscricoes])
+    return _juntar_debitos(list(resultados))
+
+async def consultar_debitos_ano_async(cli: httpx.AsyncClient, ano: int) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    debs, erros = await consultar_debitos_anos_async(cli, [ano])
+    if debs is None:
+        return [], erros[-1] if erros else f"Falha ao consultar lista (ano {ano})"
+    return debs, None
+
+async def carregar_html_dare_final_async(cli: httpx.AsyncClient, url_dare: str, max_tentativas: int = 5) -> str:
+    """
+    carregar_html_dare_final sem bloquear: o captcha é aguardado pelo Future
+    do servico_captcha. Mesma regra da versão sync: uma chamada por vez no
+    mesmo cliente (o captcha fica na sessão do dare).
+    """
+    for _ in range(max_tentativas):
+        r = await cli.get(url_dare)
+        if r.status_code != 200:
+            raise RuntimeError(f"Falha ao abrir DARE: HTTP {r.status_code}")
+
+        if "copy-cb" in r.text:
+            return r.text
+
+        captcha = _captcha_do_dare(r.text)
+        if captcha is None:
+            return r.text
+        form, img_bytes = captcha
+
+        METRICA_CAPTCHA_TENTATIVAS.inc()
+        fut_captcha = servico_captcha.resolver(img_bytes)
+        captcha_resp = await asyncio.wait_for(asyncio.wrap_future(fut_captcha), CAPTCHA_TIMEOUT + 30)
+        if not captcha_resp:
+            METRICA_CAPTCHA_FALHAS.labels("sem_resposta").inc()
+            continue
+
+        action, data = _post_captcha_dare(form, captcha_resp)
+        r2 = await cli.post(action, data=data)
+        if r2.status_code == 200 and "copy-cb" in r2.text:
+            servico_captcha.reportar(fut_captcha, True)
+            return r2.text
+
+        servico_captcha.reportar(fut_captcha, False)
+        METRICA_CAPTCHA_FALHAS.labels("incorreto").inc()
+        await asyncio.sleep(1.2)
+
+    raise RuntimeError("Não foi possível emitir o DARE (CAPTCHA).")
+
+class SessaoAsync:
+    """AsyncClient já logado no portal (par async da SessaoAutenticada)."""
+
+    def __init__(self, cert_id: str):
+        self.cert_id = cert_id
+        self.cli: Optional[httpx.AsyncClient] = None
+        self.material: Optional[MaterialCertificado] = None
+        self.html_portal: Optional[str] = None
+        self.criado_em = time.time()
+        self.usado_em = self.criado_em
+        self.valida = False
+        self.lock = asyncio.Lock()
+
+    async def login(self, cert_row: Dict[str, Any]):
+        # pem/key podem vir do Supabase e o contexto TLS carrega a base de CAs
+        # (dezenas de ms): os dois fora do event loop
+        self.material = await asyncio.to_thread(cert_store.material, cert_row)
+        self.cli = await asyncio.to_thread(criar_cliente_async, self.material)
+
+        if not await abrir_acesso_digital_e_entrar_async(self.cli):
+            raise RuntimeError("Falha ao entrar no Acesso Digital (DET)")
+
+        self.html_portal = await ir_para_portal_e_carregar_home_async(self.cli)
+        if not self.html_portal:
+            raise RuntimeError("Falha ao abrir Portal (LoginToken/home)")
+
+        self.criado_em = self.usado_em = time.time()
+        self.valida = True
+
+    async def revalidar(self) -> bool:
+        try:
+            r = await self.cli.get(URL_PORTAL_HOME_DEFAULT)
+        except Exception:
+            return False
+        url = str(r.url)
+        if r.status_code != 200 or "LoginToken" in url or "portalcontribuinte.sefin.ro.gov.br" not in url:
+            return False
+        self.html_portal = r.text
+        return True
+
+    async def fechar(self):
+        self.valida = False
+        try:
+            if self.cli is not None:
+                await self.cli.aclose()
+        except Exception:
+            pass
+        if self.material is not None and not self.material.cert_id:
+            self.material.fechar()
+
+class CacheSessoesAsync:
+    """
+    CacheSessoes para o engine async: SessaoAsync por cert id, com TTL,
+    revalidação após ociosidade e LRU. Vive no event loop do uvicorn
+    (asyncio.Lock; não compartilhar entre loops).
+    """
+
+    def __init__(
+        self,
+        ttl: float = SESSAO_CACHE_TTL,
+        revalidar_apos: float = SESSAO_CACHE_REVALIDAR_APOS,
+        max_entradas: int = SESSAO_CACHE_MAX_ENTRADAS,
+        ativo: bool = SESSAO_CACHE_ATIVO,
+    ):
+        self.ttl = ttl
+        self.revalidar_apos = revalidar_apos
+        self.max_entradas = max_entradas
+        self.ativo = ativo
+        self._entradas: "OrderedDict[str, SessaoAsync]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def _remover(self, ent: SessaoAsync):
+        if self._entradas.get(ent.cert_id) is ent:
+            del self._entradas[ent.cert_id]
+        await ent.fechar()
+
+    async def _evictar(self):
+        for chave in list(self._entradas.keys()):
+            if len(self._entradas) <= self.max_entradas:
+                break
+            ent = self._entradas[chave]
+            if ent.lock.locked():
+                continue
+            del self._entradas[chave]
+            await ent.fechar()
+
+    async def _obter(self, cert_row: Dict[str, Any]) -> SessaoAsync:
+        chave = _cert_id(cert_row)
+        while True:
+            ent = self._entradas.get(chave)
+            if ent is None:
+                ent = SessaoAsync(chave)
+                await ent.lock.acquire()
+                self._entradas[chave] = ent
+                try:
+                    await ent.login(cert_row)
+                except Exception:
+                    ent.lock.release()
+                    await self._remover(ent)
+                    raise
+                self.misses += 1
+                METRICA_CACHE.labels("sessao", "miss").inc()
+                await self._evictar()
+                return ent
+
+            self._entradas.move_to_end(chave)
+            await ent.lock.acquire()
+            agora = time.time()
+            ok = ent.valida and (agora - ent.criado_em) < self.ttl
+            if ok and (agora - ent.usado_em) > self.revalidar_apos:
+                ok = await ent.revalidar()
+            if ok:
+                self.hits += 1
+                METRICA_CACHE.labels("sessao", "hit").inc()
+                return ent
+
+            ent.lock.release()
+            await self._remover(ent)
+
+    @asynccontextmanager
+    async def sessao(self, cert_row: Dict[str, Any]):
+        if not self.ativo or not _cert_id(cert_row):
+            ent = SessaoAsync(_cert_id(cert_row))
+            try:
+                await ent.login(cert_row)
+                yield ent.cli, ent.html_portal
+            finally:
+                await ent.fechar()
+            return
+
+        ent = await self._obter(cert_row)
+        try:
+            yield ent.cli, ent.html_portal
+        except Exception:
+            ent.valida = False
+            raise
+        finally:
+            ent.usado_em = time.time()
+            ent.lock.release()
+
+    def invalidar(self, cert_row: Dict[str, Any]):
+        ent = self._entradas.get(_cert_id(cert_row))
+        if ent is not None:
+            ent.valida = False
+
+    async def limpar(self):
+        entradas = list(self._entradas.values())
+        self._entradas.clear()
+        for ent in entradas:
+            await ent.fechar()
+
+cache_sessoes_async = CacheSessoesAsync()
+
+async def fluxo_fisconforme_async(cert_row: Dict[str, Any]) -> Dict[str, Any]:
+    """fluxo_fisconforme no engine async; mesmo formato de resultado."""
+    res = _resultado_vazio(cert_row)
+    crono = Cronometro("fisconforme")
+
+    try:
+        t_sessao = time.perf_counter()
+        async with cache_sessoes_async.sessao(cert_row) as (cli, html_portal):
+            crono.registrar("sessao", time.perf_counter() - t_sessao)
+
+            try:
+                with crono.etapa("fisconforme"):
+                    # parses em thread, como o dom/render dos DARES: página grande não trava o loop
+                    form = await asyncio.to_thread(encontrar_form_fisconforme, html_portal)
+                    if form:
+                        action, token = form
+                        html_fis = await acessar_fisconforme_async(cli, action, token)
+                        if html_fis:
+                            pend = await asyncio.to_thread(obter_pendencias_fisconforme, html_fis)
+                            res["pendencias"] = pend
+                            res["qtd_pendencias"] = len(pend)
+                        else:
+                            res["erro_fisconforme"] = "Erro ao abrir FisConforme"
+                    else:
+                        res["erro_fisconforme"] = "Form FisConforme não encontrado"
+            except Exception as e:
+                res["erro_fisconforme"] = str(e)
+
+            try:
+                with crono.etapa("debitos"):
+                    debitos, err = await consultar_debitos_ano_async(cli, date.today().year)
+                if err:
+                    res["erro_debitos"] = err
+                else:
+                    res["debitos"] = debitos
+                    res["qtd_debitos"] = len(debitos)
+            except Exception as e:
+                res["erro_debitos"] = str(e)
+
+        if res["erro_fisconforme"] and res["erro_debitos"]:
+            cache_sessoes_async.invalidar(cert_row)
+
+        res["situacao_geral"] = _situacao_geral(res)
+        return res
+
+    except Exception as e:
+        res["erro"] = str(e)
+        res["situacao_geral"] = "erro"
+        return res
+
+    finally:
+        crono.exportar()
+        res["tempos_ms"] = crono.tempos_ms()
+
+async def fluxo_fisconforme_varios_async(
+    certs: List[Dict[str, Any]],
+    concorrencia: int = ASYNC_MAX_EMPRESAS,
+    refresh: bool = False,
+) -> List[Dict[str, Any]]:
+    """Todas as empresas no mesmo event loop, no máximo `concorrencia` ao mesmo tempo; ordem de certs."""
+    sem = asyncio.Semaphore(max(1, min(int(concorrencia or 1), ASYNC_MAX_EMPRESAS)))
+
+    async def _um(cert_row: Dict[str, Any]) -> Dict[str, Any]:
+        chave = _cert_id(cert_row)
+        if chave and not refresh:
+            res = cache_resultados.obter(chave)
+            if res is not None:
+                return res
+        async with sem:
+            res = await fluxo_fisconforme_async(cert_row)
+        await asyncio.to_thread(registrar_snapshot, cert_row, res)
+        res["cached_at"] = datetime.now().isoformat(timespec="seconds")
+        if chave:
+            cache_resultados.guardar(chave, res)
+        res["from_cache"] = False
+        res["cache_age_s"] = 0.0
+        return res
+
+    return list(await asyncio.gather(*[_um(c) for c in certs]))
+
+# render continua no pool Chromium (threads); este executor só segura quem está
+# esperando navegador, sem ocupar o executor padrão do asyncio
+_executor_render_async = ThreadPoolExecutor(max_workers=POOL_CHROMIUM_TAMANHO * 2, thread_name_prefix="render-async")
+
+async def gerar_pdf_dare_async(
+    cli: httpx.AsyncClient,
+    deb: Dict[str, str],
+    cert_id: Optional[str] = None,
+    stats: Optional[Dict[str, int]] = None,
+    crono: Optional[Cronometro] = None,
+    trava_sessao: Optional[asyncio.Lock] = None,
+) -> Optional[Tuple[str, bytes]]:
+    """
+    (nome, bytes) do PDF DARE(+extrato), ou None se o débito não gera DARE.
+    trava_sessao: lock da sessão do cli; GET do DARE, captcha e extrato rodam
+    sob ele, o dom e o render não.
+    """
+    crono = crono or Cronometro("dares")
+    if not _dare_no_prazo(deb):
+        return None
+    url_dare = (deb.get("url_dare") or "").strip()
+    url_ext = (deb.get("url_extrato") or "").strip()
+    if not url_dare:
+        return None
+    nome = _nome_pdf_dare(deb)
+
+    chave = chave_pdf_dare(cert_id, deb) if cert_id else None
+    if chave:
+        em_cache = cache_pdf_dare.obter(chave)
+        if em_cache is not None:
+            if stats is not None:
+                stats["cache_hits"] = stats.get("cache_hits", 0) + 1
+            METRICA_PDFS.labels("cache").inc()
+            return nome, em_cache
+
+    html_ext = None
+    async with trava_sessao or AsyncExitStack():
+        with crono.etapa("captcha"):
+            html_dare_final = await carregar_html_dare_final_async(cli, url_dare, max_tentativas=5)
+        if url_ext:
+            with crono.etapa("extrato"):
+                r_ext = await cli.get(url_ext)
+            if r_ext.status_code == 200:
+                html_ext = r_ext.text
+
+    with crono.etapa("dom"):
+        body_dare_2vias = await asyncio.to_thread(preparar_dare_duas_vias, html_dare_final)
+        ext_body_html = await asyncio.to_thread(_body_extrato, html_ext) if html_ext is not None else None
+
+    loop = asyncio.get_running_loop()
+    pdf_bytes = await loop.run_in_executor(
+        _executor_render_async, _pdf_dare_bytes, body_dare_2vias, ext_body_html, crono
+    )
+    if chave:
+        cache_pdf_dare.guardar(chave, pdf_bytes)
+    METRICA_PDFS.labels("render").inc()
+    return nome, pdf_bytes
+
+async def _processar_empresa_dares_async(cert: Dict[str, Any]) -> Dict[str, Any]:
+    """Par async de _processar_empresa_dares: "pdfs" vem como [(nome, bytes)]."""
+    empresa = (cert.get("empresa") or "empresa").strip()
+    codi = str(cert.get("codi") or "0").strip()
+    out: Dict[str, Any] = {"empresa": empresa, "codi": codi, "pdfs": [], "erros": [], "cache_hits": 0, "spans": []}
+    crono = Cronometro("dares")
+
+    try:
+        t_sessao = time.perf_counter()
+        async with cache_sessoes_async.sessao(cert) as (cli, _html_portal):
+            crono.registrar("sessao", time.perf_counter() - t_sessao)
+            anos = anos_consulta_debitos()
+            with crono.etapa("debitos"):
+                todos, erros_cons = await consultar_debitos_anos_async(cli, anos)
+            if todos is None:
+                raise RuntimeError(f"Consulta de débitos falhou ({len(anos)} anos): " + " | ".join(erros_cons[:4]))
+            for e in erros_cons:
+                out["erros"].append({"empresa": empresa, "codi": codi, "erro": f"Consulta parcial: {e}"})
+
+            # captcha 1 por vez na sessão; só dom/render sobrepõem dentro da empresa
+            sem = asyncio.Semaphore(ASYNC_MAX_DARES_POR_EMPRESA)
+            trava_sessao = asyncio.Lock()
+
+            async def _um(deb: Dict[str, str]):
+                try:
+                    async with sem:
+                        return await gerar_pdf_dare_async(cli, deb, _cert_id(cert), out, crono, trava_sessao)
+                except Exception as e_pdf:
+                    out["erros"].append({"empresa": empresa, "codi": codi, "erro": f"PDF DARE/Extrato: {str(e_pdf)}"})
+                    return None
+
+            usados = set()
+            for item in await asyncio.gather(*[_um(d) for d in todos]):
+                if item is None:
+                    continue
+                nome, pdf_bytes = item
+                out["pdfs"].append((_nome_pdf_unico(nome, usados), pdf_bytes))
+    except Exception as e_emp:
+        out["erros"].append({"empresa": empresa, "codi": codi, "erro": str(e_emp)})
+
+    out["spans"] = crono.spans
+    return out
+
+async def gerar_zip_dares_async(
+    user: str,
+    concorrencia: int = ASYNC_MAX_EMPRESAS,
+    destino_dir: Optional[str] = None,
+    tempos: Optional[List[Dict[str, Any]]] = None,
+    arquivo_modo: str = DARES_ARQUIVO_MODO,
+    otimizar: bool = DARES_PDF_OTIMIZAR,
+) -> Tuple[str, str, int, int, int, List[Dict[str, str]]]:
+    """gerar_zip_dares no engine async: mesmo ZIP e mesmo retorno."""
+    if arquivo_modo not in ArquivoDares.MODOS:
+        raise ValueError(f"modo de arquivo inválido: {arquivo_modo}")
+
+    t0 = time.perf_counter()
+    certs = await asyncio.to_thread(carregar_certificados_validos, user)
+    METRICA_ETAPA.labels("dares", "certificados").observe(time.perf_counter() - t0)
+    if not certs:
+        raise RuntimeError("Nenhuma empresa para este user.")
+
+    zip_name = _nome_zip_dares(user)
+    zip_path = os.path.join(destino_dir or tempfile.gettempdir(), zip_name)
+    sem = asyncio.Semaphore(max(1, min(int(concorrencia or 1), ASYNC_MAX_EMPRESAS)))
+
+    async def _empresa(cert: Dict[str, Any]) -> Dict[str, Any]:
+        async with sem:
+            return await _processar_empresa_dares_async(cert)
+
+    def _gravar(arquivo: ArquivoDares, res_emp: Dict[str, Any]):
+        pasta = _pasta_empresa_zip(res_emp["codi"], res_emp["empresa"])
+        for nome, pdf_bytes in res_emp["pdfs"]:
+            arquivo.adicionar(pasta, nome, PdfPronto(pdf_bytes, None, len(pdf_bytes)))
+        arquivo.fechar_empresa(pasta)
+
+    pdfs = 0
+    cache_hits = 0
+    erros_list: List[Dict[str, str]] = []
+    tarefas = [asyncio.ensure_future(_empresa(c)) for c in certs]
+    try:
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            arquivo = ArquivoDares(zf, arquivo_modo, otimizar)
+            zf.writestr("RESUMO.txt", _texto_resumo_zip(user, len(certs)))
+            # único writer: as empresas terminam em qualquer ordem, a gravação é uma de cada vez
+            for fut in asyncio.as_completed(tarefas):
+                res_emp = await fut
+                t_zip = time.perf_counter()
+                await asyncio.to_thread(_gravar, arquivo, res_emp)
+                pdfs += len(res_emp["pdfs"])
+                cache_hits += res_emp["cache_hits"]
+                erros_list.extend(res_emp["erros"])
+                spans = res_emp["spans"] + [("zip", time.perf_counter() - t_zip)]
+                exportar_spans("dares", spans)
+                if tempos is not None:
+                    tempos.append({"empresa": res_emp["empresa"], "codi": res_emp["codi"], "tempos_ms": tempos_ms(spans)})
+            _escrever_relatorios_zip(zf, user, len(certs), pdfs, cache_hits, erros_list, arquivo)
+    except BaseException:
+        # erro ou cancelamento no meio: nada de ZIP parcial no disco nem empresa rodando solta
+        for t in tarefas:
+            t.cancel()
+        try:
+            os.remove(zip_path)
+        except OSError:
+            pass
+        raise
+
+    return zip_path, zip_name, len(certs), pdfs, len(erros_list), erros_list
+
+# =========================================================
+# PREWARM
+# =========================================================
+_HTML_PREWARM = (
+    "<html><body><form><input name='a' value='1'/><select name='inscricaoEstadual'>"
+    "<option value='1'>1</option></select><img src='x.png'/></form>"
+    "<table><thead><tr><th>CÓDIGO</th></tr></thead><tr><td>1</td></tr></table></body></html>"
+)
+
+class Prewarm:
+    """
+    Adianta, numa thread, o que o import deixou para o primeiro uso: parsers
+    (bs4/lxml + SoupStrainers), pypdf, anticaptcha e, se pedido, os
+    navegadores do pool Chromium. Cada etapa que deu certo não roda de novo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._chromium = False
+        self.estado = "ocioso"
+        self.etapas_ms: Dict[str, float] = {}
+        self.erros: Dict[str, str] = {}
+
+    def _parsers(self):
+        for so in _ARGS_STRAINERS:
+            _soup(_HTML_PREWARM, so)
+        _soup(_HTML_PREWARM)
+        _arvore_lxml(_HTML_PREWARM)
+
+    def _pdf(self):
+        from pypdf import PdfReader, PdfWriter
+
+        writer = PdfWriter()
+        writer.add_blank_page(595, 842)
+        buf = io.BytesIO()
+        writer.write(buf)
+        PdfReader(io.BytesIO(buf.getvalue())).pages[0]
+
+    def _captcha(self):
+        import anticaptchaofficial.imagecaptcha  # noqa: F401
+
+    def _rodar(self):
+        etapas = {"parsers": self._parsers, "pdf": self._pdf, "captcha": self._captcha, "chromium": pool_chromium.aquecer}
+        tentadas = set()
+        while True:
+            # chromium=1 pedido com o prewarm já rodando entra nesta mesma thread
+            with self._lock:
+                pendentes = [
+                    n for n in etapas
+                    if n not in tentadas and n not in self.etapas_ms and (n != "chromium" or self._chromium)
+                ]
+                if not pendentes:
+                    self.estado = "erro" if self.erros else "concluido"
+                    break
+            for nome in pendentes:
+                tentadas.add(nome)
+                t0 = time.perf_counter()
+                try:
+                    etapas[nome]()
+                    self.etapas_ms[nome] = round((time.perf_counter() - t0) * 1000, 1)
+                    self.erros.pop(nome, None)
+                except Exception as e:
+                    self.erros[nome] = str(e)
+                    print(f"[PREWARM] {nome} falhou: {e}")
+        print(f"[PREWARM] {self.estado} {self.etapas_ms}")
+
+    def iniciar(self, chromium: bool = PREWARM_CHROMIUM) -> Dict[str, Any]:
+        with self._lock:
+            self._chromium = self._chromium or chromium
+            if self._thread is None or not self._thread.is_alive():
+                self.estado = "rodando"
+                self._thread = threading.Thread(target=self._rodar, name="prewarm", daemon=True)
+                self._thread.start()
+        return self.status()
+
+    def aguardar(self, timeout: Optional[float] = None):
+        th = self._thread
+        if th is not None:
+            th.join(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "estado": self.estado,
+            "chromium": self._chromium,
+            "etapas_ms": dict(self.etapas_ms),
+            "erros": dict(self.erros),
+        }
+
+prewarm = Prewarm()
+
+# =========================================================
+# FASTAPI
+# =========================================================
 app = FastAPI(title="API FisConforme + DARE (Render)")
 
 app.add_middleware(
@@ -928,24 +4912,237 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def _iniciar_fila_jobs():
+    fila_jobs_dares.iniciar()
+
+@app.on_event("startup")
+def _iniciar_prewarm():
+    if PREWARM_AO_INICIAR:
+        prewarm.iniciar(PREWARM_CHROMIUM)
+
+@app.on_event("shutdown")
+def _encerrar_pool_chromium():
+    pool_chromium.encerrar()
+
+@app.on_event("shutdown")
+def _fechar_snapshots():
+    snapshots.fechar()
+
+@app.on_event("shutdown")
+async def _encerrar_sessoes_async():
+    await cache_sessoes_async.limpar()
+
 @app.get("/")
 def root():
-    return {"ok": True, "date": str(date.today()), "routes": ["/health", "/fisconforme", "/dares"]}
+    return {
+        "ok": True,
+        "date": str(date.today()),
+        "routes": [
+            "/health", "/metrics", "/prewarm", "/fisconforme", "/fisconforme/async", "/fisconforme/changes", "/fisconforme/lote",
+            "/dares", "/dares/async", "/dares/jobs", "/dares/lote",
+        ],
+    }
 
 @app.get("/health")
 def health():
     return {"ok": True, "date": str(date.today())}
 
+@app.get("/metrics")
+def route_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/prewarm")
+def route_prewarm(
+    chromium: int = Query(int(PREWARM_CHROMIUM)),
+    aguardar: float = Query(0, description="segundos esperando o prewarm terminar (0 = volta na hora)"),
+):
+    """Dispara o prewarm em background (idempotente) e devolve o estado."""
+    prewarm.iniciar(chromium == 1)
+    if aguardar > 0:
+        prewarm.aguardar(aguardar)
+    return {"ok": True, **prewarm.status()}
+
 @app.get("/fisconforme")
-def route_fisconforme(user: str = Query(...)):
+def route_fisconforme(
+    user: str = Query(...),
+    workers: int = Query(FISCONFORME_MAX_WORKERS),
+    refresh: int = Query(0),
+    timing: int = Query(0),
+    stream: int = Query(0),
+    formato: str = Query("ndjson", description="stream=1: ndjson | sse"),
+):
+    if stream == 1:
+        if formato not in ("ndjson", "sse"):
+            return JSONResponse({"ok": False, "user": user, "error": f"formato inválido: {formato}"}, status_code=400)
+        try:
+            certs = carregar_certificados_validos(user)
+        except Exception as e:
+            return JSONResponse({"ok": False, "user": user, "error": str(e)})
+        return StreamingResponse(
+            gerar_fisconforme_stream(user, certs, workers=workers, refresh=refresh == 1, timing=timing == 1, formato=formato),
+            media_type="text/event-stream" if formato == "sse" else "application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     certs = carregar_certificados_validos(user)
-    results = [fluxo_fisconforme(c) for c in certs]
+    results = fluxo_fisconforme_varios(certs, workers=workers, refresh=refresh == 1)
+    if timing != 1:
+        for r in results:
+            r.pop("tempos_ms", None)
+    return {"ok": True, "user": user, "total_empresas": len(results), "results": results}
+
+@app.get("/fisconforme/async")
+async def route_fisconforme_async(
+    user: str = Query(...),
+    concorrencia: int = Query(ASYNC_MAX_EMPRESAS),
+    refresh: int = Query(0),
+    timing: int = Query(0),
+):
+    certs = await asyncio.to_thread(carregar_certificados_validos, user)
+    results = await fluxo_fisconforme_varios_async(certs, concorrencia=concorrencia, refresh=refresh == 1)
+    if timing != 1:
+        for r in results:
+            r.pop("tempos_ms", None)
     return {"ok": True, "user": user, "total_empresas": len(results), "results": results}
 
+def _users_da_query(users: str) -> List[str]:
+    return list(dict.fromkeys(u.strip() for u in users.split(",") if u.strip()))
+
+@app.get("/fisconforme/lote")
+def route_fisconforme_lote(
+    users: str = Query(..., description="users separados por vírgula"),
+    workers: int = Query(FISCONFORME_MAX_WORKERS),
+    refresh: int = Query(0),
+    timing: int = Query(0),
+):
+    lista = _users_da_query(users)
+    if not lista:
+        return JSONResponse({"ok": False, "users": [], "error": "users vazio"}, status_code=400)
+    por_user, unicas = fluxo_fisconforme_lote(lista, workers=workers, refresh=refresh == 1)
+    total = sum(len(rs) for rs in por_user.values())
+    out = []
+    for user, results in por_user.items():
+        if timing != 1:
+            results = [{k: v for k, v in r.items() if k != "tempos_ms"} for r in results]
+        out.append({"user": user, "total_empresas": len(results), "results": results})
+    return {
+        "ok": True,
+        "users": lista,
+        "total_empresas": total,
+        "total_empresas_unicas": unicas,
+        "results": out,
+    }
+
+@app.get("/fisconforme/changes")
+def route_fisconforme_changes(
+    user: str = Query(...),
+    since: str = Query("0"),
+    limit: int = Query(SNAPSHOT_CHANGES_MAX),
+    atualizar: int = Query(0),
+    refresh: int = Query(0),
+    workers: int = Query(FISCONFORME_MAX_WORKERS),
+):
+    """
+    Pendências/débitos adicionados, removidos ou alterados desde `since`
+    (cursor devolvido pela chamada anterior, ou data ISO). atualizar=1 roda
+    o /fisconforme do user antes (refresh=1 ignora o cache de resultado).
+    """
+    if not SNAPSHOT_ATIVO:
+        return JSONResponse({"ok": False, "user": user, "error": "Snapshots desativados (SNAPSHOT_ATIVO=0)"}, status_code=503)
+    try:
+        desde = int(since) if since.strip().isdigit() else snapshots.seq_em(datetime.fromisoformat(since.strip()))
+    except ValueError:
+        return JSONResponse({"ok": False, "user": user, "error": f"since inválido: {since!r}"}, status_code=400)
+
+    if atualizar == 1:
+        certs = carregar_certificados_validos(user)
+        fluxo_fisconforme_varios(certs, workers=workers, refresh=refresh == 1)
+
+    changes, cursor, tem_mais = snapshots.mudancas(user, desde, limit)
+    return {
+        "ok": True,
+        "user": user,
+        "since": desde,
+        "cursor": cursor,
+        "has_more": tem_mais,
+        "total_changes": len(changes),
+        "changes": changes,
+    }
+
+@app.get("/dares/async")
+async def route_dares_async(
+    user: str = Query(...),
+    download: int = Query(1),
+    concorrencia: int = Query(ASYNC_MAX_EMPRESAS),
+    timing: int = Query(0),
+    arquivo: str = Query(DARES_ARQUIVO_MODO),
+    otimizar: int = Query(int(DARES_PDF_OTIMIZAR)),
+):
+    tempos: List[Dict[str, Any]] = []
+    try:
+        zip_path, zip_name, empresas, pdfs, erros, erros_list = await gerar_zip_dares_async(
+            user, concorrencia=concorrencia, tempos=tempos, arquivo_modo=arquivo, otimizar=otimizar == 1
+        )
+        print(f"[ZIP-ASYNC] user={user} empresas={empresas} pdfs={pdfs} erros={erros}")
+        for e in erros_list[:50]:
+            print("[ERRO]", e)
+    except Exception as e:
+        return JSONResponse({"ok": False, "user": user, "error": str(e)})
+
+    if download == 1:
+        return FileResponse(zip_path, media_type="application/zip", filename=zip_name)
+
+    out = {
+        "ok": True,
+        "user": user,
+        "zip": zip_name,
+        "empresas": empresas,
+        "pdfs": pdfs,
+        "erros": erros,
+        "erros_list": erros_list,
+    }
+    if timing == 1:
+        out["tempos_empresas"] = tempos
+    return out
+
 @app.get("/dares")
-def route_dares(user: str = Query(...), download: int = Query(1)):
+def route_dares(
+    user: str = Query(...),
+    download: int = Query(1),
+    workers: int = Query(DARES_MAX_WORKERS),
+    modo: str = Query(DARES_MODO_EXECUCAO),
+    stream: int = Query(0),
+    timing: int = Query(0),
+    arquivo: str = Query(DARES_ARQUIVO_MODO),
+    otimizar: int = Query(int(DARES_PDF_OTIMIZAR)),
+):
+    if stream == 1:
+        try:
+            # antes do StreamingResponse: depois dos headers o erro vira ZIP truncado
+            if modo not in DARES_MODOS_EXECUCAO:
+                raise ValueError(f"modo de execução inválido: {modo}")
+            if arquivo not in ArquivoDares.MODOS:
+                raise ValueError(f"modo de arquivo inválido: {arquivo}")
+            certs = carregar_certificados_validos(user)
+            if not certs:
+                raise RuntimeError("Nenhuma empresa para este user.")
+        except Exception as e:
+            return JSONResponse({"ok": False, "user": user, "error": str(e)})
+        zip_name = _nome_zip_dares(user)
+        return StreamingResponse(
+            gerar_zip_dares_stream(user, certs, workers=workers, modo=modo, arquivo_modo=arquivo, otimizar=otimizar == 1),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{zip_name}"'},
+        )
+
+    tempos: List[Dict[str, Any]] = []
+    progresso: Dict[str, Any] = {}
     try:
-        zip_path, zip_name, empresas, pdfs, erros, erros_list = gerar_zip_dares(user)
+        zip_path, zip_name, empresas, pdfs, erros, erros_list = gerar_zip_dares(
+            user, workers=workers, modo=modo, progresso=progresso.update, tempos=tempos,
+            arquivo_modo=arquivo, otimizar=otimizar == 1,
+        )
         print(f"[ZIP] user={user} empresas={empresas} pdfs={pdfs} erros={erros}")
         for e in erros_list[:50]:
             print("[ERRO]", e)
@@ -955,7 +5152,7 @@ def route_dares(user: str = Query(...), download: int = Query(1)):
     if download == 1:
         return FileResponse(zip_path, media_type="application/zip", filename=zip_name)
 
-    return {
+    out = {
         "ok": True,
         "user": user,
         "zip": zip_name,
@@ -964,6 +5161,108 @@ def route_dares(user: str = Query(...), download: int = Query(1)):
         "erros": erros,
         "erros_list": erros_list,
     }
+    if timing == 1:
+        out["tempos_empresas"] = tempos
+        if "pipeline" in progresso:
+            out["pipeline"] = progresso["pipeline"]
+    return out
+
+@app.get("/dares/lote")
+def route_dares_lote(
+    users: str = Query(..., description="users separados por vírgula"),
+    download: int = Query(1),
+    workers: int = Query(DARES_MAX_WORKERS),
+    modo: str = Query(DARES_MODO_EXECUCAO),
+    arquivo: str = Query(DARES_ARQUIVO_MODO),
+    otimizar: int = Query(int(DARES_PDF_OTIMIZAR)),
+):
+    """
+    Um ZIP de DARES por user, numa execução só. download=1 devolve os ZIPs
+    dentro de um ZIP (sem recompressão); download=0, o resumo por user.
+    Tudo vai numa pasta temporária da requisição, apagada depois do envio
+    (download=1) ou antes de responder (download=0 e erros).
+    """
+    lista = _users_da_query(users)
+    if not lista:
+        return JSONResponse({"ok": False, "users": [], "error": "users vazio"}, status_code=400)
+    pasta_lote = tempfile.mkdtemp(prefix="dares_lote_saida_")
+    try:
+        saidas = gerar_zips_dares_lote(
+            lista, workers=workers, modo=modo, destino_dir=pasta_lote, arquivo_modo=arquivo, otimizar=otimizar == 1
+        )
+    except Exception as e:
+        shutil.rmtree(pasta_lote, ignore_errors=True)
+        return JSONResponse({"ok": False, "users": lista, "error": str(e)})
+    for s in saidas:
+        if s["ok"]:
+            print(f"[ZIP-LOTE] user={s['user']} empresas={s['empresas']} pdfs={s['pdfs']} erros={s['erros']}")
+        else:
+            print(f"[ZIP-LOTE] user={s['user']} erro={s['error']}")
+
+    if download == 1:
+        prontos = [s for s in saidas if s["ok"]]
+        if not prontos:
+            shutil.rmtree(pasta_lote, ignore_errors=True)
+            return JSONResponse({"ok": False, "users": lista, "error": "Nenhuma empresa para estes users."})
+        zip_name = f"dares_lote_{date.today().isoformat()}_{int(time.time())}.zip"
+        zip_path = os.path.join(pasta_lote, zip_name)
+        try:
+            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf:
+                for s in prontos:
+                    zf.write(s["zip_path"], arcname=s["zip"])
+                sem_empresa = [s["user"] for s in saidas if not s["ok"]]
+                if sem_empresa:
+                    zf.writestr("USERS_SEM_EMPRESA.txt", "\n".join(sem_empresa) + "\n")
+        except Exception as e:
+            shutil.rmtree(pasta_lote, ignore_errors=True)
+            return JSONResponse({"ok": False, "users": lista, "error": str(e)})
+        return FileResponse(
+            zip_path, media_type="application/zip", filename=zip_name,
+            background=BackgroundTask(shutil.rmtree, pasta_lote, ignore_errors=True),
+        )
+
+    shutil.rmtree(pasta_lote, ignore_errors=True)
+    return {
+        "ok": True,
+        "users": lista,
+        "results": [{k: v for k, v in s.items() if k != "zip_path"} for s in saidas],
+    }
+
+@app.post("/dares/jobs")
+def route_dares_job_submit(
+    user: str = Query(...),
+    workers: int = Query(DARES_MAX_WORKERS),
+    modo: str = Query(DARES_MODO_EXECUCAO),
+    arquivo: str = Query(DARES_ARQUIVO_MODO),
+    otimizar: int = Query(int(DARES_PDF_OTIMIZAR)),
+):
+    if modo not in DARES_MODOS_EXECUCAO:
+        return JSONResponse({"ok": False, "user": user, "error": f"modo de execução inválido: {modo}"}, status_code=400)
+    if arquivo not in ArquivoDares.MODOS:
+        return JSONResponse({"ok": False, "user": user, "error": f"modo de arquivo inválido: {arquivo}"}, status_code=400)
+    job = fila_jobs_dares.submeter(user, workers, modo, arquivo, otimizar == 1)
+    return {"ok": True, **_job_publico(job)}
+
+@app.get("/dares/jobs/{job_id}")
+def route_dares_job_status(job_id: str):
+    job = fila_jobs_dares.obter(job_id)
+    if not job:
+        return JSONResponse({"ok": False, "job_id": job_id, "error": "Job não encontrado"}, status_code=404)
+    return {"ok": True, **_job_publico(job)}
+
+@app.get("/dares/jobs/{job_id}/download")
+def route_dares_job_download(job_id: str):
+    job = fila_jobs_dares.obter(job_id)
+    if not job:
+        return JSONResponse({"ok": False, "job_id": job_id, "error": "Job não encontrado"}, status_code=404)
+    if job.get("status") != "concluido" or not job.get("zip_path") or not os.path.exists(job["zip_path"]):
+        return JSONResponse(
+            {"ok": False, "job_id": job_id, "status": job.get("status"), "error": "ZIP ainda não disponível"},
+            status_code=409,
+        )
+    return FileResponse(job["zip_path"], media_type="application/zip", filename=job["zip_name"])
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run("fisconforme:app", host="0.0.0.0", port=int(os.getenv("PORT", "10000")), reload=False)
@@ -0,0 +1,99 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fisconforme  # noqa: E402
+from benchmarks.sefin_fake import StandInSefin  # noqa: E402
+
+
+def pdf_em_branco() -> bytes:
+    from pypdf import PdfWriter
+
+    w = PdfWriter()
+    w.add_blank_page(595, 842)
+    buf = io.BytesIO()
+    w.write(buf)
+    return buf.getvalue()
+
+
+class PaginaFalsa:
+    """O pedaço da Page do Playwright que o NavegadorChromium usa."""
+
+    def __init__(self, navegador: "NavegadorFalso"):
+        self.navegador = navegador
+        self.fechada = False
+        self.html = ""
+
+    def set_content(self, html, wait_until=None):
+        self.html = html
+
+    def pdf(self, path=None, **kwargs):
+        self.navegador.renders.append(self.html)
+        falha = self.navegador.falhar
+        if falha is not None:
+            falha(self.html)
+        dados = pdf_em_branco()
+        if path:
+            with open(path, "wb") as f:
+                f.write(dados)
+        return dados
+
+    def evaluate(self, js):
+        return 0
+
+    def is_closed(self):
+        return self.fechada
+
+
+class NavegadorFalso:
+    def __init__(self):
+        self.conectado = True
+        self.renders = []
+        self.falhar = None   # callable(html) chamado antes de cada pdf(): levanta ou trava
+
+    def new_context(self):
+        return self
+
+    def new_page(self):
+        return PaginaFalsa(self)
+
+    def is_connected(self):
+        return self.conectado
+
+    def close(self):
+        self.conectado = False
+
+
+@pytest.fixture
+def chromium_falso(monkeypatch):
+    """
+    pool_chromium novo cujos navegadores são NavegadorFalso (sem Chromium na
+    máquina de teste). Devolve a lista dos navegadores criados.
+    """
+    criados = []
+
+    def _iniciar(self):
+        self._browser = NavegadorFalso()
+        criados.append(self._browser)
+        self._context = self._browser.new_context()
+        self._page = self._context.new_page()
+        self.renders = 0
+
+    monkeypatch.setattr(fisconforme.NavegadorChromium, "_iniciar", _iniciar)
+    pool = fisconforme.PoolChromium(2)
+    monkeypatch.setattr(fisconforme, "pool_chromium", pool)
+    yield criados
+    pool.encerrar()
+
+
+@pytest.fixture
+def sefin(monkeypatch):
+    """StandInSefin com 2 empresas, fisconforme apontado para ele e sem cache de PDF."""
+    monkeypatch.setattr(fisconforme.cache_pdf_dare, "ativo", False)
+    with StandInSefin(empresas=2) as s:
+        s.apontar(fisconforme)
+        yield s
@@ -0,0 +1,134 @@
+# dare_multipasso_referencia.py
+"""
+preparar_dare_duas_vias antigo (várias passadas pela árvore + re-parse no
+absolutizar_recursos), congelado como referência: test_dare_dom.py confere
+que o transformador de uma passada do fisconforme dá o mesmo <body>, e
+benchmarks/bench_dare_dom.py mede os dois.
+"""
+import re
+from typing import Optional
+
+from bs4 import BeautifulSoup
+
+import fisconforme
+
+
+def _remover_textos_menu(soup: BeautifulSoup):
+    for txt in ["Voltar", "Imprimir", "COPIAR CÓDIGO DE BARRAS", "COPIAR QR CODE PIX"]:
+        for node in soup.find_all(string=re.compile(re.escape(txt), re.I)):
+            p = node.find_parent(["a", "button", "div", "span"])
+            if p:
+                try:
+                    p.decompose()
+                except Exception:
+                    pass
+
+
+def _neutralizar_pagebreaks(soup: BeautifulSoup):
+    for tag in soup.find_all(True):
+        st = (tag.get("style") or "")
+        cls = " ".join(tag.get("class") or [])
+        if "page-break" in st.lower() or "break-after" in st.lower() or "pagebreak" in cls.lower():
+            try:
+                tag["style"] = re.sub(r"page-break-[^;]+;?", "", st, flags=re.I)
+                tag["style"] = re.sub(r"break-[^;]+;?", "", tag.get("style",""), flags=re.I)
+            except Exception:
+                pass
+
+
+def _marcar_primeira_img_como_logo(soup: BeautifulSoup):
+    for img in soup.find_all("img"):
+        src = (img.get("src") or "").strip()
+        if not src:
+            continue
+        classes = img.get("class") or []
+        if "logo-sefin" not in classes:
+            classes.append("logo-sefin")
+        img["class"] = classes
+        break
+
+
+def _centralizar_barcodes(soup: BeautifulSoup):
+    padrao = re.compile(r"\b\d{11}\s+\d{12}\s+\d{12}\s+\d{12}\b")
+    for node in soup.find_all(string=padrao):
+        parent = node.find_parent(["td", "div", "p", "span"])
+        if parent:
+            st = parent.get("style") or ""
+            parent["style"] = (st + ";text-align:center;").strip(";")
+
+    for tag in soup.find_all(["img", "svg"]):
+        src = (tag.get("src") or "").lower()
+        if tag.name == "svg" or ("barra" in src) or ("barcode" in src) or ("codigo" in src) or ("qrcode" in src):
+            st = tag.get("style") or ""
+            tag["style"] = (st + ";display:block;margin:0 auto;").strip(";")
+            p = tag.find_parent(["td","div","p","span"])
+            if p:
+                pst = p.get("style") or ""
+                p["style"] = (pst + ";text-align:center;").strip(";")
+
+
+def _extrair_bloco_via(soup: BeautifulSoup, regex_alvo: str, regex_proibido: str) -> Optional[str]:
+    alvo = re.compile(regex_alvo, re.I)
+    proib = re.compile(regex_proibido, re.I)
+
+    node = soup.find(string=alvo)
+    if not node:
+        return None
+
+    cur = node
+    candidates = []
+    for _ in range(18):
+        cur = cur.parent if hasattr(cur, "parent") else None
+        if not cur or not getattr(cur, "name", None):
+            break
+        if cur.name in ("table","div","section","article"):
+            txt = cur.get_text(" ", strip=True)
+            if len(txt) < 200:
+                continue
+            if proib.search(txt):
+                continue
+            candidates.append(cur)
+
+    if not candidates:
+        parent = node.find_parent(["table","div","section","article"])
+        if parent:
+            txt = parent.get_text(" ", strip=True)
+            if len(txt) >= 200 and not proib.search(txt):
+                return str(parent)
+        return None
+
+    best = min(candidates, key=lambda t: len(t.get_text(" ", strip=True)))
+    return str(best)
+
+
+def preparar_dare_duas_vias(html_dare_final: str) -> str:
+    soup = fisconforme._soup(html_dare_final)
+    _remover_textos_menu(soup)
+    _neutralizar_pagebreaks(soup)
+    _marcar_primeira_img_como_logo(soup)
+    _centralizar_barcodes(soup)
+
+    via_banco = _extrair_bloco_via(
+        soup,
+        r"Autenticação\s*mecânica\s*/\s*Via\s*banco",
+        r"Autenticação\s*mecânica\s*/\s*Via\s*Usu[aá]rio",
+    )
+    via_usuario = _extrair_bloco_via(
+        soup,
+        r"Autenticação\s*mecânica\s*/\s*Via\s*Usu[aá]rio",
+        r"Autenticação\s*mecânica\s*/\s*Via\s*banco",
+    )
+
+    if via_banco and via_usuario:
+        body = f"""
+<div class="vias">
+  <div class="via">{via_banco}</div>
+  <div class="corte">------------------------------------ corte aqui ------------------------------------</div>
+  <div class="via">{via_usuario}</div>
+</div>
+"""
+        return fisconforme.absolutizar_recursos(body, fisconforme.BASE_DARE)
+
+    # fallback: corpo inteiro
+    body = soup.body.decode_contents() if soup.body else str(soup)
+    return fisconforme.absolutizar_recursos(body, fisconforme.BASE_DARE)
@@ -0,0 +1,112 @@
+# parsers_bs4_referencia.py
+"""
+Parsers antigos do fisconforme (árvore bs4 inteira, sem SoupStrainer nem
+lxml direto), congelados como oráculo dos testes de equivalência em
+test_parsers.py. Não são usados em produção.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+import fisconforme
+
+
+def extrair_form_logintoken(html: str) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
+    soup = fisconforme._soup(html)
+    for form in soup.find_all("form"):
+        action = form.get("action") or ""
+        if "portalcontribuinte.sefin.ro.gov.br" in action or "LoginToken" in action:
+            if not action.startswith("http"):
+                action = requests.compat.urljoin(fisconforme.URL_REDIRECT_PORTAL, action)
+            data: Dict[str, str] = {}
+            for inp in form.find_all("input"):
+                name = inp.get("name")
+                if not name:
+                    continue
+                data[name] = inp.get("value", "") or ""
+            return action, data
+    return None, None
+
+
+def obter_pendencias_fisconforme(html_fis: str) -> List[Dict[str, str]]:
+    soup = fisconforme._soup(html_fis)
+    tables = soup.find_all("table")
+    if not tables:
+        return []
+
+    tabela_alvo = None
+    for t in tables:
+        thead = t.find("thead")
+        if not thead:
+            continue
+        header_text = " ".join(thead.stripped_strings).upper()
+        if "CÓDIGO" in header_text and "DESCRIÇÃO DA PENDÊNCIA" in header_text:
+            tabela_alvo = t
+            break
+    if not tabela_alvo:
+        return []
+
+    tbody = tabela_alvo.find("tbody")
+    if not tbody:
+        return []
+
+    pendencias: List[Dict[str, str]] = []
+    for tr in tbody.find_all("tr"):
+        cols = [td.get_text(" ", strip=True) for td in tr.find_all("td")]
+        if len(cols) < 5:
+            continue
+        codigo, ie, nome, periodo, descricao = cols[:5]
+        pendencias.append({"codigo": codigo, "ie": ie, "nome": nome, "periodo": periodo, "descricao": descricao})
+    return pendencias
+
+
+def obter_debitos_inscricao_estadual(html_deb: str) -> List[Dict[str, str]]:
+    soup = fisconforme._soup(html_deb)
+    tabela_alvo = None
+    for tab in soup.find_all("table"):
+        ths = tab.find_all("th")
+        if not ths:
+            continue
+        if "DÉBITOS NA INSCRIÇÃO ESTADUAL" in ths[0].get_text(" ", strip=True).upper():
+            tabela_alvo = tab
+            break
+    if not tabela_alvo:
+        return []
+
+    linhas = tabela_alvo.find_all("tr")
+    if len(linhas) <= 2:
+        return []
+
+    debitos: List[Dict[str, str]] = []
+    for tr in linhas[2:]:
+        tds = tr.find_all("td")
+        if len(tds) < 11:
+            continue
+
+        def txt(i: int) -> str:
+            return tds[i].get_text(" ", strip=True) if i < len(tds) else ""
+
+        link_dare = tr.find("a", href=fisconforme._RE_LINK_DARE)
+        link_extrato = tr.find("a", href=fisconforme._RE_LINK_EXTRATO)
+
+        debitos.append({
+            "dare": txt(0),
+            "extrato": txt(1),
+            "nr_lancamento": txt(2),
+            "parcela": txt(3),
+            "referencia": txt(4),
+            "complemento": txt(5),
+            "receita": txt(6),
+            "situacao": txt(7),
+            "data_vencimento": txt(8),
+            "valor_lancamento": txt(9),
+            "valor_atualizado": txt(10),
+            "url_dare": fisconforme._norm_url_debito(link_dare.get("href") if link_dare else ""),
+            "url_extrato": fisconforme._norm_url_debito(link_extrato.get("href") if link_extrato else ""),
+        })
+
+    return debitos
+
+
+def listar_inscricoes_estaduais(html: str) -> List[str]:
+    return fisconforme._listar_inscricoes_estaduais_soup(fisconforme._soup(html))
@@ -0,0 +1,73 @@
+# test_async.py
+"""
+Engine async contra o sefin_fake: parse das páginas fora do event loop,
+ZIP completo e nada de ZIP parcial no disco quando uma empresa falha.
+
+    cd pasta && python -m pytest -q tests/test_async.py
+"""
+import asyncio
+import threading
+import zipfile
+
+import pytest
+
+import fisconforme
+
+
+@pytest.fixture
+def sem_cache_sessao(monkeypatch):
+    # cada teste tem o seu event loop; sessão async não pode atravessar loops
+    monkeypatch.setattr(fisconforme.cache_sessoes_async, "ativo", False)
+
+
+def test_parse_fora_do_event_loop(sefin, sem_cache_sessao, monkeypatch):
+    threads = {}
+    for nome in ("_ler_form_debitos", "_debitos_da_lista", "encontrar_form_fisconforme", "obter_pendencias_fisconforme"):
+        original = getattr(fisconforme, nome)
+
+        def registrando(*args, _nome=nome, _original=original):
+            threads.setdefault(_nome, set()).add(threading.get_ident())
+            return _original(*args)
+
+        monkeypatch.setattr(fisconforme, nome, registrando)
+
+    cert = fisconforme.carregar_certificados_validos(sefin.user)[0]
+
+    async def rodar():
+        return threading.get_ident(), await fisconforme.fluxo_fisconforme_async(cert)
+
+    loop_thread, res = asyncio.run(rodar())
+    assert res["qtd_pendencias"] == sefin.pendencias
+    assert res["qtd_debitos"] > 0
+    assert set(threads) == {"_ler_form_debitos", "_debitos_da_lista", "encontrar_form_fisconforme", "obter_pendencias_fisconforme"}
+    assert all(loop_thread not in ids for ids in threads.values())
+
+
+def test_zip_completo(sefin, sem_cache_sessao, chromium_falso, tmp_path):
+    zip_path, _, empresas, pdfs, erros, _ = asyncio.run(
+        fisconforme.gerar_zip_dares_async(sefin.user, destino_dir=str(tmp_path))
+    )
+    assert (empresas, erros) == (sefin.empresas, 0)
+    with zipfile.ZipFile(zip_path) as z:
+        assert z.testzip() is None
+        assert len([n for n in z.namelist() if n.endswith(".pdf")]) == pdfs > 0
+
+
+def test_arquivo_invalido_antes_de_tudo(tmp_path, monkeypatch):
+    def nao_chamar(user):
+        raise AssertionError("não devia consultar certificados")
+
+    monkeypatch.setattr(fisconforme, "carregar_certificados_validos", nao_chamar)
+    with pytest.raises(ValueError, match="modo de arquivo inválido"):
+        asyncio.run(fisconforme.gerar_zip_dares_async("u", destino_dir=str(tmp_path), arquivo_modo="rar"))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_falha_no_meio_nao_deixa_zip_parcial(sefin, sem_cache_sessao, chromium_falso, tmp_path, monkeypatch):
+    def quebrar(self, pasta, nome, pdf):
+        raise OSError("disco cheio")
+
+    monkeypatch.setattr(fisconforme.ArquivoDares, "adicionar", quebrar)
+    with pytest.raises(OSError, match="disco cheio"):
+        asyncio.run(fisconforme.gerar_zip_dares_async(sefin.user, destino_dir=str(tmp_path)))
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,49 @@
+# test_cache_pdf.py
+"""
+CachePdfDare: hit/miss, total contabilizado igual ao tamanho em disco
+(inclusive regravando a mesma chave) e evicção LRU até 90% do teto.
+
+    cd pasta && python -m pytest -q tests/test_cache_pdf.py
+"""
+import os
+import time
+
+import pytest
+
+import fisconforme
+
+
+def _em_disco(cache: fisconforme.CachePdfDare) -> int:
+    return sum(t for _, t, _ in cache._listar())
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return fisconforme.CachePdfDare(str(tmp_path / "pdfs"), max_bytes=10_000, ativo=True)
+
+
+def test_hit_e_miss(cache):
+    assert cache.obter("ab" * 20) is None
+    cache.guardar("ab" * 20, b"%PDF-1")
+    assert cache.obter("ab" * 20) == b"%PDF-1"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_regravar_a_mesma_chave_nao_infla_o_total(cache):
+    cache.guardar("aa" * 20, b"x" * 100)   # primeiro guardar: total vem do disco
+    for tam in (1000, 3000, 500, 3000):
+        cache.guardar("bb" * 20, b"y" * tam)
+        assert cache.status()["bytes"] == _em_disco(cache) == 100 + tam
+    assert len(cache._listar()) == 2
+
+
+def test_evicta_os_mais_antigos_ate_90_por_cento(cache):
+    for i in range(12):
+        chave = f"{i:02d}" * 20
+        cache.guardar(chave, b"z" * 1000)
+        path = cache._arquivo(chave)
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+    assert cache.status()["bytes"] == _em_disco(cache) <= 10_000
+    # os mais recentes ficam
+    assert cache.obter(f"{11:02d}" * 20) is not None
+    assert cache.obter(f"{0:02d}" * 20) is None
@@ -0,0 +1,73 @@
+# test_captcha.py
+"""
+ServicoCaptcha com o BackendCaptchaLocal (sem rede): resposta certa,
+timeout, falha no enviar e a rodada de getTaskResult limitada a uma por
+intervalo mesmo com resolver() chegando sem parar.
+
+    cd pasta && python -m pytest -q tests/test_captcha.py
+"""
+import time
+
+import fisconforme
+
+
+class BackendEnvioQuebrado(fisconforme.BackendCaptchaLocal):
+    def enviar(self, img_bytes):
+        raise RuntimeError("sem saldo")
+
+
+def test_resposta_certa():
+    backend = fisconforme.BackendCaptchaLocal(lambda img: img.decode()[::-1], atraso=0.05)
+    servico = fisconforme.ServicoCaptcha(backend, intervalo=0.02, timeout=5)
+    fut = servico.resolver(b"4321")
+    assert fut.result(timeout=5) == "1234"
+    servico.reportar(fut, True)
+    st = servico.status()
+    assert (st["enviados"], st["resolvidos"], st["falhas"], st["acerto"]) == (1, 1, 0, 1.0)
+
+
+def test_incorreto_e_reportado_ao_backend():
+    backend = fisconforme.BackendCaptchaLocal()
+    servico = fisconforme.ServicoCaptcha(backend, intervalo=0.02, timeout=5)
+    fut = servico.resolver(b"x")
+    assert fut.result(timeout=5) == "0000"
+    servico.reportar(fut, False)
+    assert backend.incorretos == [fut.task_id]
+    assert servico.status()["acerto"] == 0.0
+
+
+def test_timeout_devolve_none():
+    backend = fisconforme.BackendCaptchaLocal(atraso=60)
+    servico = fisconforme.ServicoCaptcha(backend, intervalo=0.02, timeout=0.2)
+    assert servico.resolver(b"x").result(timeout=5) is None
+    st = servico.status()
+    assert (st["resolvidos"], st["falhas"], st["pendentes"]) == (0, 1, 0)
+
+
+def test_falha_no_enviar_devolve_none():
+    servico = fisconforme.ServicoCaptcha(BackendEnvioQuebrado(), intervalo=0.02, timeout=5)
+    assert servico.resolver(b"x").result(timeout=5) is None
+    st = servico.status()
+    assert (st["enviados"], st["falhas"]) == (0, 1)
+
+
+def test_resolver_nao_antecipa_rodada_de_consulta():
+    servico = fisconforme.ServicoCaptcha(fisconforme.BackendCaptchaLocal(atraso=60), intervalo=0.5, timeout=30)
+    rodadas = []
+    consultar = servico._consultar_pendentes
+
+    def contando():
+        rodadas.append(time.monotonic())
+        consultar()
+
+    servico._consultar_pendentes = contando
+    futs = []
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < 1.2:
+        futs.append(servico.resolver(b"x"))
+        time.sleep(0.01)
+    time.sleep(0.05)
+    # ~100 resolver() em 1.2s: todos enviados, mas só as rodadas de t=0, 0.5 e 1.0
+    assert servico.status()["enviados"] == len(futs)
+    assert 2 <= len(rodadas) <= 3
+    assert all(b - a >= 0.5 for a, b in zip(rodadas, rodadas[1:]))
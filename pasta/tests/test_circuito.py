@@ -0,0 +1,87 @@
+# test_circuito.py
+"""
+Sonda do circuito meio aberto (ControleHost): quem recebe a sonda e sai sem
+registrar() — exceção fora das de rede, cancelamento — tem que devolvê-la,
+senão o host fica rejeitando tudo.
+
+    cd pasta && python -m pytest -q tests/test_circuito.py
+"""
+import asyncio
+import time
+
+import httpx
+import pytest
+import requests
+
+import fisconforme
+
+
+def _meio_aberto(host: str) -> fisconforme.ControleHost:
+    ctl = fisconforme.ControleHost(host)
+    ctl.estado = "aberto"
+    ctl._aberto_ate = time.monotonic() - 1
+    return ctl
+
+
+@pytest.fixture
+def controle(monkeypatch):
+    monkeypatch.setattr(fisconforme, "LIMITE_HOST_ATIVO", True)
+    hosts = {}
+
+    def de(url):
+        host = requests.compat.urlparse(url).hostname or ""
+        if host not in hosts:
+            hosts[host] = _meio_aberto(host)
+        return hosts[host]
+
+    monkeypatch.setattr(fisconforme.controle_hosts, "de", de)
+    return hosts
+
+
+def test_sonda_so_uma_por_vez():
+    ctl = _meio_aberto("h")
+    assert ctl.reservar()[1] is True
+    with pytest.raises(fisconforme.CircuitoAberto):
+        ctl.reservar()
+    ctl.registrar(False, 0.01)
+    assert ctl.estado == "fechado"
+    assert ctl.reservar()[1] is False
+
+
+def test_liberar_sonda():
+    ctl = _meio_aberto("h")
+    assert ctl.reservar()[1] is True
+    ctl.liberar_sonda()
+    assert ctl.reservar()[1] is True
+
+
+def test_sync_excecao_fora_da_rede_libera_sonda(controle, monkeypatch):
+    def send(self, request, **kwargs):
+        raise requests.exceptions.InvalidURL("url ruim")
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, "send", send)
+    sess = requests.Session()
+    sess.mount("https://", fisconforme.AdaptadorSefin())
+
+    with pytest.raises(requests.exceptions.InvalidURL):
+        sess.get("https://sefin.teste/x")
+    ctl = controle["sefin.teste"]
+    assert ctl.estado == "meio_aberto"
+    assert ctl.reservar()[1] is True
+
+
+def test_async_cancelamento_libera_sonda(controle):
+    class Travado(httpx.AsyncBaseTransport):
+        async def handle_async_request(self, request):
+            await asyncio.sleep(60)
+
+    async def rodar():
+        transporte = fisconforme.TransporteSefinAsync(Travado())
+        tarefa = asyncio.ensure_future(transporte.handle_async_request(httpx.Request("GET", "https://sefin.teste/x")))
+        await asyncio.sleep(0.05)
+        tarefa.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tarefa
+
+    asyncio.run(rodar())
+    assert controle["sefin.teste"].reservar()[1] is True
@@ -0,0 +1,53 @@
+# test_dare_dom.py
+"""
+preparar_dare_duas_vias (uma passada) contra a versão multipasso antiga
+(tests/dare_multipasso_referencia.py): mesmo <body> nas páginas DARE de
+tests/fixtures, com as 2 vias, sem uma das vias e página curta.
+
+    cd pasta && python -m pytest -q tests/test_dare_dom.py
+"""
+import os
+
+import pytest
+from bs4 import BeautifulSoup
+
+import fisconforme
+from tests import dare_multipasso_referencia as multipasso
+
+DIR_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+PAGINAS_DARE = ["dare_final.html", "dare_sem_via_usuario.html", "dare_curta.html"]
+
+
+def _fixture(nome: str) -> str:
+    with open(os.path.join(DIR_FIXTURES, nome), encoding="utf-8") as f:
+        return f.read()
+
+
+def _body(html: str) -> str:
+    # a multipasso devolve o fragmento re-parseado (com <html><body>), a nova o fragmento puro
+    soup = BeautifulSoup(html, "lxml")
+    return (soup.body or soup).decode_contents()
+
+
+@pytest.mark.parametrize("nome", PAGINAS_DARE)
+def test_body_igual_ao_multipasso(nome):
+    html = _fixture(nome)
+    assert _body(fisconforme.preparar_dare_duas_vias(html)) == _body(multipasso.preparar_dare_duas_vias(html))
+
+
+def test_duas_vias_em_uma_pagina():
+    body = fisconforme.preparar_dare_duas_vias(_fixture("dare_final.html"))
+    assert body.count('class="via"') == 2
+    assert "corte aqui" in body
+    assert "Voltar" not in body and "COPIAR CÓDIGO DE BARRAS" not in body
+    assert "page-break" not in body
+    assert 'src="/' not in body and 'href="/' not in body
+
+
+def test_erro_no_transformador_propaga(monkeypatch):
+    def quebrar(soup, base_url):
+        raise RuntimeError("bug no transformador")
+
+    monkeypatch.setattr(fisconforme, "_transformar_dare", quebrar)
+    with pytest.raises(RuntimeError, match="bug no transformador"):
+        fisconforme.preparar_dare_duas_vias(_fixture("dare_final.html"))
@@ -0,0 +1,59 @@
+# test_dares_lote.py
+"""
+/dares/lote contra o sefin_fake: ZIP por user dentro do ZIP do lote e
+nenhum arquivo sobrando no tempdir depois da resposta (download=1, 0 e erro).
+
+    cd pasta && python -m pytest -q tests/test_dares_lote.py
+"""
+import io
+import tempfile
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+import fisconforme
+from benchmarks.sefin_fake import StandInSefin
+
+
+@pytest.fixture
+def lote(monkeypatch, tmp_path, chromium_falso):
+    monkeypatch.setattr(fisconforme.cache_pdf_dare, "ativo", False)
+    with StandInSefin(empresas=3, users=["u1", "u2"]) as s:
+        s.apontar(fisconforme)
+        # tempdir só para o lote: o que sobrar nele é vazamento
+        pasta = tmp_path / "tmp"
+        pasta.mkdir()
+        monkeypatch.setattr(tempfile, "tempdir", str(pasta))
+        yield TestClient(fisconforme.app), pasta
+
+
+def test_download_devolve_zip_por_user_e_limpa(lote):
+    cliente, pasta = lote
+    r = cliente.get("/dares/lote", params={"users": "u1,u2,ninguem", "modo": "thread"})
+    assert r.status_code == 200
+    z = zipfile.ZipFile(io.BytesIO(r.content))
+    zips = sorted(n for n in z.namelist() if n.endswith(".zip"))
+    assert len(zips) == 2
+    for nome in zips:
+        interno = zipfile.ZipFile(io.BytesIO(z.read(nome)))
+        assert interno.testzip() is None
+        assert any(n.endswith(".pdf") for n in interno.namelist())
+    assert z.read("USERS_SEM_EMPRESA.txt").decode().split() == ["ninguem"]
+    assert list(pasta.iterdir()) == []
+
+
+def test_download_0_limpa(lote):
+    cliente, pasta = lote
+    j = cliente.get("/dares/lote", params={"users": "u1,u2", "download": 0, "modo": "thread"}).json()
+    assert j["ok"] and all(s["ok"] and s["pdfs"] > 0 for s in j["results"])
+    assert list(pasta.iterdir()) == []
+
+
+def test_erro_limpa(lote):
+    cliente, pasta = lote
+    j = cliente.get("/dares/lote", params={"users": "u1", "arquivo": "rar"}).json()
+    assert j["ok"] is False and "arquivo" in j["error"]
+    j = cliente.get("/dares/lote", params={"users": "ninguem"}).json()
+    assert j["ok"] is False
+    assert list(pasta.iterdir()) == []
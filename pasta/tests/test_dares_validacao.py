@@ -0,0 +1,49 @@
+# test_dares_validacao.py
+"""
+modo/arquivo inválidos recusados antes de qualquer trabalho: /dares com
+stream=1 (antes dos headers do ZIP), jobs e _iterar_empresas com 1 ou N
+empresas.
+
+    cd pasta && python -m pytest -q tests/test_dares_validacao.py
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+import fisconforme
+
+
+@pytest.fixture
+def cliente():
+    return TestClient(fisconforme.app)
+
+
+def test_stream_modo_invalido_responde_json(cliente):
+    r = cliente.get("/dares", params={"user": "u", "stream": 1, "modo": "turbo"})
+    assert r.headers["content-type"].startswith("application/json")
+    assert r.json() == {"ok": False, "user": "u", "error": "modo de execução inválido: turbo"}
+
+
+def test_stream_arquivo_invalido_responde_json(cliente):
+    r = cliente.get("/dares", params={"user": "u", "stream": 1, "arquivo": "rar"})
+    assert r.json()["error"] == "modo de arquivo inválido: rar"
+
+
+@pytest.mark.parametrize("params, erro", [
+    ({"modo": "turbo"}, "modo de execução inválido: turbo"),
+    ({"arquivo": "rar"}, "modo de arquivo inválido: rar"),
+])
+def test_job_invalido_400(cliente, params, erro):
+    r = cliente.post("/dares/jobs", params={"user": "u", **params})
+    assert r.status_code == 400
+    assert r.json()["error"] == erro
+
+
+@pytest.mark.parametrize("itens, workers", [([1], 4), ([1, 2, 3], 1), ([1, 2, 3], 4)])
+def test_iterar_empresas_modo_invalido(itens, workers):
+    with pytest.raises(ValueError, match="modo de execução inválido"):
+        list(fisconforme._iterar_empresas(lambda x: x, itens, "turbo", workers))
+
+
+@pytest.mark.parametrize("modo", ["serial", "thread"])
+def test_iterar_empresas_modos_validos(modo):
+    assert sorted(fisconforme._iterar_empresas(lambda x: x * 2, [1, 2, 3], modo, 2)) == [2, 4, 6]
@@ -0,0 +1,53 @@
+# test_debitos.py
+"""
+Consulta de débitos contra o sefin_fake, que lê IE/ano da sessão do portal
+como a lista.jsp real: cada débito tem que sair com a IE e o ano do próprio
+POST, na engine sync e na async.
+
+    cd pasta && python -m pytest -q tests/test_debitos.py
+"""
+import asyncio
+
+import httpx
+import pytest
+import requests
+
+import fisconforme
+from benchmarks.sefin_fake import StandInSefin
+
+
+@pytest.fixture
+def sefin_lento():
+    # atraso abre a janela entre gravar o filtro na sessão e montar a lista
+    with StandInSefin(empresas=1, inscricoes=3, atraso=0.02) as s:
+        s.apontar(fisconforme)
+        yield s
+
+
+ANOS = [2026, 2025, 2024]
+
+
+def _conferir(sefin, debitos, erros):
+    anos = [str(a) for a in ANOS]
+    assert erros == []
+    assert len(debitos) == len(sefin.inscricoes) * len(anos) * sefin.debitos_por_ie
+    for d in debitos:
+        # o fake monta nº do lançamento e referência a partir da IE/ano que leu da sessão
+        assert d["nr_lancamento"].startswith(d["ie"][-3:] + d["ano"]), d
+        assert d["referencia"].endswith("/" + d["ano"]), d
+    assert {(d["ie"], d["ano"]) for d in debitos} == {(ie, a) for ie in sefin.inscricoes for a in anos}
+    assert sefin.requisicoes["debitos_trocados"] == 0
+
+
+def test_sync_cada_debito_com_a_sua_ie_e_ano(sefin_lento):
+    # o fake não exige login na consulta; uma Session = um cookie jar, como por empresa
+    with requests.Session() as sess:
+        _conferir(sefin_lento, *fisconforme.consultar_debitos_anos(sess, ANOS))
+
+
+def test_async_cada_debito_com_a_sua_ie_e_ano(sefin_lento):
+    async def rodar():
+        async with httpx.AsyncClient() as cli:
+            return await fisconforme.consultar_debitos_anos_async(cli, ANOS)
+
+    _conferir(sefin_lento, *asyncio.run(rodar()))
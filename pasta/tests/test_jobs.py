@@ -0,0 +1,140 @@
+# test_jobs.py
+"""
+FilaJobsDares contra o sefin_fake (Chromium falso): estado do job em disco
+a cada passo, restart recolocando na fila o job interrompido, job
+finalizado que não roda de novo, JSON corrompido ignorado, expiração e as
+rotas /dares/jobs.
+
+    cd pasta && python -m pytest -q tests/test_jobs.py
+"""
+import json
+import os
+import threading
+import time
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+import fisconforme
+
+
+def _aguardar(fila: fisconforme.FilaJobsDares, job_id: str, status=("concluido", "erro"), limite: float = 60) -> dict:
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        job = fila.obter(job_id)
+        if job and job["status"] in status:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} não chegou em {status}: {fila.obter(job_id)}")
+
+
+def _em_disco(pasta, job_id: str) -> dict:
+    with open(os.path.join(pasta, f"{job_id}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def pasta_jobs(tmp_path):
+    return str(tmp_path / "jobs")
+
+
+def test_job_concluido_fica_em_disco(sefin, chromium_falso, pasta_jobs):
+    fila = fisconforme.FilaJobsDares(pasta_jobs)
+    job = fila.submeter(sefin.user, 2, "pipeline")
+    assert _em_disco(pasta_jobs, job["id"])["status"] in ("na_fila", "rodando", "concluido")
+
+    job = _aguardar(fila, job["id"])
+    assert job["status"] == "concluido", job
+    assert job["empresas"] == job["empresas_concluidas"] == sefin.empresas
+    assert job["pdfs"] > 0 and job["erros"] == 0
+    assert _em_disco(pasta_jobs, job["id"]) == job
+    assert os.path.dirname(job["zip_path"]) == pasta_jobs
+    with zipfile.ZipFile(job["zip_path"]) as z:
+        assert len([n for n in z.namelist() if n.endswith(".pdf")]) == job["pdfs"]
+
+
+def test_restart_recoloca_o_job_interrompido(sefin, chromium_falso, pasta_jobs, monkeypatch):
+    gerar = fisconforme.gerar_zip_dares
+    liberar = threading.Event()
+
+    def travado(*args, **kwargs):
+        liberar.wait(30)
+        raise RuntimeError("processo morto")
+
+    # primeiro processo: job fica "rodando" e o processo "morre"
+    monkeypatch.setattr(fisconforme, "gerar_zip_dares", travado)
+    antes = fisconforme.FilaJobsDares(pasta_jobs)
+    job_id = antes.submeter(sefin.user, 2, "pipeline", arquivo="zip_por_empresa")["id"]
+    _aguardar(antes, job_id, status=("rodando",))
+    assert _em_disco(pasta_jobs, job_id)["status"] == "rodando"
+
+    # restart: nova fila na mesma pasta, com o gerar_zip_dares de verdade
+    monkeypatch.setattr(fisconforme, "gerar_zip_dares", gerar)
+    depois = fisconforme.FilaJobsDares(pasta_jobs)
+    try:
+        depois.iniciar()
+        job = _aguardar(depois, job_id)
+        assert job["status"] == "concluido", job
+        assert job["reinicios"] == 1
+        assert job["arquivo"] == "zip_por_empresa" and job["modo"] == "pipeline"
+        assert job["pdfs"] > 0
+        assert _em_disco(pasta_jobs, job_id) == job
+    finally:
+        liberar.set()
+
+
+def test_job_finalizado_nao_roda_de_novo(pasta_jobs, monkeypatch):
+    monkeypatch.setattr(fisconforme, "carregar_certificados_validos", lambda user: [])
+    fila = fisconforme.FilaJobsDares(pasta_jobs)
+    job = _aguardar(fila, fila.submeter("sem_empresas", 1, "thread")["id"])
+    assert (job["status"], job["error"]) == ("erro", "Nenhuma empresa para este user.")
+
+    # lixo na pasta (gravação interrompida) não impede o restart
+    with open(os.path.join(pasta_jobs, "quebrado.json"), "w", encoding="utf-8") as f:
+        f.write('{"id": "quebr')
+
+    def nao_chamar(*args, **kwargs):
+        raise AssertionError("job finalizado não volta para a fila")
+
+    monkeypatch.setattr(fisconforme, "gerar_zip_dares", nao_chamar)
+    depois = fisconforme.FilaJobsDares(pasta_jobs)
+    depois.iniciar()
+    time.sleep(0.2)
+    assert depois.obter(job["id"]) == job
+    assert depois.obter("quebrado") is None
+
+
+def test_expirados_somem_do_disco(sefin, chromium_falso, pasta_jobs):
+    fila = fisconforme.FilaJobsDares(pasta_jobs)
+    job = _aguardar(fila, fila.submeter(sefin.user, 2, "thread")["id"])
+    fila.limpar_expirados(forcar=True)
+    assert fila.obter(job["id"]) == job and os.path.exists(job["zip_path"])
+
+    fila.retencao_s = 0
+    time.sleep(0.01)
+    fila.limpar_expirados(forcar=True)
+    assert fila.obter(job["id"]) is None
+    assert os.listdir(pasta_jobs) == []
+
+
+def test_rotas_submit_status_download(sefin, chromium_falso, pasta_jobs, monkeypatch):
+    fila = fisconforme.FilaJobsDares(pasta_jobs)
+    monkeypatch.setattr(fisconforme, "fila_jobs_dares", fila)
+    cliente = TestClient(fisconforme.app)
+
+    r = cliente.post("/dares/jobs", params={"user": sefin.user, "modo": "pipeline", "workers": 2})
+    assert r.status_code == 200 and r.json()["ok"]
+    job_id = r.json()["job_id"]
+    assert "zip_path" not in r.json()
+
+    _aguardar(fila, job_id)
+    st = cliente.get(f"/dares/jobs/{job_id}").json()
+    assert st["status"] == "concluido" and st["pdfs"] > 0
+
+    r = cliente.get(f"/dares/jobs/{job_id}/download")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/zip"
+    assert r.content[:2] == b"PK"
+
+    assert cliente.get("/dares/jobs/nao-existe").status_code == 404
@@ -0,0 +1,81 @@
+# test_parsers.py
+"""
+Equivalência dos parsers lxml/SoupStrainer com as versões bs4 antigas
+(tests/parsers_bs4_referencia.py), sobre as páginas de tests/fixtures. debitos_grande.html.gz tem
+~4 MB: 6000 débitos (parte sem link de DARE/extrato), subtotais, script nas
+células e rodapé longo.
+
+    cd pasta && python -m pytest -q tests
+"""
+import gzip
+import os
+
+import pytest
+
+import fisconforme
+from tests import parsers_bs4_referencia as bs4_ref
+
+DIR_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def _fixture(nome: str) -> str:
+    caminho = os.path.join(DIR_FIXTURES, nome)
+    if nome.endswith(".gz"):
+        with gzip.open(caminho, "rt", encoding="utf-8") as f:
+            return f.read()
+    with open(caminho, encoding="utf-8") as f:
+        return f.read()
+
+
+PAGINAS_PENDENCIAS = ["pendencias.html", "pendencias_vazia.html", "pendencias_sem_tbody.html", "debitos.html"]
+PAGINAS_DEBITOS = [
+    "debitos.html", "debitos_vazia.html", "debitos_sem_tabela.html", "debitos_grande.html.gz", "pendencias.html",
+]
+PAGINAS_FORMS = ["form_debitos.html", "logintoken.html", "logintoken_relativo.html", "debitos_sem_tabela.html"]
+
+
+@pytest.mark.parametrize("nome", PAGINAS_PENDENCIAS)
+def test_pendencias_iguais_ao_bs4(nome):
+    html = _fixture(nome)
+    assert fisconforme.obter_pendencias_fisconforme(html) == bs4_ref.obter_pendencias_fisconforme(html)
+
+
+@pytest.mark.parametrize("nome", PAGINAS_DEBITOS)
+def test_debitos_iguais_ao_bs4(nome):
+    html = _fixture(nome)
+    assert fisconforme.obter_debitos_inscricao_estadual(html) == bs4_ref.obter_debitos_inscricao_estadual(html)
+
+
+@pytest.mark.parametrize("nome", PAGINAS_FORMS)
+def test_inscricoes_iguais_ao_bs4(nome):
+    html = _fixture(nome)
+    assert fisconforme._listar_inscricoes_estaduais(html) == bs4_ref.listar_inscricoes_estaduais(html)
+
+
+@pytest.mark.parametrize("nome", PAGINAS_FORMS)
+def test_logintoken_igual_ao_bs4(nome):
+    html = _fixture(nome)
+    assert fisconforme.extrair_form_logintoken(html) == bs4_ref.extrair_form_logintoken(html)
+
+
+@pytest.mark.parametrize("html", ["", "   ", "<html></html>", "<table><tr><th>Débitos na Inscrição Estadual</th></tr>"])
+def test_html_vazio_ou_truncado(html):
+    assert fisconforme.obter_debitos_inscricao_estadual(html) == bs4_ref.obter_debitos_inscricao_estadual(html)
+    assert fisconforme.obter_pendencias_fisconforme(html) == bs4_ref.obter_pendencias_fisconforme(html)
+
+
+def test_fixtures_cobrem_os_casos():
+    """Os fixtures têm o que a equivalência precisa exercitar (não só listas vazias)."""
+    debitos = fisconforme.obter_debitos_inscricao_estadual(_fixture("debitos.html"))
+    assert len(debitos) == 5
+    assert any(not d["url_dare"] and not d["url_extrato"] for d in debitos)   # linha sem links
+    assert fisconforme.obter_debitos_inscricao_estadual(_fixture("debitos_vazia.html")) == []
+
+    grande = _fixture("debitos_grande.html.gz")
+    assert len(grande) > 2 * 1024 * 1024
+    debitos_grande = fisconforme.obter_debitos_inscricao_estadual(grande)
+    assert len(debitos_grande) == 6000
+    assert sum(1 for d in debitos_grande if not d["url_dare"]) == 1200
+
+    assert len(fisconforme.obter_pendencias_fisconforme(_fixture("pendencias.html"))) == 5   # a linha curta fica de fora
+    assert fisconforme._listar_inscricoes_estaduais(_fixture("form_debitos.html")) == ["000000001", "000000002", "000000003"]
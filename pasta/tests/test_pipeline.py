@@ -0,0 +1,154 @@
+# test_pipeline.py
+"""
+PipelineDares contra o sefin_fake (Chromium falso): ZIP igual ao do modo
+thread, erro de um estágio vira erro do débito/empresa sem derrubar o
+resto, erro no writer e cliente que desconecta do stream cancelam tudo
+(workers parados, sessões devolvidas, nada de ZIP parcial).
+
+    cd pasta && python -m pytest -q tests/test_pipeline.py
+"""
+import threading
+import time
+import zipfile
+
+import pytest
+
+import fisconforme
+
+
+def _pdfs_no_zip(zip_path: str) -> int:
+    with zipfile.ZipFile(zip_path) as z:
+        assert z.testzip() is None
+        return len([n for n in z.namelist() if n.endswith(".pdf")])
+
+
+def _threads_do_pipeline():
+    return [th.name for th in threading.enumerate() if th.name.startswith("pipeline-")]
+
+
+def _captchas_resolvidos(sefin) -> int:
+    return sefin.requisicoes["/dare.sefin.ro.gov.br/adm/processar"]
+
+
+def _total_debitos(sefin) -> int:
+    return sefin.empresas * len(sefin.inscricoes) * len(fisconforme.anos_consulta_debitos()) * sefin.debitos_por_ie
+
+
+def _sessoes_presas():
+    return [c for c, ent in fisconforme.cache_sessoes._entradas.items() if ent.lock.locked()]
+
+
+@pytest.fixture
+def gerar(sefin, chromium_falso, tmp_path):
+    def _gerar(modo="pipeline", **kw):
+        return fisconforme.gerar_zip_dares(sefin.user, workers=2, modo=modo, destino_dir=str(tmp_path), **kw)
+    return _gerar
+
+
+def test_mesmo_zip_que_o_modo_thread(gerar):
+    progresso = []
+    zip_pipe, _, empresas, pdfs_pipe, erros, _ = gerar(progresso=progresso.append)
+    zip_thread, _, _, pdfs_thread, _, _ = gerar(modo="thread")
+
+    assert (empresas, erros) == (2, 0)
+    assert pdfs_pipe == pdfs_thread == _pdfs_no_zip(zip_pipe) == _pdfs_no_zip(zip_thread) > 0
+    # progresso por empresa traz fila/ocupação de cada estágio
+    etapas = progresso[-1]["pipeline"]
+    assert set(etapas) == {"http", "captcha", "dom", "render", "archive"}
+    assert etapas["archive"]["itens"] >= pdfs_pipe
+    assert _threads_do_pipeline() == []
+    assert _sessoes_presas() == []
+
+
+def test_erro_no_dom_vira_erro_do_debito(gerar, monkeypatch):
+    original = fisconforme.preparar_dare_duas_vias
+    chamadas = []
+
+    def quebrar_o_segundo(html, *args, **kwargs):
+        chamadas.append(1)
+        if len(chamadas) == 2:
+            raise RuntimeError("DOM inesperado")
+        return original(html, *args, **kwargs)
+
+    monkeypatch.setattr(fisconforme, "preparar_dare_duas_vias", quebrar_o_segundo)
+    zip_path, _, _, pdfs, erros, erros_list = gerar()
+
+    assert erros == 1
+    assert erros_list[0]["erro"] == "PDF DARE/Extrato (dom): DOM inesperado"
+    assert pdfs == _pdfs_no_zip(zip_path) == len(chamadas) - 1
+    with zipfile.ZipFile(zip_path) as z:
+        assert "DOM inesperado" in z.read("RELATORIO_ERROS.txt").decode()
+
+
+def test_consulta_que_falha_derruba_so_a_empresa(gerar, monkeypatch):
+    original = fisconforme.consultar_debitos_anos
+    invalidadas = []
+    chamadas = []
+
+    def falhar_a_primeira(sess, anos):
+        chamadas.append(1)
+        if len(chamadas) == 1:
+            return None, ["Erro HTTP 503 lista"]
+        return original(sess, anos)
+
+    invalidar = fisconforme.cache_sessoes.invalidar
+    monkeypatch.setattr(fisconforme, "consultar_debitos_anos", falhar_a_primeira)
+    monkeypatch.setattr(fisconforme.cache_sessoes, "invalidar", lambda cert: (invalidadas.append(cert), invalidar(cert)))
+    zip_path, _, empresas, pdfs, erros, erros_list = gerar()
+
+    assert (empresas, erros) == (2, 1)
+    assert erros_list[0]["erro"].startswith("Consulta de débitos falhou")
+    assert pdfs == _pdfs_no_zip(zip_path) > 0
+    # sessão da empresa que falhou não volta para o cache como boa
+    assert len(invalidadas) == 1
+
+
+def test_erro_no_writer_cancela_o_pipeline(gerar, sefin, tmp_path, monkeypatch):
+    original = fisconforme.ArquivoDares.adicionar
+    adicionados = []
+
+    def disco_cheio_no_terceiro(self, pasta, nome, pdf):
+        adicionados.append(nome)
+        if len(adicionados) == 3:
+            raise OSError("disco cheio")
+        return original(self, pasta, nome, pdf)
+
+    monkeypatch.setattr(fisconforme.ArquivoDares, "adicionar", disco_cheio_no_terceiro)
+    with pytest.raises(OSError, match="disco cheio"):
+        gerar()
+
+    assert len(adicionados) == 3
+    # cancelado: os captchas que ainda estavam na fila não foram resolvidos
+    assert _captchas_resolvidos(sefin) < _total_debitos(sefin) // 2
+    assert list(tmp_path.iterdir()) == []
+    assert _threads_do_pipeline() == []
+    assert _sessoes_presas() == []
+
+    # nada ficou preso: a próxima execução roda inteira
+    monkeypatch.setattr(fisconforme.ArquivoDares, "adicionar", original)
+    _, _, _, pdfs, erros, _ = gerar()
+    assert erros == 0 and pdfs > 3
+
+
+def test_cliente_que_desconecta_cancela_o_stream(sefin, chromium_falso, monkeypatch):
+    # 1 byte por bloco e 1 bloco na fila: o writer só anda no ritmo do cliente
+    monkeypatch.setattr(fisconforme._SaidaStreamZip.__init__, "__defaults__", (1, 1))
+    certs = fisconforme.carregar_certificados_validos(sefin.user)
+    gen = fisconforme.gerar_zip_dares_stream(sefin.user, certs, workers=2, modo="pipeline")
+
+    # cliente lê até o pipeline estar no meio e desconecta
+    for _ in gen:
+        if _captchas_resolvidos(sefin) >= 3:
+            break
+    gen.close()
+
+    limite = time.monotonic() + 10
+    while time.monotonic() < limite:
+        produtor = [th for th in threading.enumerate() if th.name.startswith("zip-stream-")]
+        if not produtor and not _threads_do_pipeline():
+            break
+        time.sleep(0.05)
+    assert [th.name for th in threading.enumerate() if th.name.startswith("zip-stream-")] == []
+    assert _threads_do_pipeline() == []
+    assert _sessoes_presas() == []
+    assert _captchas_resolvidos(sefin) < _total_debitos(sefin) // 2
@@ -0,0 +1,58 @@
+# test_render.py
+"""
+_pdf_dare_bytes no pool Chromium (navegador falso do conftest): fallback de
+2 renders + merge só para erro de render; timeout não cai no fallback com o
+navegador já encerrado.
+
+    cd pasta && python -m pytest -q tests/test_render.py
+"""
+import io
+import time
+
+import pytest
+from pypdf import PdfReader
+
+import fisconforme
+
+BODY_DARE = "<div class='dare'>guia</div>"
+BODY_EXTRATO = "<table><tr><td>extrato</td></tr></table>"
+
+
+def _paginas(pdf: bytes) -> int:
+    return len(PdfReader(io.BytesIO(pdf)).pages)
+
+
+def test_sem_extrato_um_render(chromium_falso):
+    pdf = fisconforme._pdf_dare_bytes(BODY_DARE, None, fisconforme.Cronometro("teste"))
+    assert _paginas(pdf) == 1
+    assert len(chromium_falso[0].renders) == 1
+
+
+def test_erro_no_combinado_usa_dois_renders_e_merge(chromium_falso, monkeypatch):
+    monkeypatch.setattr(fisconforme, "RENDER_COMBINADO", True)
+    fisconforme.pool_chromium.aquecer()
+    for nav in chromium_falso:
+        def falhar(html, nav=nav):
+            if len(nav.renders) == 1:
+                raise RuntimeError("layout quebrado")
+        nav.falhar = falhar
+
+    pdf = fisconforme._pdf_dare_bytes(BODY_DARE, BODY_EXTRATO, fisconforme.Cronometro("teste"))
+    assert _paginas(pdf) == 2
+    assert sum(len(n.renders) for n in chromium_falso) == 3
+
+
+def test_timeout_no_combinado_nao_usa_o_navegador_encerrado(chromium_falso, monkeypatch):
+    monkeypatch.setattr(fisconforme, "RENDER_COMBINADO", True)
+    monkeypatch.setattr(fisconforme.NavegadorChromium.executar, "__defaults__", (0.3,))
+    fisconforme.pool_chromium.aquecer()
+    for nav in chromium_falso:
+        nav.falhar = lambda html: time.sleep(1.5)
+
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError, match="excedeu"):
+        fisconforme._pdf_dare_bytes(BODY_DARE, BODY_EXTRATO, fisconforme.Cronometro("teste"))
+    # um timeout só (antes: +2 renders no navegador morto, cada um esperando o timeout)
+    assert time.monotonic() - t0 < 0.55
+    assert sum(len(n.renders) for n in chromium_falso) == 1
+    assert len(fisconforme.pool_chromium._todos) == 1
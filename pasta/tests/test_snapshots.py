@@ -0,0 +1,125 @@
+# test_snapshots.py
+"""
+SnapshotStore.registrar/mudancas: adicionado, removido, alterado, parte com
+erro não comparada, chaves estáveis com a resposta em outra ordem (mesmo
+lançamento/parcela em duas IEs) e banco antigo rechaveado.
+
+    cd pasta && python -m pytest -q tests/test_snapshots.py
+"""
+import json
+import random
+import sqlite3
+
+import pytest
+
+import fisconforme
+
+CERT = {"id": "c1"}
+
+
+def _deb(ie, lanc, parcela="1", valor="10,00", url="https://dare/?tok=a"):
+    return {"ie": ie, "nr_lancamento": lanc, "parcela": parcela, "valor": valor, "url_dare": url}
+
+
+def _pend(codigo, ie="000000001", periodo="01/2026"):
+    return {"codigo": codigo, "ie": ie, "nome": "X", "periodo": periodo, "descricao": "d"}
+
+
+def _res(pendencias=(), debitos=(), **extra):
+    res = {
+        "user": "u", "empresa": "EMPRESA", "situacao_geral": "ok",
+        "pendencias": list(pendencias), "qtd_pendencias": len(pendencias),
+        "debitos": list(debitos), "qtd_debitos": len(debitos),
+        "erro": None, "erro_fisconforme": None, "erro_debitos": None,
+    }
+    res.update(extra)
+    return res
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = fisconforme.SnapshotStore(str(tmp_path / "snap.sqlite3"))
+    yield s
+    s.fechar()
+
+
+def _acoes(store, desde=0):
+    mud, cursor, _ = store.mudancas("u", desde)
+    return sorted((m["tipo"], m["chave"], m["acao"]) for m in mud), cursor
+
+
+def test_primeira_execucao_tudo_adicionado(store):
+    assert store.registrar(CERT, _res([_pend("P1")], [_deb("1", "L1")])) == 2
+    acoes, _ = _acoes(store)
+    assert acoes == [("debito", "1|L1|1", "adicionado"), ("pendencia", "P1|000000001|01/2026", "adicionado")]
+
+
+def test_adicionado_removido_alterado(store):
+    store.registrar(CERT, _res([_pend("P1"), _pend("P2")], [_deb("1", "L1"), _deb("1", "L2")]))
+    _, cursor = _acoes(store)
+
+    n = store.registrar(CERT, _res([_pend("P1"), _pend("P3")], [_deb("1", "L1", valor="99,00"), _deb("1", "L2")]))
+    acoes, _ = _acoes(store, cursor)
+    assert n == 3
+    assert acoes == [
+        ("debito", "1|L1|1", "alterado"),
+        ("pendencia", "P2|000000001|01/2026", "removido"),
+        ("pendencia", "P3|000000001|01/2026", "adicionado"),
+    ]
+    mud, _, _ = store.mudancas("u", cursor)
+    alterado = next(m for m in mud if m["acao"] == "alterado")
+    assert (alterado["anterior"]["valor"], alterado["item"]["valor"]) == ("10,00", "99,00")
+
+
+def test_link_com_token_novo_nao_e_mudanca(store):
+    store.registrar(CERT, _res(debitos=[_deb("1", "L1", url="https://dare/?tok=a")]))
+    assert store.registrar(CERT, _res(debitos=[_deb("1", "L1", url="https://dare/?tok=b")])) == 0
+
+
+def test_parte_com_erro_nao_vira_removido(store):
+    store.registrar(CERT, _res([_pend("P1")], [_deb("1", "L1")]))
+    assert store.registrar(CERT, _res([_pend("P1")], [], erro_debitos="HTTP 503")) == 0
+    # e o snapshot dos débitos continua o anterior
+    assert store.registrar(CERT, _res([_pend("P1")], [_deb("1", "L1")])) == 0
+
+
+def test_mesmo_lancamento_em_duas_ies_em_qualquer_ordem(store):
+    debitos = [
+        _deb("000000001", "L1", valor="10,00"),
+        _deb("000000002", "L1", valor="20,00"),
+        _deb("000000001", "L2"),
+        _deb("000000002", "L2"),
+    ]
+    store.registrar(CERT, _res(debitos=debitos))
+    rnd = random.Random(7)
+    for _ in range(10):
+        embaralhados = debitos[:]
+        rnd.shuffle(embaralhados)
+        assert store.registrar(CERT, _res(debitos=embaralhados)) == 0
+
+
+def test_duplicado_na_mesma_chave_estavel_na_reordenacao():
+    a = _deb("1", "L1", valor="10,00")
+    b = _deb("1", "L1", valor="20,00")
+    assert fisconforme._itens_snapshot("debito", [a, b]) == fisconforme._itens_snapshot("debito", [b, a])
+
+
+def test_banco_com_chave_antiga_e_rechaveado(tmp_path):
+    caminho = str(tmp_path / "antigo.sqlite3")
+    con = sqlite3.connect(caminho)
+    con.executescript(fisconforme.SnapshotStore._SCHEMA)
+    debitos = [_deb("000000001", "L1"), _deb("000000002", "L1", valor="20,00")]
+    for chave, d in zip(("L1|1", "L1|1#2"), debitos):
+        h = fisconforme._itens_snapshot("debito", [d])["|".join((d["ie"], "L1", "1"))][0]
+        con.execute(
+            "INSERT INTO itens (cert_id, tipo, chave, hash, dados, visto_em) VALUES (?, ?, ?, ?, ?, ?)",
+            ("c1", "debito", chave, h, json.dumps(d), 1.0),
+        )
+    con.commit()
+    con.close()
+
+    store = fisconforme.SnapshotStore(caminho)
+    try:
+        assert store.registrar(CERT, _res(debitos=list(reversed(debitos)))) == 0
+    finally:
+        store.fechar()
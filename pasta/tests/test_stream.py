@@ -0,0 +1,57 @@
+# test_stream.py
+"""
+/fisconforme?stream=1 contra o sefin_fake: uma linha por empresa (NDJSON
+ou evento SSE) e o resumo no fim; /prewarm idempotente.
+
+    cd pasta && python -m pytest -q tests/test_stream.py
+"""
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import fisconforme
+
+
+@pytest.fixture
+def cliente():
+    return TestClient(fisconforme.app)
+
+
+def test_ndjson_uma_linha_por_empresa_e_resumo(sefin, cliente):
+    r = cliente.get("/fisconforme", params={"user": sefin.user, "stream": 1, "refresh": 1})
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    linhas = [json.loads(l) for l in r.text.splitlines()]
+
+    empresas, resumo = linhas[:-1], linhas[-1]
+    assert sorted(l["indice"] for l in empresas) == list(range(sefin.empresas))
+    assert all(l["tipo"] == "empresa" and l["qtd_pendencias"] == sefin.pendencias for l in empresas)
+    assert all("tempos_ms" not in l for l in empresas)
+    assert resumo["tipo"] == "resumo" and resumo["total_empresas"] == sefin.empresas
+    assert sum(resumo["situacoes"].values()) == sefin.empresas
+
+
+def test_sse_eventos(sefin, cliente):
+    r = cliente.get("/fisconforme", params={"user": sefin.user, "stream": 1, "formato": "sse", "timing": 1})
+    assert r.headers["content-type"].startswith("text/event-stream")
+    eventos = [bloco.split("\n") for bloco in r.text.strip().split("\n\n")]
+    assert [e[0] for e in eventos] == ["event: empresa"] * sefin.empresas + ["event: resumo"]
+    assert all("tempos_ms" in json.loads(e[1][len("data: "):]) for e in eventos[:-1])
+
+
+def test_formato_invalido(cliente):
+    r = cliente.get("/fisconforme", params={"user": "u", "stream": 1, "formato": "xml"})
+    assert r.status_code == 400
+    assert r.json()["error"] == "formato inválido: xml"
+
+
+def test_prewarm_idempotente(cliente, chromium_falso, monkeypatch):
+    monkeypatch.setattr(fisconforme, "prewarm", fisconforme.Prewarm())
+    r1 = cliente.get("/prewarm", params={"chromium": 1, "aguardar": 30}).json()
+    r2 = cliente.get("/prewarm", params={"aguardar": 30}).json()
+
+    assert r1["estado"] in ("concluido", "erro")
+    assert {"parsers", "pdf", "chromium"} <= set(r1["etapas_ms"])
+    # segunda chamada não refaz o que já aqueceu
+    assert r2["etapas_ms"] == r1["etapas_ms"] and r2["chromium"]
+    assert len(chromium_falso) == fisconforme.pool_chromium.tamanho